@@ -13,7 +13,14 @@
 # limitations under the License.
 #
 
+import os
+from copy import deepcopy
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+
 from cloudify import ctx
+from cloudify.state import current_ctx
+from cloudify.manager import DirtyTrackingDict
 from cloudify.exceptions import (
     RecoverableError,
     NonRecoverableError
@@ -21,16 +28,28 @@ from cloudify.exceptions import (
 from cloudify.decorators import operation
 
 from ._compat import text_type
-from .utils import (get_node,
+from .utils import (NODE_INSTANCE,
+                    get_node,
                     get_instance,
                     retrieve_path,
+                    update_instance,
                     get_client_config,
+                    coalesced_updates,
+                    bulk_operations_enabled,
+                    get_resource_definitions,
+                    order_added_resource_definitions,
+                    DEFS,
+                    DEFS_ORDER,
                     NODE_PROPERTY_FILE,
                     NODE_PROPERTY_OPTIONS,
+                    NODE_PROPERTY_RESOURCES_CONCURRENCY,
                     handle_existing_resource,
                     generate_traceback_exception,
                     NODE_PROPERTY_FILE_RESOURCE_PATH,
                     INSTANCE_RUNTIME_PROPERTY_KUBERNETES)
+from .k8s.cache import get_api_client, invalidate_api_client
+from .k8s.discovery import ApiDiscovery, DISCOVERY_CACHE_TTL
+from .k8s.planner import plan_waves
 from .k8s import (CloudifyKubernetesClient,
                   KuberentesMappingNotFoundError,
                   KuberentesInvalidApiClassError,
@@ -55,6 +74,9 @@ RELATIONSHIP_TYPE_MANAGED_BY_MASTER = (
 RELATIONSHIP_TYPE_MANAGED_BY_CLUSTER = (
     'cloudify.relationships.kubernetes.connected_to_shared_cluster'
 )
+AUTHENTICATION_FAILURES = ['(401)', 'Unauthorized']
+CLIENT_CONFIG_API_DISCOVERY = 'api_discovery'
+API_DISCOVERY_CACHE_DIR = 'api_discovery_cache'
 
 
 def _retrieve_master(resource_instance):
@@ -87,13 +109,213 @@ def _retrieve_property(_ctx, property_name, client_config=None):
     return configuration
 
 
+def _api_discovery(api_client, client_config):
+    """ Create the API discovery of the cluster, if client_config enables
+    it. The discovery is cached in the plugin workdir, when there is one.
+    """
+    api_discovery = client_config.get(CLIENT_CONFIG_API_DISCOVERY) or {}
+    if not api_discovery.get('enabled'):
+        return
+    try:
+        workdir = ctx.plugin.workdir
+    except Exception:
+        workdir = None
+    return ApiDiscovery(
+        api_client,
+        cache_dir=os.path.join(workdir, API_DISCOVERY_CACHE_DIR)
+        if workdir else None,
+        ttl=api_discovery.get('cache_ttl', DISCOVERY_CACHE_TTL),
+        logger=ctx.logger)
+
+
+def _is_authentication_failure(exception):
+    messages = [text_type(exception)]
+    for cause in getattr(exception, 'causes', None) or []:
+        if isinstance(cause, dict):
+            messages.append(text_type(cause.get('message')))
+    return any(failure in message for message in messages
+               for failure in AUTHENTICATION_FAILURES)
+
+
+class _StagedInstance(object):
+    """ A node instance whose runtime properties are a private copy, so
+    that a document can be applied in a worker thread.
+    """
+
+    def __init__(self, instance):
+        self._instance = instance
+        self.runtime_properties = DirtyTrackingDict(
+            deepcopy(dict(instance.runtime_properties)))
+
+    def __getattr__(self, name):
+        return getattr(self._instance, name)
+
+    def update(self, *_, **__):
+        # merged into the real instance by _merge_runtime_properties
+        pass
+
+
+class _StagedContext(object):
+
+    def __init__(self, _ctx):
+        self._ctx = _ctx
+        self.instance = _StagedInstance(_ctx.instance)
+
+    def __getattr__(self, name):
+        return getattr(self._ctx, name)
+
+
+def _merge_runtime_properties(live, base, staged):
+    """ Apply the changes that a document made to its staged copy of the
+    runtime properties, staged, compared to the copy it started from,
+    base, to the real runtime properties, live.
+    """
+    for key in sorted(set(base) | set(staged)):
+        if key not in staged:
+            live.pop(key, None)
+            continue
+        new = staged[key]
+        old = base.get(key)
+        if key in base and new == old:
+            continue
+        current = live.get(key)
+        if key not in base and isinstance(new, (dict, list)):
+            # added by several documents, for example the first results
+            old = type(new)()
+        if isinstance(new, dict) and isinstance(old, dict) \
+                and isinstance(current, dict):
+            # for example the results stored by resource path
+            for sub_key in sorted(set(old) | set(new)):
+                if sub_key not in new:
+                    current.pop(sub_key, None)
+                elif sub_key not in old or old[sub_key] != new[sub_key]:
+                    current[sub_key] = new[sub_key]
+        elif isinstance(new, list) and isinstance(old, list) \
+                and isinstance(current, list):
+            # for example a list that every document appends to
+            live[key] = [item for item in current
+                         if item not in old or item in new]
+            live[key].extend(item for item in new if item not in old)
+        else:
+            live[key] = new
+    live.dirty = True
+
+
+def _apply_definition(task, definition, kwargs,
+                      cleanup_runtime_properties=False,
+                      resource_state_function=None):
+    # check current state
+    path = retrieve_path(kwargs)
+    resource_id = definition.metadata.get('name')
+    if resource_state_function and resource_id:
+        current_state = resource_state_function(**kwargs)
+    elif path:
+        current_state = ctx.instance.runtime_properties.get(
+            INSTANCE_RUNTIME_PROPERTY_KUBERNETES, {}).get(path)
+    else:
+        current_state = ctx.instance.runtime_properties.get(
+            INSTANCE_RUNTIME_PROPERTY_KUBERNETES)
+
+    handle_existing_resource(current_state, definition)
+    # ignore pre-existing state
+    result = task(**kwargs)
+    del ctx.instance.runtime_properties['__perform_task']
+    # cleanup after successful run
+    if current_state and cleanup_runtime_properties:
+        if path and path in ctx.instance.runtime_properties.get(
+                INSTANCE_RUNTIME_PROPERTY_KUBERNETES, {}):
+            del ctx.instance.runtime_properties[
+                INSTANCE_RUNTIME_PROPERTY_KUBERNETES][path]
+        else:
+            ctx.instance.runtime_properties[
+                INSTANCE_RUNTIME_PROPERTY_KUBERNETES] = {}
+        # remove empty kubernetes property
+        if not ctx.instance.runtime_properties[
+            INSTANCE_RUNTIME_PROPERTY_KUBERNETES
+        ]:
+            del ctx.instance.runtime_properties[
+                INSTANCE_RUNTIME_PROPERTY_KUBERNETES]
+        # force save
+        ctx.instance.runtime_properties.dirty = True
+        update_instance()
+    return result
+
+
+def _apply_definitions_in_parallel(task, documents, concurrency, **kwargs):
+    """ Apply the documents of a file at the same time, each one in a
+    staged context, then merge their runtime properties in the order of
+    the documents.
+
+    :param documents: A list of (definition, kwargs) tuples.
+    :param concurrency: The maximum number of documents applied at once.
+    :return: The results, in the order of the documents.
+    """
+    _ctx = current_ctx.get_ctx()
+    # the documents add to the keyed layout, move an old layout to it once
+    get_resource_definitions()
+    base = deepcopy(dict(_ctx.instance.runtime_properties))
+
+    def apply_document(document):
+        definition, document_kwargs = document
+        staged_ctx = _StagedContext(_ctx)
+        current_ctx.set(staged_ctx)
+        try:
+            return staged_ctx, _apply_definition(
+                task, definition, document_kwargs, **kwargs), None
+        except Exception as e:
+            return staged_ctx, None, e
+        finally:
+            current_ctx.clear()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(apply_document, documents))
+
+    results = []
+    errors = []
+    added = []
+    for (definition, document_kwargs), (staged_ctx, result, error) in \
+            zip(documents, outcomes):
+        staged = staged_ctx.instance.runtime_properties
+        _merge_runtime_properties(_ctx.instance.runtime_properties,
+                                  base,
+                                  staged)
+        added.extend(sorted(
+            set(staged.get(DEFS) or {}) - set(base.get(DEFS) or {})))
+        if error:
+            ctx.logger.error(
+                'Failed to apply {kind} {name} ({path}): {error}'.format(
+                    kind=definition.kind,
+                    name=definition.metadata.get('name'),
+                    path=retrieve_path(document_kwargs),
+                    error=text_type(error)))
+            errors.append(error)
+        else:
+            results.append(result)
+    if added:
+        order_added_resource_definitions(_ctx.instance.runtime_properties,
+                                         base.get(DEFS_ORDER, 0),
+                                         added)
+    update_instance()
+    if errors:
+        # like the sequential mode, fail with the error of the first
+        # document that failed
+        raise errors[0]
+    return results
+
+
 def _multidefinition_resource_task(task, definitions, kwargs,
                                    retrieve_mapping,
                                    cleanup_runtime_properties=False,
-                                   resource_state_function=None):
-    curr_num = 0
+                                   resource_state_function=None,
+                                   dependency_order=None,
+                                   bulk_task=None,
+                                   cascade_task=None):
+    # definitions can be a generator, look ahead to the second one
+    definitions = iter(definitions)
+    lookahead = list(islice(definitions, 2))
     # we have several definitions (not one!)
-    multicalls = len(definitions) > 1
+    multicalls = len(lookahead) > 1
+    definitions = chain(lookahead, definitions)
     # we can have several resources in one file, save origin
     origin_path = None
     if NODE_PROPERTY_FILE in kwargs and multicalls:
@@ -106,9 +328,55 @@ def _multidefinition_resource_task(task, definitions, kwargs,
         # save origin path
         origin_path = kwargs[
             NODE_PROPERTY_FILE].get(NODE_PROPERTY_FILE_RESOURCE_PATH)
+    concurrency = get_node(ctx).properties.get(
+        NODE_PROPERTY_RESOURCES_CONCURRENCY, 1)
+    parallel = multicalls and concurrency > 1 and \
+        ctx.type == NODE_INSTANCE
+    documents = _prepare_documents(
+        definitions, kwargs, retrieve_mapping, origin_path)
+    if dependency_order and multicalls:
+        # create what the other documents use first, delete it last
+        documents = list(documents)
+        waves = [[documents[index] for index in wave]
+                 for wave in plan_waves([d for d, _ in documents],
+                                        dependency_order)]
+    else:
+        waves = [documents]
+    if cascade_task and ctx.type == NODE_INSTANCE:
+        # the documents that the cascade task deleted are not applied
+        waves = cascade_task([list(wave) for wave in waves])
+    if bulk_task and ctx.type == NODE_INSTANCE and bulk_operations_enabled():
+        def apply_document(definition, document_kwargs):
+            return _apply_definition(
+                task, definition, document_kwargs,
+                cleanup_runtime_properties=cleanup_runtime_properties,
+                resource_state_function=resource_state_function)
+        # the bulk task handles the documents it can not select by label
+        # with apply_document
+        return bulk_task([list(wave) for wave in waves], apply_document)
     # iterate by definitions list
     results = []
-    for definition in definitions:
+    for wave in waves:
+        if parallel:
+            results.extend(_apply_definitions_in_parallel(
+                task, list(wave), concurrency,
+                cleanup_runtime_properties=cleanup_runtime_properties,
+                resource_state_function=resource_state_function))
+            continue
+        for definition, document_kwargs in wave:
+            results.append(_apply_definition(
+                task, definition, document_kwargs,
+                cleanup_runtime_properties=cleanup_runtime_properties,
+                resource_state_function=resource_state_function))
+    return results
+
+
+def _prepare_documents(definitions, kwargs, retrieve_mapping, origin_path):
+    """ Yield the definitions with the kwargs of their task, every
+    document keeps its own mapping and resource path.
+    """
+    for curr_num, definition in enumerate(definitions):
+        kwargs = dict(kwargs)
         kwargs['resource_definition'] = definition
         if retrieve_mapping:
             kwargs['node_options'] = \
@@ -117,72 +385,44 @@ def _multidefinition_resource_task(task, definitions, kwargs,
             kwargs.pop('node_options')
         # we can have several resources in one file
         if origin_path:
+            kwargs[NODE_PROPERTY_FILE] = dict(kwargs[NODE_PROPERTY_FILE])
             kwargs[NODE_PROPERTY_FILE][NODE_PROPERTY_FILE_RESOURCE_PATH] = (
                 "{name}#{curr_num}".format(
                     name=origin_path,
                     curr_num=text_type(curr_num)
                 ))
-            curr_num += 1
-
-        # check current state
-        path = retrieve_path(kwargs)
-        resource_id = definition.metadata.get('name')
-        if resource_state_function and resource_id:
-            current_state = resource_state_function(**kwargs)
-        elif path:
-            current_state = ctx.instance.runtime_properties.get(
-                INSTANCE_RUNTIME_PROPERTY_KUBERNETES, {}).get(path)
-        else:
-            current_state = ctx.instance.runtime_properties.get(
-                INSTANCE_RUNTIME_PROPERTY_KUBERNETES)
-
-        handle_existing_resource(current_state, definition)
-        # ignore pre-existing state
-        result = task(**kwargs)
-        results.append(result)
-        del ctx.instance.runtime_properties['__perform_task']
-        # cleanup after successful run
-        if current_state and cleanup_runtime_properties:
-            if path and path in ctx.instance.runtime_properties.get(
-                    INSTANCE_RUNTIME_PROPERTY_KUBERNETES, {}):
-                del ctx.instance.runtime_properties[
-                    INSTANCE_RUNTIME_PROPERTY_KUBERNETES][path]
-            else:
-                ctx.instance.runtime_properties[
-                    INSTANCE_RUNTIME_PROPERTY_KUBERNETES] = {}
-            # remove empty kubernetes property
-            if not ctx.instance.runtime_properties[
-                INSTANCE_RUNTIME_PROPERTY_KUBERNETES
-            ]:
-                del ctx.instance.runtime_properties[
-                    INSTANCE_RUNTIME_PROPERTY_KUBERNETES]
-            # force save
-            ctx.instance.runtime_properties.dirty = True
-            ctx.instance.update()
-    return results
+        yield definition, kwargs
 
 
 def resource_task(retrieve_resource_definition=None,
                   retrieve_resources_definitions=None,
                   retrieve_mapping=None,
                   cleanup_runtime_properties=False,
-                  resource_state_function=None):
+                  resource_state_function=None,
+                  dependency_order=None,
+                  bulk_task=None,
+                  cascade_task=None):
     def decorator(task, **_):
         def wrapper(**kwargs):
             try:
-                definitions = []
-                # use single definition source
-                if retrieve_resource_definition:
-                    definitions = [retrieve_resource_definition(**kwargs)]
-                # use multi definition source
-                elif retrieve_resources_definitions:
-                    definitions = retrieve_resources_definitions(**kwargs)
-                # apply definition
-                return _multidefinition_resource_task(
-                    task, definitions, kwargs, retrieve_mapping,
-                    cleanup_runtime_properties=cleanup_runtime_properties,
-                    resource_state_function=resource_state_function
-                )
+                # send the runtime properties once, not after every step
+                with coalesced_updates():
+                    definitions = []
+                    # use single definition source
+                    if retrieve_resource_definition:
+                        definitions = [retrieve_resource_definition(**kwargs)]
+                    # use multi definition source
+                    elif retrieve_resources_definitions:
+                        definitions = retrieve_resources_definitions(**kwargs)
+                    # apply definition
+                    return _multidefinition_resource_task(
+                        task, definitions, kwargs, retrieve_mapping,
+                        cleanup_runtime_properties=cleanup_runtime_properties,
+                        resource_state_function=resource_state_function,
+                        dependency_order=dependency_order,
+                        bulk_task=bulk_task,
+                        cascade_task=cascade_task
+                    )
             except (KuberentesMappingNotFoundError,
                     KuberentesInvalidPayloadClassError,
                     KuberentesInvalidApiClassError,
@@ -282,20 +522,35 @@ def with_kubernetes_client(fn):
         if kubeconfig:
             config_kwargs.update({'kubeconfig': kubeconfig})
 
+        api_client_key = None
         try:
-
-            api_client = setup_configuration(**config_kwargs)
+            # Reuse the connection pool of earlier operations against the
+            # same cluster with the same credentials.
+            api_client, api_client_key = get_api_client(
+                setup_configuration, **config_kwargs)
             kwargs['client'] = CloudifyKubernetesClient(
-                ctx.logger, api_client=api_client)
+                ctx.logger, api_client=api_client,
+                raw_json=client_config.get('raw_json', False),
+                discovery=_api_discovery(api_client, client_config))
 
             result = fn(**kwargs)
-        except (RecoverableError, NonRecoverableError):
+        except (RecoverableError, NonRecoverableError) as e:
+            if _is_authentication_failure(e):
+                invalidate_api_client(api_client_key)
             raise
-        except BaseException:
+        except BaseException as e:
+            if _is_authentication_failure(e):
+                invalidate_api_client(api_client_key)
             raise RecoverableError(
                 'Error encountered',
                 causes=[generate_traceback_exception()]
             )
+        finally:
+            reads_avoided = getattr(kwargs.get('client'), 'reads_avoided', 0)
+            if reads_avoided:
+                ctx.logger.debug(
+                    'Reused earlier reads instead of {0} API calls.'.format(
+                        reads_avoided))
         return result
 
     return operation(func=wrapper, resumable=True)
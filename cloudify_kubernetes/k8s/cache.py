@@ -0,0 +1,131 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+
+from .._compat import text_type
+
+API_CLIENT_CACHE_SIZE = 16
+API_CLIENT_CACHE_TTL = 300
+CREDENTIAL_KEYS = ['host', 'token', 'api_key', 'ca_file', 'kubeconfig']
+
+
+class LRUCache(object):
+    """A bounded, thread safe LRU cache whose entries expire after a TTL.
+    """
+
+    def __init__(self, max_size, ttl, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return
+            del self._entries[key]
+            if expires < self._clock():
+                return
+            # Reinsert to mark the entry as the most recently used one.
+            self._entries[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Keep a value for the TTL of the cache, or for its own TTL.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, self._clock() + ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_API_CLIENTS = LRUCache(API_CLIENT_CACHE_SIZE, API_CLIENT_CACHE_TTL)
+
+
+def _credential_fingerprint(value):
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True, default=text_type)
+    if isinstance(value, text_type):
+        if os.path.isfile(value):
+            # Certificates and kubeconfigs are usually written to a new
+            # temporary file by every operation, so hash the content.
+            with open(value, 'rb') as infile:
+                return hashlib.sha256(infile.read()).hexdigest()
+        return value
+    raise TypeError('Unsupported credential: {0}'.format(type(value)))
+
+
+def api_client_key(**config_kwargs):
+    """ Create a cache key from the arguments of setup_configuration.
+
+    :return: A hex digest, or None if the credentials can not be hashed.
+    """
+    digest = hashlib.sha256()
+    for key in CREDENTIAL_KEYS:
+        value = config_kwargs.get(key)
+        if value is None:
+            continue
+        try:
+            fingerprint = _credential_fingerprint(value)
+        except (TypeError, IOError, OSError):
+            return
+        digest.update(key.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(fingerprint.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get_api_client(factory, **config_kwargs):
+    """ Return a warm ApiClient for these credentials, or create one with
+    factory(**config_kwargs) and keep it for the next operations.
+
+    :return: A tuple of the ApiClient and its cache key.
+    """
+    key = api_client_key(**config_kwargs)
+    if key is None:
+        return factory(**config_kwargs), None
+    api_client = _API_CLIENTS.get(key)
+    if api_client is None:
+        api_client = factory(**config_kwargs)
+        _API_CLIENTS.set(key, api_client)
+    return api_client, key
+
+
+def invalidate_api_client(key):
+    if key:
+        _API_CLIENTS.invalidate(key)
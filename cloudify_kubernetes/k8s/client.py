@@ -13,14 +13,25 @@
 # limitations under the License.
 
 import kubernetes
+from threading import Lock
 
 from cloudify.exceptions import NonRecoverableError
 
 from .._compat import text_type, getfullargspec
+from .mapping import (get_watch_method_name,
+                      get_api_and_method_for,
+                      get_preferred_alternate,
+                      set_preferred_alternate,
+                      KubernetesSingleOperationApiMapping)
+from .raw import RawApiMethod, payload_from_definition
 from .operations import (KubernetesReadOperation,
+                         KubernetesListOperation,
+                         KubernetesApplyOperation,
+                         KubernetesWatchOperation,
                          KubernetesDeleteOperation,
                          KubernetesUpdateOperation,
-                         KubernetesCreateOperation)
+                         KubernetesCreateOperation,
+                         KubernetesDeleteCollectionOperation)
 from .exceptions import (KuberentesApiOperationError,
                          KuberentesInvalidApiClassError,
                          KuberentesInvalidApiMethodError,
@@ -28,6 +39,10 @@ from .exceptions import (KuberentesApiOperationError,
                          KuberentesInvalidDefinitionError
                          )
 
+API_VERSION_MISMATCH = 'does not match the expected API version'
+CUSTOM_OBJECTS_API = 'CustomObjectsApi'
+# The errors of a status read after which the resource is read instead.
+STATUS_FALLBACK_CODES = ['(403)', '(404)']
 API_VERSION_DEFINITION = "apiVersion"
 METADATA_DEFINITION = "metadata"
 KIND_DEFINITION = "kind"
@@ -120,17 +135,57 @@ class KubernetesResourceDefinition(object):
             in self.__dict__.items() if key != 'underscore_to_camelcase')
 
 
+class ContentTypeApiClient(kubernetes.client.ApiClient):
+    """ An ApiClient that shares the configuration and the connection pool
+    of another one, and sends every request with one Content-Type.
+    """
+
+    def __init__(self, api_client, content_type):
+        # ApiClient.__init__ would open another connection pool.
+        self.__dict__.update(api_client.__dict__)
+        self._pool = None
+        self.content_type = content_type
+
+    def select_header_content_type(self, *_, **__):
+        return self.content_type
+
+    def close(self):
+        # the connection pool belongs to the other client
+        pass
+
+
 class CloudifyKubernetesClient(object):
 
     def __init__(self,
                  logger,
                  api_configuration=None,
                  api_authentication=None,
-                 api_client=None):
+                 api_client=None,
+                 raw_json=False,
+                 discovery=None):
 
         self.logger = logger
         self.client = api_client
         self.api = kubernetes.client
+        # Send and receive plain dicts instead of kubernetes.client models.
+        self.raw_json = raw_json
+        # The ApiDiscovery of the cluster, to resolve the endpoint of a
+        # resource definition before the first request.
+        self.discovery = discovery
+        # (api class, method, content type) ->
+        #     (bound method, mandatory arguments names)
+        self._api_methods = {}
+        # content type -> ContentTypeApiClient
+        self._content_type_clients = {}
+        # delete options class -> {option: is attribute of the class}
+        self._delete_options_attributes = {}
+        # (api version, kind, namespace, name) -> (last read result, error)
+        self._reads = {}
+        self._reads_lock = Lock()
+        # The number of reads that were answered from self._reads.
+        self.reads_avoided = 0
+        # The read_status methods that failed with STATUS_FALLBACK_CODES.
+        self._status_unavailable = set()
 
         if not self.client:
             self.logger.debug(
@@ -167,6 +222,8 @@ class CloudifyKubernetesClient(object):
     def _prepare_payload(self, class_name, resource_definition):
         if class_name is None:
             return resource_definition.to_dict()
+        if self.raw_json:
+            return payload_from_definition(class_name, resource_definition)
         if not hasattr(self.api, class_name):
             raise KuberentesInvalidPayloadClassError(
                 'Cannot create instance of Kubernetes API payload class: {0}. '
@@ -175,16 +232,40 @@ class CloudifyKubernetesClient(object):
         self.logger.debug('Kubernetes API initialized successfully')
         return getattr(self.api, class_name)(**vars(resource_definition))
 
-    def _prepare_api_method(self, class_name, method_name):
+    def _prepare_api_method(self, class_name, method_name,
+                            content_type=None):
+        key = (class_name, method_name, content_type)
+        try:
+            return self._api_methods[key]
+        except KeyError:
+            api_method = self._api_methods[key] = self._create_api_method(
+                class_name, method_name, content_type)
+            return api_method
+
+    def _get_api_client(self, content_type=None):
+        if not content_type:
+            return self.client
+        try:
+            return self._content_type_clients[content_type]
+        except KeyError:
+            api_client = self._content_type_clients[content_type] = \
+                ContentTypeApiClient(self.client, content_type)
+            return api_client
+
+    def _create_api_method(self, class_name, method_name, content_type=None):
         if hasattr(self.api, class_name):
-            api = getattr(self.api, class_name)(api_client=self.client)
+            api = getattr(self.api, class_name)(
+                api_client=self._get_api_client(content_type))
 
             if hasattr(api, method_name):
                 method = getattr(api, method_name)
-                return method, [
+                arguments_names = [
                     arg for arg in getfullargspec(method).args
                     if not arg == 'self'
                 ]
+                if self.raw_json:
+                    method = RawApiMethod(method)
+                return method, arguments_names
 
             raise KuberentesInvalidApiMethodError(
                 'Method {0} not supported by Kubernetes API class {1}'
@@ -197,7 +278,7 @@ class CloudifyKubernetesClient(object):
 
     def _prepare_operation(self, operation, api, method, **_):
         api_method, api_method_arguments_names = self._prepare_api_method(
-            api, method
+            api, method, getattr(operation, 'CONTENT_TYPE', None)
         )
         self.logger.debug('Preparing operation with api method: {0} '
                           '(mandatory arguments: {1})'
@@ -210,9 +291,14 @@ class CloudifyKubernetesClient(object):
         if resource_definition.kind != 'ReplicationController':
             if options:
                 if hasattr(self.api, class_name):
+                    attributes = self._delete_options_attributes.setdefault(
+                        class_name, {})
+                    for k in options:
+                        if k not in attributes:
+                            attributes[k] = hasattr(
+                                getattr(self.api, class_name), k)
                     node_options = \
-                        {k: v for k, v in options.items()
-                         if hasattr(getattr(self.api, class_name), k)}
+                        {k: v for k, v in options.items() if attributes[k]}
 
                     return getattr(self.api, class_name)(**node_options)
 
@@ -255,58 +341,276 @@ class CloudifyKubernetesClient(object):
                 options['namespace'] = namespace_from_def
         self.logger.debug('Options API Request {0}'.format(options))
 
-    def execute_with_alternates(self,
-                                operation, mapping, options, mapping_key):
+    @property
+    def _host(self):
+        configuration = getattr(self.client, 'configuration', None)
+        return getattr(configuration, 'host', None)
+
+    def _discover(self, resource_definition):
+        if not self.discovery:
+            return
+        return self.discovery.resolve(
+            resource_definition.api_version, resource_definition.kind)
+
+    def _resolve_api_and_method(self, api_and_method, resource_definition):
+        """ Get the API class and method that serve a resource definition
+        on this cluster: the class of its apiVersion, or of the apiVersion
+        that the cluster serves its kind with, and the cluster scoped
+        methods for cluster scoped custom resources.
+
+        :return: A KubernetesSingleOperationApiMapping, which is
+            api_and_method if there is nothing else to try first.
+        """
+        if resource_definition is None:
+            return api_and_method
+        if getattr(api_and_method, 'api', None) == CUSTOM_OBJECTS_API:
+            resource = self._discover(resource_definition)
+            method = api_and_method.method.replace(
+                '_namespaced_', '_cluster_')
+            if resource and not resource['namespaced'] and \
+                    hasattr(self.api.CustomObjectsApi, method):
+                return KubernetesSingleOperationApiMapping(
+                    api=api_and_method.api,
+                    method=method,
+                    payload=api_and_method.payload)
+            return api_and_method
+        api_versions = [resource_definition.api_version]
+        if self.discovery:
+            served = self.discovery.api_versions(resource_definition.kind)
+            if served and resource_definition.api_version not in served:
+                api_versions = served
+        for api_version in api_versions:
+            resolved = get_api_and_method_for(api_and_method, api_version)
+            if resolved:
+                return resolved
+        return api_and_method
+
+    def _set_custom_object_options(self, api_and_method,
+                                   resource_definition, options):
+        """ Set the group, version and plural of a custom resource that
+        has no cloudify-crd-* annotations from the API discovery.
+        """
+        if resource_definition is None or \
+                getattr(api_and_method, 'api', None) != CUSTOM_OBJECTS_API:
+            return
+        resource = self._discover(resource_definition)
+        if not resource:
+            return
+        # the cluster scoped methods do not take the namespace, it is left
+        # out of their arguments
+        for key in ['group', 'version', 'plural']:
+            if not options.get(key):
+                options[key] = resource[key]
+
+    def execute_with_alternates(self, operation, mapping, options,
+                                mapping_key, resource_definition=None):
         api_and_method = getattr(mapping, mapping_key)
+        self._set_custom_object_options(
+            api_and_method, resource_definition, options)
+        resolved = self._resolve_api_and_method(
+            api_and_method, resource_definition)
+        if resolved is not api_and_method:
+            try:
+                return self._execute(self._prepare_operation(
+                    operation, **vars(resolved)), options)
+            except KuberentesApiOperationError as e:
+                if API_VERSION_MISMATCH not in str(e):
+                    raise
+                self.logger.error(
+                    'The API and Method {} {} of {} failed: {}'.format(
+                        resolved.api, resolved.method,
+                        resource_definition.api_version, str(e)))
+        preferred = get_preferred_alternate(self._host, api_and_method)
+        if preferred:
+            try:
+                return self._execute(self._prepare_operation(
+                    operation, **vars(preferred)), options)
+            except KuberentesApiOperationError as e:
+                if API_VERSION_MISMATCH not in str(e):
+                    raise
+                self.logger.error(
+                    'The preferred alternate mapping API and Method '
+                    '{} {} failed: {}'.format(
+                        preferred.api, preferred.method, str(e)))
+                set_preferred_alternate(self._host, api_and_method, None)
         try:
             return self._execute(self._prepare_operation(
                 operation, **vars(api_and_method)), options)
         except KuberentesApiOperationError as e:
             str_e = str(e)
-            if 'does not match the expected API version' in str_e:
+            if API_VERSION_MISMATCH in str_e:
                 self.logger.error(
                     'The mapping API and Method {} failed: {}'.format(
                         api_and_method, str_e))
                 for alternate in api_and_method.alternates:
                     try:
-                        return self._execute(self._prepare_operation(
+                        result = self._execute(self._prepare_operation(
                             operation, **vars(alternate)), options)
                     except KuberentesApiOperationError as e2:
                         str_e2 = str(e2)
-                        if 'does not match the expected API version' not in \
-                                str_e2:
+                        if API_VERSION_MISMATCH not in str_e2:
                             raise e2
                         self.logger.error(
                             'The alternate mapping API and Method '
                             '{} {} failed: {}'.format(
                                 alternate.api, alternate.payload, str(e2)))
                         continue
+                    set_preferred_alternate(
+                        self._host, api_and_method, alternate)
+                    return result
             raise e
 
+    @staticmethod
+    def _read_key(resource_definition, options, name=None):
+        return (resource_definition.api_version,
+                resource_definition.kind,
+                options.get('namespace'),
+                name or resource_definition.metadata.get('name'))
+
+    def _forget_read(self, resource_definition, options, name=None):
+        with self._reads_lock:
+            self._reads.pop(
+                self._read_key(resource_definition, options, name), None)
+
     def create_resource(self, mapping, resource_definition, options):
         options['body'] = self._prepare_payload(
-            mapping.create.payload, resource_definition
+            self._resolve_api_and_method(
+                mapping.create, resource_definition).payload,
+            resource_definition
         )
         self.match_namespace(resource_definition, options)
         self.logger.debug('Options API Request {0}'.format(options))
-        return self.execute_with_alternates(
-            KubernetesCreateOperation, mapping, options, 'create')
+        try:
+            return self.execute_with_alternates(
+                KubernetesCreateOperation, mapping, options, 'create',
+                resource_definition)
+        finally:
+            self._forget_read(resource_definition, options)
 
     def read_resource(self, mapping, resource_definition, options):
+        """ Read a resource. The result, or the resource not being found, is
+        reused by the next reads of the same resource, until it is written.
+        """
         options['name'] = resource_definition.metadata['name']
         self.match_namespace(resource_definition, options)
 
-        return self.execute_with_alternates(
-            KubernetesReadOperation, mapping, options, 'read')
+        key = self._read_key(resource_definition, options)
+        with self._reads_lock:
+            last_read = self._reads.get(key)
+            if last_read:
+                self.reads_avoided += 1
+        if last_read:
+            result, error = last_read
+            self.logger.debug('Reusing the last read of {0} {1}.'.format(
+                resource_definition.kind, options['name']))
+            if error:
+                raise error
+            return result
+        try:
+            result = self.execute_with_alternates(
+                KubernetesReadOperation, mapping, options, 'read',
+                resource_definition)
+        except KuberentesApiOperationError as e:
+            if '(404)' in text_type(e):
+                with self._reads_lock:
+                    self._reads[key] = (None, e)
+            raise
+        with self._reads_lock:
+            self._reads[key] = (result, None)
+        return result
+
+    def read_resource_status(self, mapping, resource_definition, options):
+        """ Read the status subresource of a resource, or the resource
+        when there is no status subresource, or it can not be read, for
+        example when RBAC allows get on deployments but not on
+        deployments/status.
+        """
+        read_status = getattr(mapping, 'read_status', None)
+        if not read_status or \
+                read_status.method in self._status_unavailable:
+            return self.read_resource(mapping, resource_definition, options)
+        options['name'] = resource_definition.metadata['name']
+        self.match_namespace(resource_definition, options)
+
+        try:
+            return self.execute_with_alternates(
+                KubernetesReadOperation, mapping, options, 'read_status',
+                resource_definition)
+        except KuberentesApiOperationError as e:
+            if not any(code in text_type(e) for code in STATUS_FALLBACK_CODES):
+                raise
+            self.logger.debug(
+                'Unable to read the status of {0} {1}, reading the '
+                'resource: {2}'.format(
+                    resource_definition.kind, options['name'], e))
+        self._status_unavailable.add(read_status.method)
+        return self.read_resource(mapping, resource_definition, options)
+
+    def watch_resource(self, mapping, resource_definition, options,
+                       timeout_seconds):
+        """ Watch the changes of a resource, with the list method of the read
+        API, until the server closes the watch.
+
+        :param timeout_seconds: The time budget of the watch.
+        :return: A generator of the event dicts, with type and object keys.
+        """
+        api_and_method = self._resolve_api_and_method(
+            mapping.read, resource_definition)
+        if api_and_method is mapping.read:
+            api_and_method = get_preferred_alternate(
+                self._host, mapping.read) or mapping.read
+        options['field_selector'] = 'metadata.name={0}'.format(
+            resource_definition.metadata['name'])
+        options['timeout_seconds'] = int(timeout_seconds)
+        # the server closes the watch, this is in case it does not
+        options['_request_timeout'] = int(timeout_seconds) + 5
+        self.match_namespace(resource_definition, options)
+        self._set_custom_object_options(
+            mapping.read, resource_definition, options)
+        operation = self._prepare_operation(
+            KubernetesWatchOperation,
+            api=api_and_method.api,
+            method=get_watch_method_name(api_and_method.method))
+        return operation.execute(
+            {k: v for k, v in options.items() if v})
 
     def update_resource(self, mapping, resource_definition, options):
         options['body'] = self._prepare_payload(
-            mapping.create.payload, resource_definition
+            self._resolve_api_and_method(
+                mapping.create, resource_definition).payload,
+            resource_definition
         )
         options['name'] = resource_definition.metadata['name']
         self.match_namespace(resource_definition, options)
-        return self.execute_with_alternates(
-            KubernetesUpdateOperation, mapping, options, 'update')
+        try:
+            return self.execute_with_alternates(
+                KubernetesUpdateOperation, mapping, options, 'update',
+                resource_definition)
+        finally:
+            self._forget_read(resource_definition, options)
+
+    def apply_resource(self, mapping, resource_definition, options,
+                       field_manager, force=False):
+        """ Create or update a resource with a server-side apply request.
+
+        :param field_manager: The name that owns the fields of the request.
+        :param force: Take the fields over from other field managers.
+        """
+        if not getattr(mapping, 'apply', None):
+            raise KuberentesInvalidApiMethodError(
+                'Server-side apply is not supported for {0}'.format(
+                    resource_definition.kind))
+        options['body'] = resource_definition.to_dict()
+        options['name'] = resource_definition.metadata['name']
+        options['field_manager'] = field_manager
+        options['force'] = force
+        self.match_namespace(resource_definition, options)
+        try:
+            return self.execute_with_alternates(
+                KubernetesApplyOperation, mapping, options, 'apply',
+                resource_definition)
+        finally:
+            self._forget_read(resource_definition, options)
 
     def delete_resource(self, mapping, resource_definition,
                         resource_id, options):
@@ -336,6 +640,51 @@ class CloudifyKubernetesClient(object):
             options = {k: v for k, v in options.items()
                        if k not in delete_resource.keys()}
 
+        self.match_namespace(resource_definition, options)
+        try:
+            return self.execute_with_alternates(
+                KubernetesDeleteOperation, mapping, options, 'delete',
+                resource_definition)
+        finally:
+            self._forget_read(resource_definition, options, resource_id)
+
+    def list_resources(self, mapping, resource_definition, options,
+                       label_selector):
+        """ List the resources of the kind and namespace of a definition
+        that have some labels, with one request.
+
+        :param label_selector: For example app=nginx,tier=backend.
+        :return: The list response, the resources are in its items.
+        """
+        if not getattr(mapping, 'list', None):
+            raise KuberentesInvalidApiMethodError(
+                'Listing is not supported for {0}'.format(
+                    resource_definition.kind))
+        options['label_selector'] = label_selector
         self.match_namespace(resource_definition, options)
         return self.execute_with_alternates(
-            KubernetesDeleteOperation, mapping, options, 'delete')
+            KubernetesListOperation, mapping, options, 'list',
+            resource_definition)
+
+    def delete_resources(self, mapping, resource_definition, options,
+                         label_selector):
+        """ Delete the resources of the kind and namespace of a definition
+        that have some labels, with one deletecollection request.
+
+        :param label_selector: For example app=nginx,tier=backend.
+        """
+        if not getattr(mapping, 'delete_collection', None):
+            raise KuberentesInvalidApiMethodError(
+                'Deleting collections is not supported for {0}'.format(
+                    resource_definition.kind))
+        options['label_selector'] = label_selector
+        options.setdefault('propagation_policy', 'Foreground')
+        self.match_namespace(resource_definition, options)
+        try:
+            return self.execute_with_alternates(
+                KubernetesDeleteCollectionOperation,
+                mapping, options, 'delete_collection', resource_definition)
+        finally:
+            # any of the reads can be of a deleted resource
+            with self._reads_lock:
+                self._reads.clear()
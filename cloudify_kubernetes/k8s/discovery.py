@@ -0,0 +1,286 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import hashlib
+from threading import Lock
+from tempfile import NamedTemporaryFile
+
+from .._compat import text_type
+from .cache import LRUCache
+
+DISCOVERY_CACHE_SIZE = 16
+DISCOVERY_CACHE_TTL = 600
+# Aggregated discovery returns every group, version and resource with one
+# request per root. Servers without it answer with the legacy lists.
+AGGREGATED_DISCOVERY_ACCEPT = ','.join([
+    'application/json;g=apidiscovery.k8s.io;v=v2;as=APIGroupDiscoveryList',
+    'application/json;g=apidiscovery.k8s.io;v=v2beta1;'
+    'as=APIGroupDiscoveryList',
+    'application/json'])
+AGGREGATED_DISCOVERY_KIND = 'APIGroupDiscoveryList'
+
+# cluster host -> discovered resources, shared by the operations of a worker,
+# every entry expires after the cache_ttl of the discovery that stored it
+_DISCOVERIES = LRUCache(DISCOVERY_CACHE_SIZE, DISCOVERY_CACHE_TTL)
+
+
+def split_api_version(api_version):
+    """ Split an apiVersion into its group and version.
+
+    :param api_version: For example apps/v1, or v1 for the core group.
+    :return: A tuple of the group and the version.
+    """
+    if '/' in api_version:
+        return tuple(api_version.split('/', 1))
+    return '', api_version
+
+
+def _resource(kind, plural, namespaced):
+    return {'kind': kind, 'plural': plural, 'namespaced': bool(namespaced)}
+
+
+def _parse_aggregated(discovery_list):
+    """ Index an APIGroupDiscoveryList.
+
+    :return: A dict of apiVersion -> kind -> resource.
+    """
+    resources = {}
+    for group in discovery_list.get('items') or []:
+        group_name = (group.get('metadata') or {}).get('name') or ''
+        for version in group.get('versions') or []:
+            api_version = '/'.join(
+                [p for p in [group_name, version.get('version')] if p])
+            kinds = resources.setdefault(api_version, {})
+            for resource in version.get('resources') or []:
+                kind = (resource.get('responseKind') or {}).get('kind')
+                if not kind:
+                    continue
+                kinds.setdefault(kind, _resource(
+                    kind,
+                    resource.get('resource'),
+                    resource.get('scope') == 'Namespaced'))
+    return resources
+
+
+def _parse_resource_list(resource_list):
+    """ Index the APIResourceList of a group version.
+
+    :return: A dict of kind -> resource.
+    """
+    kinds = {}
+    for resource in resource_list.get('resources') or []:
+        # subresources, like pods/status, have the kind of their parent
+        if '/' in resource.get('name', '/'):
+            continue
+        kinds.setdefault(resource.get('kind'), _resource(
+            resource.get('kind'),
+            resource.get('name'),
+            resource.get('namespaced')))
+    return kinds
+
+
+class ApiDiscovery(object):
+    """ The resources that a cluster serves, read from the discovery
+    endpoints /api and /apis, and kept in memory and on disk until the TTL
+    expires.
+    """
+
+    def __init__(self,
+                 api_client,
+                 cache_dir=None,
+                 ttl=DISCOVERY_CACHE_TTL,
+                 logger=None,
+                 clock=time.time):
+        self.api_client = api_client
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.logger = logger
+        self._clock = clock
+        self._resources = None
+        # a missing resource refreshes the cache once, it can be a
+        # CustomResourceDefinition that was created after the discovery
+        self._refreshed = False
+        self._failed = False
+        self._lock = Lock()
+
+    @property
+    def host(self):
+        configuration = getattr(self.api_client, 'configuration', None)
+        return getattr(configuration, 'host', None)
+
+    @property
+    def _cache_path(self):
+        if not self.cache_dir or not self.host:
+            return
+        return os.path.join(
+            self.cache_dir,
+            hashlib.sha256(self.host.encode('utf-8')).hexdigest() + '.json')
+
+    def _debug(self, message):
+        if self.logger:
+            self.logger.debug(message)
+
+    def _get(self, path, accept='application/json'):
+        response = self.api_client.call_api(
+            path, 'GET',
+            header_params={'Accept': accept},
+            auth_settings=['BearerToken'],
+            _preload_content=False,
+            _return_http_data_only=True)
+        data = response.data
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def _fetch(self):
+        """ Read every group version that the cluster serves, with the
+        aggregated discovery of /api and /apis, or with a request per group
+        version if the server does not support it.
+        """
+        resources = {}
+        core = self._get('/api', AGGREGATED_DISCOVERY_ACCEPT)
+        groups = self._get('/apis', AGGREGATED_DISCOVERY_ACCEPT)
+        for root, response in [('/api', core), ('/apis', groups)]:
+            if response.get('kind') == AGGREGATED_DISCOVERY_KIND:
+                resources.update(_parse_aggregated(response))
+                continue
+            if root == '/api':
+                api_versions = response.get('versions') or []
+            else:
+                api_versions = [
+                    version.get('groupVersion')
+                    for group in response.get('groups') or []
+                    for version in group.get('versions') or []]
+            for api_version in api_versions:
+                try:
+                    resource_list = self._get(
+                        '{0}/{1}'.format(root, api_version))
+                except Exception as e:
+                    # for example an APIService that is not available,
+                    # the other group versions are still discovered
+                    self._debug('Unable to discover {0}: {1}'.format(
+                        api_version, text_type(e)))
+                    continue
+                resources[api_version] = _parse_resource_list(resource_list)
+        return resources
+
+    def _read_cache(self):
+        path = self._cache_path
+        if not path:
+            return
+        try:
+            with open(path, 'rb') as infile:
+                cached = json.loads(infile.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return
+        if cached.get('host') != self.host or \
+                cached.get('expires', 0) < self._clock():
+            return
+        return cached
+
+    def _write_cache(self, resources):
+        path = self._cache_path
+        if not path:
+            return
+        data = json.dumps({'host': self.host,
+                           'expires': self._clock() + self.ttl,
+                           'resources': resources},
+                          separators=(',', ':'))
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with NamedTemporaryFile(
+                    'wb', dir=self.cache_dir, delete=False) as outfile:
+                outfile.write(data.encode('utf-8'))
+            os.rename(outfile.name, path)
+        except (IOError, OSError) as e:
+            self._debug('Failed to cache the API discovery: {0}'.format(
+                text_type(e)))
+
+    def _load(self, refresh=False):
+        """ Get the discovered resources from memory, from disk, or from the
+        cluster, in this order.
+
+        :return: A dict of apiVersion -> kind -> resource, or None if the
+            discovery failed.
+        """
+        with self._lock:
+            if self._failed or \
+                    self._resources is not None and not refresh:
+                return self._resources
+            resources = None
+            if not refresh:
+                resources = _DISCOVERIES.get(self.host)
+                if resources is not None:
+                    self._resources = resources
+                    return resources
+                cached = self._read_cache()
+                if cached:
+                    resources = cached.get('resources')
+                    ttl = cached['expires'] - self._clock()
+            if resources is None:
+                try:
+                    resources = self._fetch()
+                except Exception as e:
+                    # operations fall back to the mappings of the kinds
+                    self._failed = True
+                    self._debug('The API discovery failed: {0}'.format(
+                        text_type(e)))
+                    return self._resources
+                self._write_cache(resources)
+                ttl = self.ttl
+            if self.host:
+                _DISCOVERIES.set(self.host, resources, ttl)
+            self._resources = resources
+            return resources
+
+    def _find(self, find):
+        resources = self._load()
+        result = find(resources) if resources else None
+        if result is None and resources is not None and \
+                not self._refreshed:
+            self._refreshed = True
+            resources = self._load(refresh=True)
+            result = find(resources) if resources else None
+        return result
+
+    def resolve(self, api_version, kind):
+        """ Get the resource of a kind in an apiVersion, for example a
+        custom resource.
+
+        :return: A dict with the group, version, plural and namespaced keys,
+            or None if the cluster does not serve it.
+        """
+        resource = self._find(
+            lambda resources: (resources.get(api_version) or {}).get(kind))
+        if resource is None:
+            return
+        group, version = split_api_version(api_version)
+        return {'group': group,
+                'version': version,
+                'plural': resource['plural'],
+                'namespaced': resource['namespaced']}
+
+    def api_versions(self, kind):
+        """ Get the apiVersions in which the cluster serves a kind.
+
+        :return: A list, which is empty if the discovery failed.
+        """
+        return self._find(
+            lambda resources: [
+                api_version for api_version, kinds in resources.items()
+                if kind in kinds] or None) or []
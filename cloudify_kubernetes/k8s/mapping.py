@@ -13,20 +13,184 @@
 # limitations under the License.
 
 import inspect
-from re import search
+from re import search, split
+from threading import Lock
 
 from kubernetes import client as kube_api
 
+from .._compat import text_type
 from .exceptions import KuberentesMappingNotFoundError
 
 
+_KUBERNETES_APIS = None
+# Method name -> [(API class name, payload class name), ...].
+_ALTERNATES_INDEX = {}
+# (cluster host, API class name, method name) -> the alternate that worked.
+_PREFERRED_ALTERNATES = {}
+_PREFERRED_ALTERNATES_LOCK = Lock()
+
+
+def _scan_kubernetes_apis():
+    kubernetes_apis = {}
+    for name, obj in inspect.getmembers(kube_api):
+        try:
+            path = inspect.getfile(obj)
+        except TypeError:
+            path = None
+        if path and 'kubernetes/client/api' in path:
+            kubernetes_apis[name] = obj
+    return kubernetes_apis
+
+
+def get_kubernetes_apis():
+    """ Create a dict of all available APIs in the current version of
+    Kubernetes Python library.
+
+    The scan is expensive, so it is done once, on first use, and the result
+    is shared by every mapping in the process.
+
+    :return:
+    """
+    global _KUBERNETES_APIS
+    if _KUBERNETES_APIS is None:
+        _KUBERNETES_APIS = _scan_kubernetes_apis()
+    return _KUBERNETES_APIS
+
+
+def get_method_payload_name(method_obj):
+    """All Kubernetes API methods have a doc string that matches the
+    pattern "param ObjectName body", which is our "payload" object.
+
+    :param str method_obj: The name of the API method, for example
+        create_namespaced_ingress.
+    :return:
+    """
+    body_param_pattern = "param\\s(.*?)\\sbody"
+    docs = inspect.getdoc(method_obj)
+    body_param_result = search(body_param_pattern, docs)
+    return_param_pattern = "\\:return\\:\\s(.*?)\\n"
+    return_param_result = search(return_param_pattern, docs)
+    if not body_param_result and not return_param_result:
+        return
+    elif body_param_result and body_param_result.group(1) != 'object':
+        return body_param_result.group(1)
+    elif return_param_result and 'tuple' not in return_param_result.group(1):
+        return return_param_result.group(1)
+
+
+def get_watch_method_name(read_method):
+    """ Get the list method that can watch the resources of a read method.
+
+    :param str read_method: The name of the read method, for example
+        read_namespaced_pod or get_namespaced_custom_object.
+    :return: The name of the list method, for example list_namespaced_pod.
+    """
+    for prefix in ['read_', 'get_']:
+        if read_method.startswith(prefix):
+            return 'list_{0}'.format(read_method[len(prefix):])
+    raise KuberentesMappingNotFoundError(
+        'Cannot find a list method for {0}'.format(read_method))
+
+
+def get_alternates_index(method):
+    """ Get every API class that implements a method, with the payload
+    class that the method accepts.
+
+    The docstrings are parsed only the first time a method is looked up,
+    after that it is a dict hit.
+
+    :param str method: The name of the API method, for example
+        create_namespaced_ingress.
+    :return: A list of (API class name, payload class name) tuples.
+    """
+    try:
+        return _ALTERNATES_INDEX[method]
+    except KeyError:
+        pass
+    entries = []
+    for name, value in get_kubernetes_apis().items():
+        method_obj = getattr(value, method, None)
+        if not method_obj:
+            continue
+        entries.append((name, get_method_payload_name(method_obj)))
+    _ALTERNATES_INDEX[method] = entries
+    return entries
+
+
+def get_preferred_alternate(host, api_and_method):
+    """ Get the alternate that last worked against a cluster instead of
+    the mapped API and method.
+
+    :param host: The cluster host.
+    :param api_and_method: A KubernetesSingleOperationApiMapping.
+    :return: A KubernetesSingleOperationApiMapping or None.
+    """
+    return _PREFERRED_ALTERNATES.get(
+        (host, api_and_method.api, api_and_method.method))
+
+
+def set_preferred_alternate(host, api_and_method, alternate):
+    with _PREFERRED_ALTERNATES_LOCK:
+        key = (host, api_and_method.api, api_and_method.method)
+        if alternate:
+            _PREFERRED_ALTERNATES[key] = alternate
+        else:
+            _PREFERRED_ALTERNATES.pop(key, None)
+
+
+def get_api_class_name(api_version):
+    """ Get the name of the API class of the Kubernetes python library that
+    serves an apiVersion.
+
+    :param str api_version: For example rbac.authorization.k8s.io/v1.
+    :return: The class name, for example RbacAuthorizationV1Api, and
+        CoreV1Api for v1.
+    """
+    if '/' in api_version:
+        group, version = api_version.split('/', 1)
+    else:
+        group, version = 'core', api_version
+    if group.endswith('.k8s.io'):
+        group = group[:-len('.k8s.io')]
+    words = [word for word in split('[^a-zA-Z0-9]', group) if word]
+    return '{0}{1}Api'.format(
+        ''.join(word.capitalize() for word in words), version.capitalize())
+
+
+def get_api_and_method_for(api_and_method, api_version):
+    """ Get the API class that serves an apiVersion with the method of a
+    mapping, instead of the class of the mapping.
+
+    :param api_and_method: A KubernetesSingleOperationApiMapping.
+    :param str api_version: The apiVersion of a resource definition.
+    :return: A KubernetesSingleOperationApiMapping, or None if the library
+        has no such class with the method.
+    """
+    method = getattr(api_and_method, 'method', None)
+    if not isinstance(method, text_type) or \
+            not isinstance(api_version, text_type):
+        return
+    api = get_api_class_name(api_version)
+    if api == api_and_method.api:
+        return api_and_method
+    for name, payload_name in get_alternates_index(method):
+        if name == api:
+            return KubernetesSingleOperationApiMapping(
+                api=name,
+                method=method,
+                payload=payload_name if api_and_method.payload else None)
+
+
 class KubernetesSingleOperationApiMapping(object):
 
     def __init__(self, api, method, payload=None):
         self.api = api
         self.method = method
         self.payload = payload
-        self.kubernetes_apis = self.get_kubernetes_apis()
+
+    @property
+    def kubernetes_apis(self):
+        return get_kubernetes_apis()
 
     @staticmethod
     def get_kubernetes_apis():
@@ -35,15 +199,7 @@ class KubernetesSingleOperationApiMapping(object):
 
         :return:
         """
-        kubernetes_apis = {}
-        for name, obj in inspect.getmembers(kube_api):
-            try:
-                path = inspect.getfile(obj)
-            except TypeError:
-                path = None
-            if path and 'kubernetes/client/api' in path:
-                kubernetes_apis[name] = obj
-        return kubernetes_apis
+        return get_kubernetes_apis()
 
     def get_apis_with_method(self):
         """ Get a list of APIs that support self.method function.
@@ -51,59 +207,93 @@ class KubernetesSingleOperationApiMapping(object):
         :return:
         """
         alternates = []
-        for name, value in self.kubernetes_apis.items():
+        for name, payload_name in get_alternates_index(self.method):
             if name == self.api:
                 continue
-            method_obj = getattr(value, self.method, None)
-            if not method_obj:
-                continue
-            if self.payload:
-                payload_name = self.get_method_payload_name(method_obj)
-                alternates.append(
-                    KubernetesSingleOperationApiMapping(
-                        api=name,
-                        method=self.method,
-                        payload=payload_name
-                    )
-                )
-            else:
-                alternates.append(
-                    KubernetesSingleOperationApiMapping(
-                        api=name,
-                        method=self.method
-                    )
+            alternates.append(
+                KubernetesSingleOperationApiMapping(
+                    api=name,
+                    method=self.method,
+                    payload=payload_name if self.payload else None
                 )
+            )
         return alternates
 
     @staticmethod
     def get_method_payload_name(method_obj):
-        """All Kubernetes API methods have a doc string that matches the
-        pattern "param ObjectName body", which is our "payload" object.
-
-        :param str method_obj: The name of the API method, for example
-            create_namespaced_ingress.
-        :return:
-        """
-        body_param_pattern = "param\\s(.*?)\\sbody"
-        docs = inspect.getdoc(method_obj)
-        body_param_result = search(body_param_pattern, docs)
-        return_param_pattern = "\\:return\\:\\s(.*?)\\n"
-        return_param_result = search(return_param_pattern, docs)
-        if not body_param_result and not return_param_pattern:
-            return
-        elif body_param_result and body_param_result.group(1) != 'object':
-            return body_param_result.group(1)
-        elif 'tuple' not in return_param_result.group(1):
-            return return_param_result.group(1)
+        return get_method_payload_name(method_obj)
 
     @property
     def alternates(self):
         return self.get_apis_with_method()
 
 
+def get_status_read_mapping(read):
+    """ Get the method that reads the status subresource of the resources
+    of a read method, if the API has one.
+
+    :param read: The KubernetesSingleOperationApiMapping of the read.
+    :return: A KubernetesSingleOperationApiMapping or None.
+    """
+    api = getattr(kube_api, getattr(read, 'api', None) or '', None)
+    method = '{0}_status'.format(getattr(read, 'method', None))
+    if api and hasattr(api, method):
+        return KubernetesSingleOperationApiMapping(api=read.api, method=method)
+
+
+def get_apply_mapping(update):
+    """ Get the patch method that can take server-side apply requests for
+    the resources of a replace method, if the API has one.
+
+    :param update: The KubernetesSingleOperationApiMapping of the update.
+    :return: A KubernetesSingleOperationApiMapping or None.
+    """
+    api = getattr(kube_api, getattr(update, 'api', None) or '', None)
+    method = getattr(update, 'method', None) or ''
+    if not method.startswith('replace_'):
+        return
+    method = 'patch_{0}'.format(method[len('replace_'):])
+    if api and hasattr(api, method):
+        return KubernetesSingleOperationApiMapping(
+            api=update.api, method=method)
+
+
+def get_list_mapping(read):
+    """ Get the method that lists the resources of a read method.
+
+    :param read: The KubernetesSingleOperationApiMapping of the read.
+    :return: A KubernetesSingleOperationApiMapping or None.
+    """
+    api = getattr(kube_api, getattr(read, 'api', None) or '', None)
+    try:
+        method = get_watch_method_name(getattr(read, 'method', None) or '')
+    except KuberentesMappingNotFoundError:
+        return
+    if api and hasattr(api, method):
+        return KubernetesSingleOperationApiMapping(api=read.api, method=method)
+
+
+def get_delete_collection_mapping(delete):
+    """ Get the method that deletes all the resources that match a label
+    selector, for the resources of a delete method, if the API has one.
+
+    :param delete: The KubernetesSingleOperationApiMapping of the delete.
+    :return: A KubernetesSingleOperationApiMapping or None.
+    """
+    api = getattr(kube_api, getattr(delete, 'api', None) or '', None)
+    method = getattr(delete, 'method', None) or ''
+    if not method.startswith('delete_'):
+        return
+    method = 'delete_collection_{0}'.format(method[len('delete_'):])
+    if api and hasattr(api, method):
+        return KubernetesSingleOperationApiMapping(
+            api=delete.api, method=method)
+
+
 class KubernetesApiMapping(object):
 
-    def __init__(self, create, read, update, delete):
+    def __init__(self, create, read, update, delete, read_status=None,
+                 apply=None, list=None, delete_collection=None):
 
         if isinstance(create, dict):
             create = KubernetesSingleOperationApiMapping(**create)
@@ -117,10 +307,30 @@ class KubernetesApiMapping(object):
         if isinstance(delete, dict):
             delete = KubernetesSingleOperationApiMapping(**delete)
 
+        if isinstance(read_status, dict):
+            read_status = KubernetesSingleOperationApiMapping(**read_status)
+
+        if isinstance(apply, dict):
+            apply = KubernetesSingleOperationApiMapping(**apply)
+
+        if isinstance(list, dict):
+            list = KubernetesSingleOperationApiMapping(**list)
+
+        if isinstance(delete_collection, dict):
+            delete_collection = KubernetesSingleOperationApiMapping(
+                **delete_collection)
+
         self.create = create
         self.read = read
         self.update = update
         self.delete = delete
+        # status checks read only the status subresource, where there is one
+        self.read_status = read_status or get_status_read_mapping(read)
+        self.apply = apply or get_apply_mapping(update)
+        # bulk operations select the resources by label
+        self.list = list or get_list_mapping(read)
+        self.delete_collection = delete_collection or \
+            get_delete_collection_mapping(delete)
 
 
 SUPPORTED_API_MAPPINGS = {
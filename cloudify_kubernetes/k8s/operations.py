@@ -11,14 +11,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from kubernetes.watch import Watch
 from kubernetes.client.rest import ApiException
 
+from .raw import RawApiMethod
 from .exceptions import KuberentesApiOperationError
 
+APPLY_PATCH_CONTENT_TYPE = 'application/apply-patch+yaml'
+
 
 class KubernetesOperartion(object):
 
     API_ACCEPTED_ARGUMENTS = []
+    # The Content-Type of the request, if not the one the method selects.
+    CONTENT_TYPE = None
 
     def __init__(self, api_method, api_method_arguments_names):
         self.api_method = api_method
@@ -72,3 +78,51 @@ class KubernetesUpdateOperation(KubernetesOperartion):
 class KubernetesDeleteOperation(KubernetesOperartion):
 
     API_ACCEPTED_ARGUMENTS = ['grace_period_seconds', 'propagation_policy']
+
+
+class KubernetesListOperation(KubernetesOperartion):
+
+    API_ACCEPTED_ARGUMENTS = ['label_selector', 'field_selector']
+
+
+class KubernetesDeleteCollectionOperation(KubernetesOperartion):
+
+    API_ACCEPTED_ARGUMENTS = ['label_selector',
+                              'grace_period_seconds',
+                              'propagation_policy']
+
+
+class KubernetesApplyOperation(KubernetesOperartion):
+
+    API_ACCEPTED_ARGUMENTS = ['field_manager', 'force']
+    CONTENT_TYPE = APPLY_PATCH_CONTENT_TYPE
+
+
+class KubernetesWatchOperation(KubernetesOperartion):
+
+    API_ACCEPTED_ARGUMENTS = ['field_selector',
+                              'timeout_seconds',
+                              'resource_version',
+                              '_request_timeout']
+
+    def execute(self, arguments):
+        """ Stream the watch events of the list method.
+
+        :return: A generator of the event dicts, with type and object keys.
+        """
+        api_method = self.api_method
+        if isinstance(api_method, RawApiMethod):
+            # the watch decodes the events from the docstring of the method
+            api_method = api_method.method
+        watch = Watch()
+        try:
+            for event in watch.stream(
+                    api_method, **self._prepare_arguments(arguments)):
+                yield event
+        except ApiException as e:
+            raise KuberentesApiOperationError(
+                'Operation execution failed. Exception during Kubernetes '
+                'API call: {0}'
+                .format(str(e)))
+        finally:
+            watch.stop()
@@ -0,0 +1,162 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+APPLY_ORDER = 'apply'
+DELETE_ORDER = 'delete'
+
+WORKLOAD_KINDS = ['Pod', 'Deployment', 'StatefulSet', 'DaemonSet',
+                  'ReplicaSet', 'ReplicationController', 'Job', 'CronJob']
+ROLE_BINDING_KINDS = ['RoleBinding', 'ClusterRoleBinding']
+ROLE_KINDS = ['Role', 'ClusterRole']
+
+
+def _get(ob, *keys):
+    for key in keys:
+        if not isinstance(ob, dict):
+            return
+        ob = ob.get(key)
+    return ob
+
+
+def _api_group(api_version):
+    if api_version and '/' in api_version:
+        return api_version.split('/')[0]
+    return ''
+
+
+def _pod_spec(definition):
+    spec = getattr(definition, 'spec', None)
+    if definition.kind == 'Pod':
+        return spec
+    if definition.kind == 'CronJob':
+        return _get(spec, 'jobTemplate', 'spec', 'template', 'spec')
+    return _get(spec, 'template', 'spec')
+
+
+def _pod_references(pod_spec):
+    """ Yield the (kind, name) of the objects that a pod spec uses.
+    """
+    if not isinstance(pod_spec, dict):
+        return
+    service_account = pod_spec.get('serviceAccountName') or \
+        pod_spec.get('serviceAccount')
+    if service_account:
+        yield 'ServiceAccount', service_account
+    for secret in pod_spec.get('imagePullSecrets') or []:
+        yield 'Secret', _get(secret, 'name')
+    for volume in pod_spec.get('volumes') or []:
+        yield 'ConfigMap', _get(volume, 'configMap', 'name')
+        yield 'Secret', _get(volume, 'secret', 'secretName')
+        yield 'PersistentVolumeClaim', _get(
+            volume, 'persistentVolumeClaim', 'claimName')
+        for source in _get(volume, 'projected', 'sources') or []:
+            yield 'ConfigMap', _get(source, 'configMap', 'name')
+            yield 'Secret', _get(source, 'secret', 'name')
+    containers = (pod_spec.get('initContainers') or []) + \
+        (pod_spec.get('containers') or [])
+    for container in containers:
+        for env_from in _get(container, 'envFrom') or []:
+            yield 'ConfigMap', _get(env_from, 'configMapRef', 'name')
+            yield 'Secret', _get(env_from, 'secretRef', 'name')
+        for env in _get(container, 'env') or []:
+            yield 'ConfigMap', _get(env, 'valueFrom', 'configMapKeyRef',
+                                    'name')
+            yield 'Secret', _get(env, 'valueFrom', 'secretKeyRef', 'name')
+
+
+def _references(definition):
+    """ Yield the (kind, name, namespace) of the objects that a
+    definition uses by name. A namespace of None matches cluster scoped
+    objects and objects in the namespace of the definition.
+    """
+    namespace = definition.metadata.get('namespace')
+    if definition.kind in WORKLOAD_KINDS:
+        for kind, name in _pod_references(_pod_spec(definition)):
+            yield kind, name, namespace
+    elif definition.kind in ROLE_BINDING_KINDS:
+        role_ref = getattr(definition, 'role_ref', None) or {}
+        yield role_ref.get('kind'), role_ref.get('name'), \
+            namespace if role_ref.get('kind') == 'Role' else None
+        for subject in getattr(definition, 'subjects', None) or []:
+            if subject.get('kind') == 'ServiceAccount':
+                yield 'ServiceAccount', subject.get('name'), \
+                    subject.get('namespace') or namespace
+    elif definition.kind == 'PersistentVolumeClaim':
+        yield 'StorageClass', _get(getattr(definition, 'spec', None),
+                                   'storageClassName'), None
+
+
+def _dependencies(definitions):
+    """ Find the definitions that every definition has to wait for.
+
+    :param definitions: A list of KubernetesResourceDefinition.
+    :return: A list with a set of indices for every definition.
+    """
+    by_name = {}
+    namespaces = {}
+    custom_resources = {}
+    for index, definition in enumerate(definitions):
+        name = definition.metadata.get('name')
+        namespace = definition.metadata.get('namespace')
+        by_name.setdefault(
+            (definition.kind, name, namespace), []).append(index)
+        if definition.kind == 'Namespace':
+            namespaces.setdefault(name, []).append(index)
+        elif definition.kind == 'CustomResourceDefinition':
+            spec = getattr(definition, 'spec', None)
+            custom_resources.setdefault(
+                (_get(spec, 'group'), _get(spec, 'names', 'kind')),
+                []).append(index)
+
+    dependencies = []
+    for index, definition in enumerate(definitions):
+        namespace = definition.metadata.get('namespace')
+        required = set(namespaces.get(namespace, []))
+        required.update(custom_resources.get(
+            (_api_group(definition.api_version), definition.kind), []))
+        for kind, name, ref_namespace in _references(definition):
+            if kind and name:
+                required.update(
+                    by_name.get((kind, name, ref_namespace), []))
+        required.discard(index)
+        dependencies.append(required)
+    return dependencies
+
+
+def plan_waves(definitions, order=APPLY_ORDER):
+    """ Group definitions into waves, so that every definition comes after
+    the Namespace, CustomResourceDefinition, ServiceAccount, ConfigMap and
+    other objects from the same list that it uses. The definitions of a
+    wave do not depend on each other.
+
+    :param definitions: A list of KubernetesResourceDefinition.
+    :param order: APPLY_ORDER, or DELETE_ORDER for the reverse order.
+    :return: A list of waves, every wave is a list of indices in the order
+    of the definitions.
+    """
+    dependencies = _dependencies(definitions)
+    waves = []
+    done = set()
+    while len(done) < len(definitions):
+        wave = [index for index in range(len(definitions))
+                if index not in done and dependencies[index] <= done]
+        if not wave:
+            # a cycle, keep the order of the file for the rest
+            wave = [index for index in range(len(definitions))
+                    if index not in done]
+        waves.append(wave)
+        done.update(wave)
+    if order == DELETE_ORDER:
+        waves.reverse()
+    return waves
@@ -0,0 +1,120 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import json
+import inspect
+
+from dateutil.parser import parse
+from kubernetes.client import models
+
+from .._compat import text_type
+
+RETURN_TYPE_PATTERN = re.compile(r':return:\s(.*?)$', re.MULTILINE)
+LIST_TYPE_PATTERN = re.compile(r'list\[(.*)\]')
+DICT_TYPE_PATTERN = re.compile(r'dict\(([^,]*), (.*)\)')
+PRIMITIVE_TYPES = {
+    'str': text_type,
+    'int': int,
+    'long': int,
+    'float': float,
+    'bool': bool,
+}
+
+
+def get_response_type(method):
+    """ Get the name of the class that the API method deserializes its
+    response into, from the ":return:" line of its docstring.
+
+    :param method: A Kubernetes API method.
+    :return: A class name, for example V1Pod, or None.
+    """
+    result = RETURN_TYPE_PATTERN.search(inspect.getdoc(method) or '')
+    if result:
+        return result.group(1)
+
+
+def payload_from_definition(class_name, resource_definition):
+    """ Create the request body straight from a resource definition, with
+    the same keys that the payload model would have been serialized with.
+
+    :param class_name: The name of the payload model, for example V1Pod.
+    :param resource_definition: A KubernetesResourceDefinition.
+    :return: dict
+    """
+    attribute_map = getattr(getattr(models, class_name, None),
+                            'attribute_map', {})
+    return {attribute_map.get(k, k): v
+            for k, v in vars(resource_definition).items()
+            if v is not None}
+
+
+def deserialize(data, klass):
+    """ Decode JSON data into the dict that the to_dict() of the klass
+    model would return, without building the model.
+
+    :param data: Decoded JSON.
+    :param klass: The name of the response class, for example V1Pod.
+    :return: A dict, list or a primitive value.
+    """
+    if data is None:
+        return
+    if klass.startswith('list['):
+        sub_klass = LIST_TYPE_PATTERN.match(klass).group(1)
+        return [deserialize(sub_data, sub_klass) for sub_data in data]
+    if klass.startswith('dict('):
+        sub_klass = DICT_TYPE_PATTERN.match(klass).group(2)
+        return {k: deserialize(v, sub_klass) for k, v in data.items()}
+    if klass in PRIMITIVE_TYPES:
+        try:
+            return PRIMITIVE_TYPES[klass](data)
+        except (TypeError, ValueError):
+            return data
+    if klass == 'object':
+        return data
+    if klass == 'datetime':
+        return parse(data)
+    if klass == 'date':
+        return parse(data).date()
+    model = getattr(models, klass)
+    if not model.openapi_types or not isinstance(data, dict):
+        return data
+    return {attr: deserialize(data.get(model.attribute_map[attr]), attr_type)
+            for attr, attr_type in model.openapi_types.items()}
+
+
+class RawApiMethod(object):
+    """ Call a Kubernetes API method without preloading the response, and
+    decode the JSON response into plain dicts.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.response_type = get_response_type(method)
+
+    def __repr__(self):
+        return 'RawApiMethod({0!r})'.format(self.method)
+
+    def __call__(self, **kwargs):
+        response = self.method(_preload_content=False, **kwargs)
+        if not self.response_type:
+            return
+        data = response.data
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return data
+        return deserialize(data, self.response_type)
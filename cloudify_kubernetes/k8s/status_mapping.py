@@ -22,17 +22,63 @@ from cloudify import ctx
 from cloudify.exceptions import (
     NonRecoverableError, OperationRetry)
 
+# Waiting reasons that do not go away without a change to the resource.
+TERMINAL_WAITING_REASONS = ['CrashLoopBackOff',
+                            'ImagePullBackOff',
+                            'InvalidImageName',
+                            'ErrImageNeverPull',
+                            'CreateContainerConfigError']
+# Condition type -> reasons that mean the rollout has failed.
+TERMINAL_CONDITION_REASONS = {
+    'Progressing': ['ProgressDeadlineExceeded'],
+}
+
+
+def get_terminal_container_state(status):
+    """ Find a container of a pod that waits for a reason that will not
+    go away by retrying.
+
+    :param status: The status of a pod.
+    :return: A tuple of the container name and its waiting state, or None.
+    """
+    for key in ['init_container_statuses', 'container_statuses']:
+        for container in status.get(key) or []:
+            waiting = (container.get('state') or {}).get('waiting') or {}
+            if waiting.get('reason') in TERMINAL_WAITING_REASONS:
+                return container.get('name'), waiting
+
+
+def get_terminal_condition(status):
+    """ Find a condition that says that the resource has failed.
+
+    :param status: The status of a resource.
+    :return: The condition, or None.
+    """
+    for condition in status.get('conditions') or []:
+        if condition.get('reason') in TERMINAL_CONDITION_REASONS.get(
+                condition.get('type'), []):
+            return condition
+
 
 class KubernetesResourceStatus(object):
 
-    def __init__(self, status, validate_status=False):
+    def __init__(self, status, validate_status=False, resource=None):
         self._status = status
         self.validate_status = validate_status
+        self._resource = resource or {}
 
     @property
     def status(self):
         return self._status
 
+    @property
+    def metadata(self):
+        return self._resource.get('metadata') or {}
+
+    @property
+    def spec(self):
+        return self._resource.get('spec') or {}
+
     @property
     def status_message(self):
         return 'Status is {0}'.format(self._status)
@@ -58,6 +104,12 @@ class KubernetesPodStatus(KubernetesResourceStatus):
         return self._status['phase']
 
     def is_resource_ready(self):
+        terminal_state = get_terminal_container_state(self._status)
+        if terminal_state:
+            name, waiting = terminal_state
+            raise NonRecoverableError(
+                'Container {0} is waiting with reason {1}: {2}'.format(
+                    name, waiting.get('reason'), waiting.get('message')))
         if self.status in ['Running', 'Succeeded']:
             ctx.logger.debug(self.status_message)
         elif self.status in ['Pending', 'Unknown']:
@@ -88,11 +140,74 @@ class KubernetesIngressStatus(KubernetesServiceStatus):
     pass
 
 
-class KubernetesDeploymentStatus(KubernetesResourceStatus):
+class KubernetesRolloutStatus(KubernetesResourceStatus):
+    """Track the rollout of a workload like "kubectl rollout status": the
+    controller has to observe the latest generation of the spec, and then
+    update the replicas of that generation.
+    """
+
+    @property
+    def tracks_generation(self):
+        return bool(self.metadata.get('generation'))
+
+    def rollout_progress(self):
+        """
+        :return: A list of (description, current count, desired count).
+        """
+        return []
+
+    def check_generation(self):
+        generation = self.metadata.get('generation')
+        observed_generation = self.status.get('observed_generation') or 0
+        if observed_generation < generation:
+            raise OperationRetry(
+                'Waiting for generation {0} to be observed, the observed '
+                'generation is {1}.'.format(generation, observed_generation))
+
+    def check_rollout(self):
+        self.check_generation()
+        progress = self.rollout_progress()
+        message = ', '.join(
+            '{0}/{1} {2}'.format(current or 0, desired, description)
+            for description, current, desired in progress)
+        ctx.logger.info('Rollout of {0}: {1}.'.format(
+            self.metadata.get('name'), message))
+        if any((current or 0) < desired for _, current, desired in progress):
+            raise OperationRetry('Rollout in progress: {0}.'.format(message))
+
+
+class KubernetesDeploymentStatus(KubernetesRolloutStatus):
+
+    def rollout_progress(self):
+        replicas = self.spec.get('replicas')
+        if replicas is None:
+            replicas = 1
+        return [('updated', self.status.get('updated_replicas'), replicas),
+                ('ready', self.status.get('ready_replicas'), replicas),
+                ('available', self.status.get('available_replicas'),
+                 replicas)]
 
     def is_resource_ready(self):
-        if self.status['unavailable_replicas']:
-            raise OperationRetry(self.status_message)
+        # The conditions describe the observed generation, a condition of
+        # an earlier rollout stays until the new spec is observed.
+        if self.tracks_generation:
+            self.check_generation()
+        condition = get_terminal_condition(self.status)
+        if condition:
+            raise NonRecoverableError(
+                'The rollout has failed with reason {0}: {1}'.format(
+                    condition.get('reason'), condition.get('message')))
+        if not self.tracks_generation:
+            if self.status['unavailable_replicas']:
+                raise OperationRetry(self.status_message)
+            return True
+        self.check_rollout()
+        old_replicas = (self.status.get('replicas') or 0) - \
+            (self.status.get('updated_replicas') or 0)
+        if old_replicas > 0:
+            raise OperationRetry(
+                'Rollout in progress: {0} old replicas are pending '
+                'termination.'.format(old_replicas))
         return True
 
 
@@ -134,21 +249,60 @@ class KubernetesReplicationControllerStatus(KubernetesReplicaSetStatus):
     pass
 
 
-class KubernetesDaemonSetStatus(KubernetesResourceStatus):
+class KubernetesDaemonSetStatus(KubernetesRolloutStatus):
+
+    def rollout_progress(self):
+        desired = self.status.get('desired_number_scheduled') or 0
+        return [('updated', self.status.get('updated_number_scheduled'),
+                 desired),
+                ('available', self.status.get('number_available'), desired)]
 
     def is_resource_ready(self):
-        if not self.status['number_unavailable']:
+        if self.tracks_generation:
+            self.check_rollout()
+        elif not self.status['number_unavailable']:
             ctx.logger.debug(self.status_message)
         else:
             raise OperationRetry(self.status_message)
         return True
 
 
-class KubernetesStatefulSetStatus(KubernetesResourceStatus):
+class KubernetesStatefulSetStatus(KubernetesRolloutStatus):
+
+    @property
+    def partition(self):
+        """ The ordinal from which the pods are updated by a rolling update,
+        or None if the pods are updated when they are deleted.
+        """
+        update_strategy = self.spec.get('update_strategy') or {}
+        if update_strategy.get('type') == 'OnDelete':
+            return
+        return (update_strategy.get('rolling_update') or {}).get(
+            'partition') or 0
+
+    def rollout_progress(self):
+        replicas = self.spec.get('replicas')
+        if replicas is None:
+            replicas = 1
+        progress = [('ready', self.status.get('ready_replicas'), replicas)]
+        if self.partition is not None:
+            progress.insert(0, ('updated', self.status.get('updated_replicas'),
+                                replicas - self.partition))
+        return progress
 
     def is_resource_ready(self):
-        if self.status['ready_replicas']:
-            ctx.logger.debug(self.status_message)
-        else:
-            raise OperationRetry(self.status_message)
+        if not self.tracks_generation:
+            if self.status['ready_replicas']:
+                ctx.logger.debug(self.status_message)
+            else:
+                raise OperationRetry(self.status_message)
+            return True
+        self.check_rollout()
+        update_revision = self.status.get('update_revision')
+        current_revision = self.status.get('current_revision')
+        if self.partition == 0 and update_revision and \
+                current_revision != update_revision:
+            raise OperationRetry(
+                'Rollout in progress: waiting for revision {0}, the current '
+                'revision is {1}.'.format(update_revision, current_revision))
         return True
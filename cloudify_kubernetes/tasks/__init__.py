@@ -47,4 +47,6 @@ from .api_calls import (_do_resource_read,  # noqa
                         _do_resource_create,  # noqa
                         _do_resource_update,  # noqa
                         _do_resource_status_check,  # noqa
+                        _do_resource_status_wait,  # noqa
+                        _do_resource_status_read,  # noqa
                         _do_resource_delete)  # noqa
@@ -0,0 +1,232 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import time
+from copy import deepcopy
+
+from cloudify import ctx
+from cloudify.exceptions import OperationRetry
+
+from .._compat import text_type
+from ..k8s import KubernetesResourceDefinition
+from ..k8s.mapping import get_mapping
+from ..k8s.exceptions import KuberentesApiOperationError
+from ..utils import (get_instance,
+                     retrieve_path,
+                     get_owner_anchor,
+                     sanitize_for_json,
+                     get_instance_labels,
+                     forget_deleted_resources,
+                     get_result_for_retrieve_id,
+                     OWNER_ANCHORS,
+                     LABEL_DEPLOYMENT,
+                     DEFAULT_NAMESPACE,
+                     LABEL_NODE_INSTANCE,
+                     NODE_PROPERTY_OPTIONS,
+                     DEFAULT_OWNER_ANCHOR_DELETE_TIMEOUT)
+
+ANCHOR_KIND = 'ConfigMap'
+ANCHOR_API_VERSION = 'v1'
+ANCHOR_NAME_PREFIX = 'cloudify-owner-'
+ANCHOR_NAME_INVALID_CHARACTERS = re.compile(r'[^a-z0-9-]')
+LABEL_OWNER_ANCHOR = 'cloudify.co/owner-anchor'
+
+
+def _anchor_definition(namespace):
+    """ The anchor of the node instance in a namespace. Its name is the same
+    every time, so that an anchor that was not stored can be found.
+    """
+    labels = get_instance_labels()
+    name = ANCHOR_NAME_INVALID_CHARACTERS.sub(
+        '-', '{0}-{1}'.format(labels[LABEL_DEPLOYMENT],
+                              labels[LABEL_NODE_INSTANCE]).lower())
+    return KubernetesResourceDefinition(
+        kind=ANCHOR_KIND,
+        apiVersion=ANCHOR_API_VERSION,
+        metadata={
+            'name': ANCHOR_NAME_PREFIX + name.strip('-'),
+            'namespace': namespace,
+            # not the labels of the node instance, the anchor is not one of
+            # its resources
+            'labels': {
+                LABEL_DEPLOYMENT: labels[LABEL_DEPLOYMENT],
+                LABEL_OWNER_ANCHOR: labels[LABEL_NODE_INSTANCE],
+            },
+        })
+
+
+def _namespace(resource_definition, kwargs):
+    options = ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs)
+    return resource_definition.metadata.get('namespace') or \
+        options.get('namespace') or DEFAULT_NAMESPACE
+
+
+def _ensure_anchor(client, namespace):
+    """ Get the anchor of the node instance in a namespace, and create it
+    if it does not exist yet.
+
+    :return: A dict with the name and uid of the anchor.
+    """
+    anchors = get_instance(ctx).runtime_properties.get(OWNER_ANCHORS) or {}
+    anchor = anchors.get(namespace)
+    if anchor and not anchor.get('deleted'):
+        return anchor
+    definition = _anchor_definition(namespace)
+    mapping = get_mapping(ANCHOR_KIND)
+    try:
+        result = client.create_resource(
+            mapping, definition, {'namespace': namespace})
+    except KuberentesApiOperationError as e:
+        if '(409)' not in text_type(e):
+            raise
+        result = client.read_resource(
+            mapping, definition, {'namespace': namespace})
+    metadata = sanitize_for_json(result)['metadata']
+    if metadata.get('deletion_timestamp'):
+        # the resources that it owns would be deleted with it
+        raise OperationRetry(
+            'Waiting for the owner anchor {0} to be deleted.'.format(
+                definition.metadata['name']))
+    anchor = {'name': definition.metadata['name'], 'uid': metadata['uid']}
+    anchors = dict(anchors)
+    anchors[namespace] = anchor
+    get_instance(ctx).runtime_properties[OWNER_ANCHORS] = anchors
+    return anchor
+
+
+def add_owner_reference(client, api_mapping, resource_definition, **kwargs):
+    """ Make the anchor of the node instance the owner of a namespaced
+    resource of a file, when the owner_anchor node property is enabled.
+    Cluster scoped resources can not have a namespaced owner.
+    """
+    if not get_owner_anchor() or not retrieve_path(kwargs) or \
+            'namespaced' not in api_mapping.create.method:
+        return
+    anchor = _ensure_anchor(
+        client, _namespace(resource_definition, kwargs))
+    metadata = resource_definition.metadata
+    references = metadata.get('ownerReferences') or []
+    if any(reference.get('uid') == anchor['uid']
+           for reference in references):
+        return
+    # the metadata can be a node property, do not change it in place
+    references = list(references) + [{
+        'apiVersion': ANCHOR_API_VERSION,
+        'kind': ANCHOR_KIND,
+        'name': anchor['name'],
+        'uid': anchor['uid'],
+        # a foreground delete of the anchor waits for the resource
+        'blockOwnerDeletion': True,
+    }]
+    resource_definition.metadata = dict(metadata, ownerReferences=references)
+
+
+def _owned(kwargs, uids):
+    try:
+        result = get_result_for_retrieve_id(retrieve_path(kwargs)) or {}
+    except KeyError:
+        return False
+    metadata = result.get('metadata') or {}
+    references = metadata.get('owner_references') or \
+        metadata.get('ownerReferences') or []
+    return any(reference.get('uid') in uids for reference in references)
+
+
+def _delete_anchor(client, mapping, definition):
+    try:
+        client.delete_resource(
+            mapping, definition, definition.metadata['name'],
+            {'namespace': definition.metadata['namespace'],
+             'propagation_policy': 'Foreground'})
+    except KuberentesApiOperationError as e:
+        if '(404)' not in text_type(e):
+            raise
+
+
+def _wait_for_anchor(client, mapping, definition, deadline):
+    """ Watch a deleted anchor until Kubernetes removes it, which it does
+    after it deletes the resources that the anchor owns.
+
+    :return: True if the anchor is gone before the deadline.
+    """
+    options = {'namespace': definition.metadata['namespace']}
+    try:
+        result = client.read_resource(mapping, definition, dict(options))
+    except KuberentesApiOperationError as e:
+        if '(404)' in text_type(e):
+            return True
+        raise
+    # the events after the read, so the delete is not missed
+    options['resource_version'] = \
+        sanitize_for_json(result)['metadata'].get('resource_version')
+    remaining = deadline - time.time()
+    try:
+        while remaining >= 1:
+            for event in client.watch_resource(
+                    mapping, definition, dict(options), remaining):
+                if event['type'] == 'DELETED':
+                    return True
+            remaining = deadline - time.time()
+    except KuberentesApiOperationError as e:
+        ctx.logger.debug('Unable to watch the owner anchor: {0}'.format(e))
+    return False
+
+
+def cascade_delete(waves):
+    """ Delete the anchors of the node instance with a foreground delete,
+    and wait for Kubernetes to delete the resources that they own.
+
+    :param waves: The waves of (definition, kwargs) documents to delete.
+    :return: The waves without the documents that the anchors owned.
+    """
+    anchors = get_instance(ctx).runtime_properties.get(OWNER_ANCHORS)
+    documents = sum(waves, [])
+    if not anchors or not documents:
+        return waves
+    anchors = deepcopy(dict(anchors))
+    client = documents[0][1]['client']
+    mapping = get_mapping(ANCHOR_KIND)
+    timeout = (get_owner_anchor() or {}).get(
+        'delete_timeout', DEFAULT_OWNER_ANCHOR_DELETE_TIMEOUT)
+    deadline = time.time() + timeout
+    deleting = [(namespace, _anchor_definition(namespace))
+                for namespace, anchor in anchors.items()
+                if not anchor.get('deleted')]
+    for _, definition in deleting:
+        ctx.logger.info('Deleting the owner anchor {0} in {1}.'.format(
+            definition.metadata['name'], definition.metadata['namespace']))
+        _delete_anchor(client, mapping, definition)
+    for namespace, definition in deleting:
+        if not _wait_for_anchor(client, mapping, definition, deadline):
+            raise OperationRetry(
+                'Waiting for the resources that {0} owns to be '
+                'deleted.'.format(definition.metadata['name']))
+        anchors[namespace]['deleted'] = True
+    # the uids of deleted anchors are kept for the other files of the node
+    get_instance(ctx).runtime_properties[OWNER_ANCHORS] = anchors
+
+    uids = set(anchor['uid'] for anchor in anchors.values())
+    owned = []
+    remaining = []
+    for wave in waves:
+        owned.extend((d, k) for d, k in wave if _owned(k, uids))
+        wave = [(d, k) for d, k in wave if not _owned(k, uids)]
+        if wave:
+            remaining.append(wave)
+    if owned:
+        ctx.logger.info('{0} resources were deleted with their owner '
+                        'anchors.'.format(len(owned)))
+        forget_deleted_resources(owned)
+    return remaining
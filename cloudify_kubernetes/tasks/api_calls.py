@@ -14,18 +14,33 @@
 
 # hack for import namespaced modules (google.auth)
 import cloudify_importer # noqa
+import time
 
 from cloudify import ctx
-from cloudify.exceptions import NonRecoverableError
+from cloudify.exceptions import NonRecoverableError, OperationRetry
 
+from .._compat import text_type
 from ..k8s import status_mapping
 from ..k8s.exceptions import KuberentesApiOperationError
 from ..utils import (set_namespace,
-                     JsonCleanuper,
+                     sanitize_for_json,
                      PERMIT_REDEFINE,
                      set_custom_resource,
                      NODE_PROPERTY_OPTIONS,
-                     handle_delete_resource)
+                     STATUS_EXCLUDED_FIELDS,
+                     handle_delete_resource,
+                     retrieve_path,
+                     add_instance_labels,
+                     get_server_side_apply,
+                     count_skipped_update,
+                     definition_unchanged,
+                     store_definition_fingerprint,
+                     remove_definition_fingerprint,
+                     INSTANCE_RUNTIME_PROPERTY_KUBERNETES,
+                     handle_existing_resource,
+                     optimistic_create_enabled,
+                     NODE_PROPERTY_STATUS_WATCH_TIMEOUT)
+from .anchor import add_owner_reference
 
 
 def _do_resource_create(client, api_mapping, resource_definition, **kwargs):
@@ -36,10 +51,38 @@ def _do_resource_create(client, api_mapping, resource_definition, **kwargs):
     if not perform_task:
         return _do_resource_read(
             client, api_mapping, resource_definition, **kwargs)
-    return JsonCleanuper(client.create_resource(
-        api_mapping,
-        resource_definition,
-        options)).to_dict()
+    add_instance_labels(resource_definition)
+    add_owner_reference(client, api_mapping, resource_definition, **kwargs)
+    server_side_apply = get_server_side_apply()
+    try:
+        # An apply also changes a resource that exists. Without the read
+        # before the create, a POST reports it with a conflict, so that
+        # use_if_exists still applies.
+        if server_side_apply and not optimistic_create_enabled():
+            result = client.apply_resource(
+                api_mapping,
+                resource_definition,
+                options,
+                **server_side_apply)
+        else:
+            result = client.create_resource(
+                api_mapping,
+                resource_definition,
+                options)
+    except KuberentesApiOperationError as e:
+        if '(409)' not in text_type(e) or not optimistic_create_enabled():
+            raise
+    else:
+        store_definition_fingerprint(resource_definition)
+        return sanitize_for_json(result)
+    # The resource was not read before the create, apply the same rules as
+    # if it had been.
+    ctx.logger.debug('The resource {0} already exists.'.format(
+        resource_definition.metadata['name']))
+    existing_resource = _do_resource_read(
+        client, api_mapping, resource_definition, **kwargs)
+    handle_existing_resource(existing_resource, resource_definition)
+    return existing_resource
 
 
 def _do_resource_read(client, api_mapping, resource_definition, **kwargs):
@@ -53,22 +96,66 @@ def _do_resource_read(client, api_mapping, resource_definition, **kwargs):
     options = ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs)
     set_namespace(kwargs, resource_definition)
     set_custom_resource(options, resource_definition)
-    return JsonCleanuper(client.read_resource(
+    return sanitize_for_json(client.read_resource(
         api_mapping,
         resource_definition,
         options
-    )).to_dict()
+    ))
 
 
-def _do_resource_update(client, api_mapping, resource_definition, **kwargs):
+def _do_resource_status_read(client,
+                             api_mapping,
+                             resource_definition,
+                             **kwargs):
     options = ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs)
     set_namespace(kwargs, resource_definition)
     set_custom_resource(options, resource_definition)
-    return JsonCleanuper(client.update_resource(
+    return sanitize_for_json(client.read_resource_status(
         api_mapping,
         resource_definition,
-        ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs)
-    )).to_dict()
+        options
+    ), exclude=STATUS_EXCLUDED_FIELDS)
+
+
+def _do_resource_update(client, api_mapping, resource_definition, **kwargs):
+    options = ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs)
+    set_namespace(kwargs, resource_definition)
+    set_custom_resource(options, resource_definition)
+    add_instance_labels(resource_definition)
+    add_owner_reference(client, api_mapping, resource_definition, **kwargs)
+    last_result = _last_applied_result(resource_definition, **kwargs)
+    if last_result:
+        count_skipped_update(resource_definition)
+        return last_result
+    server_side_apply = get_server_side_apply()
+    if server_side_apply:
+        result = client.apply_resource(
+            api_mapping,
+            resource_definition,
+            options,
+            **server_side_apply)
+    else:
+        result = client.update_resource(
+            api_mapping,
+            resource_definition,
+            ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs)
+        )
+    store_definition_fingerprint(resource_definition)
+    return sanitize_for_json(result)
+
+
+def _last_applied_result(resource_definition, **kwargs):
+    """Get the stored result of a resource, if its definition is the same
+    as the one that was last applied to it, so there is nothing to update.
+    """
+    if not definition_unchanged(resource_definition):
+        return
+    last_result = ctx.instance.runtime_properties.get(
+        INSTANCE_RUNTIME_PROPERTY_KUBERNETES) or {}
+    path = retrieve_path(kwargs)
+    if path:
+        last_result = last_result.get(path)
+    return last_result or None
 
 
 def _do_resource_status_check(resource_kind, response):
@@ -77,13 +164,58 @@ def _do_resource_status_check(resource_kind, response):
     if hasattr(status_mapping, status_obj_name):
         return getattr(status_mapping, status_obj_name)(
             response['status'],
-            ctx.node.properties['validate_resource_status']).ready()
+            ctx.node.properties['validate_resource_status'],
+            resource=response).ready()
     ctx.logger.debug(
         'Resource status check not supported for {0}'.format(
             resource_kind))
     return True
 
 
+def _do_resource_status_wait(client,
+                             api_mapping,
+                             resource_definition,
+                             response,
+                             **kwargs):
+    """Check the resource status, and if it is not ready yet, watch the
+    resource for the time budget of the status_watch_timeout node property,
+    instead of retrying the whole operation.
+    """
+    resource_kind = resource_definition.kind
+    try:
+        return _do_resource_status_check(resource_kind, response)
+    except OperationRetry as e:
+        timeout = ctx.node.properties.get(
+            NODE_PROPERTY_STATUS_WATCH_TIMEOUT, 0)
+        if not timeout:
+            raise
+        retry = e
+    options = dict(ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs))
+    set_namespace(kwargs, resource_definition)
+    set_custom_resource(options, resource_definition)
+    ctx.logger.info('Waiting up to {0} seconds for {1} {2} to be ready.'
+                    .format(timeout, resource_kind,
+                            resource_definition.metadata['name']))
+    deadline = time.time() + timeout
+    remaining = timeout
+    try:
+        while remaining >= 1:
+            for event in client.watch_resource(
+                    api_mapping, resource_definition, dict(options),
+                    remaining):
+                if event['type'] not in ['ADDED', 'MODIFIED']:
+                    continue
+                try:
+                    return _do_resource_status_check(
+                        resource_kind, sanitize_for_json(event['object']))
+                except OperationRetry as e:
+                    retry = e
+            remaining = deadline - time.time()
+    except KuberentesApiOperationError as e:
+        ctx.logger.debug('Unable to watch the resource: {0}'.format(e))
+    raise retry
+
+
 def _do_resource_delete(client, api_mapping, resource_definition,
                         resource_id, **kwargs):
     options = ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs)
@@ -109,13 +241,15 @@ def _do_resource_delete(client, api_mapping, resource_definition,
     handle_delete_resource(resource_exists)
     perform_task = ctx.instance.runtime_properties.get('__perform_task', False)
     if not perform_task:
-        return JsonCleanuper(resource_exists).to_dict()
-    return JsonCleanuper(client.delete_resource(
+        return sanitize_for_json(resource_exists)
+    result = client.delete_resource(
         api_mapping,
         resource_definition,
         resource_id,
         options,
-    )).to_dict()
+    )
+    remove_definition_fingerprint(resource_definition)
+    return sanitize_for_json(result)
 
 
 def _check_if_resource_exists(client,
@@ -129,3 +263,27 @@ def _check_if_resource_exists(client,
         ctx.logger.error('The resource {0} was not found.'.format(
             resource_definition.metadata['name']))
         return
+
+
+def _check_if_resource_exists_before_update(client,
+                                            api_mapping,
+                                            resource_definition,
+                                            **kwargs):
+    # an unchanged definition is not applied, there is no need to read the
+    # resource
+    add_instance_labels(resource_definition)
+    add_owner_reference(client, api_mapping, resource_definition, **kwargs)
+    return _last_applied_result(resource_definition, **kwargs) or \
+        _check_if_resource_exists(
+            client, api_mapping, resource_definition, **kwargs)
+
+
+def _check_if_resource_exists_before_create(client,
+                                            api_mapping,
+                                            resource_definition,
+                                            **kwargs):
+    if optimistic_create_enabled():
+        # _do_resource_create reads the resource if it already exists
+        return
+    return _check_if_resource_exists(
+        client, api_mapping, resource_definition, **kwargs)
@@ -0,0 +1,196 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+from cloudify import ctx
+from cloudify.exceptions import OperationRetry
+
+from ..k8s.exceptions import KuberentesInvalidApiMethodError
+from ..utils import (check_drift,
+                     retrieve_path,
+                     sanitize_for_json,
+                     set_custom_resource,
+                     get_drift_fingerprint,
+                     forget_deleted_resources,
+                     NODE_PROPERTY_OPTIONS,
+                     get_result_for_retrieve_id,
+                     get_instance_labels,
+                     get_instance_label_selector)
+from .api_calls import _do_resource_status_check
+
+# Resources that the delete of a single resource has to prepare first.
+DELETE_COLLECTION_EXCLUDED_KINDS = ['PersistentVolumeClaim']
+
+
+def _options(definition, kwargs):
+    options = dict(ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs))
+    set_custom_resource(options, definition)
+    return options
+
+
+def _group_by_kind(documents):
+    """ Group documents by the list request that reads them.
+
+    :param documents: A list of (definition, kwargs) tuples.
+    :return: An OrderedDict of lists of documents, in the order of the
+        documents.
+    """
+    groups = OrderedDict()
+    for definition, kwargs in documents:
+        namespace = definition.metadata.get('namespace') or \
+            _options(definition, kwargs).get('namespace')
+        groups.setdefault(
+            (definition.api_version, definition.kind, namespace), []).append(
+            (definition, kwargs))
+    return groups
+
+
+def _list_by_label(group):
+    """ Read the resources of a group that have the labels of the node
+    instance, with one request.
+
+    :return: A dict of the resources by name, or None if the resources can
+        not be listed.
+    """
+    definition, kwargs = group[0]
+    try:
+        response = kwargs['client'].list_resources(
+            kwargs['api_mapping'],
+            definition,
+            _options(definition, kwargs),
+            get_instance_label_selector())
+    except KuberentesInvalidApiMethodError:
+        return
+    resources = {}
+    for item in sanitize_for_json(response).get('items') or []:
+        # the items of a list response have no kind and API version
+        if not item.get('kind'):
+            item['kind'] = definition.kind
+        if not item.get('api_version') and not item.get('apiVersion'):
+            item['api_version'] = definition.api_version
+        resources[item['metadata']['name']] = item
+    return resources
+
+
+def _listed_resource_ready(definition, resource):
+    """ Check the status of a listed resource.
+
+    :return: False if the resource is not ready yet, so that it is checked,
+        and watched, on its own.
+    """
+    try:
+        # None when the status is not validated
+        return _do_resource_status_check(
+            definition.kind, resource) is not False
+    except OperationRetry as e:
+        ctx.logger.debug('{0} {1} is not ready yet: {2}'.format(
+            definition.kind, definition.metadata['name'], e))
+        return False
+
+
+def bulk_check_status(waves, apply_document):
+    """ Check the status of the resources of a file with a list request
+    per kind. Resources that are not found by label, or are not ready yet,
+    are checked one by one.
+    """
+    for group in _group_by_kind(sum(waves, [])).values():
+        resources = _list_by_label(group) or {}
+        for definition, kwargs in group:
+            resource = resources.get(definition.metadata['name'])
+            if resource and _listed_resource_ready(definition, resource):
+                continue
+            apply_document(definition, kwargs)
+
+
+def bulk_check_drift(waves, apply_document):
+    """ Check the drift of the resources of a file with a list request per
+    kind. Resources that are not found by label are checked one by one.
+    """
+    for group in _group_by_kind(sum(waves, [])).values():
+        resources = _list_by_label(group) or {}
+        for definition, kwargs in group:
+            resource = resources.get(definition.metadata['name'])
+            if resource is None:
+                apply_document(definition, kwargs)
+                continue
+            path = retrieve_path(kwargs)
+            previous_response = get_result_for_retrieve_id(path)
+            diff = check_drift(previous_response,
+                               resource,
+                               get_drift_fingerprint(previous_response, path))
+            if diff:
+                raise RuntimeError('The resource has drifted: {}'.format(diff))
+    ctx.logger.info('No drift ')
+
+
+def _labeled(kwargs):
+    """ Check if a resource had the labels of the node instance when it was
+    stored, so if a list by label does not find it, it is gone.
+    """
+    try:
+        result = get_result_for_retrieve_id(retrieve_path(kwargs)) or {}
+    except KeyError:
+        return False
+    labels = (result.get('metadata') or {}).get('labels') or {}
+    return all(labels.get(k) == v for k, v in get_instance_labels().items())
+
+
+def bulk_delete(waves, apply_document):
+    """ Delete the resources of a file, wave after wave, with a
+    deletecollection request per kind. Resources are deleted one by one
+    when the API has no deletecollection, when they were created without
+    the labels, or when the label selector also matches resources that are
+    not in the file.
+    """
+    label_selector = get_instance_label_selector()
+    for wave in waves:
+        deleting = 0
+        for group in _group_by_kind(wave).values():
+            definition, kwargs = group[0]
+            resources = _list_by_label(group)
+            if resources is None or \
+                    definition.kind in DELETE_COLLECTION_EXCLUDED_KINDS or \
+                    not getattr(kwargs['api_mapping'],
+                                'delete_collection', None):
+                one_by_one, by_label = group, []
+            else:
+                names = set(d.metadata['name'] for d, _ in group)
+                by_label = [(d, k) for d, k in group
+                            if d.metadata['name'] in resources]
+                one_by_one = [(d, k) for d, k in group
+                              if d.metadata['name'] not in resources and
+                              not _labeled(k)]
+                if set(resources) - names:
+                    # other resources have the same labels, keep them
+                    one_by_one.extend(by_label)
+                    by_label = []
+            for document in one_by_one:
+                apply_document(*document)
+            if not by_label:
+                continue
+            ctx.logger.info(
+                'Deleting {0} {1} resources by label {2}.'.format(
+                    len(by_label), definition.kind, label_selector))
+            kwargs['client'].delete_resources(
+                kwargs['api_mapping'],
+                definition,
+                _options(definition, kwargs),
+                label_selector)
+            deleting += len(by_label)
+        if deleting:
+            # the next wave waits for the resources to be gone
+            raise OperationRetry(
+                'Waiting for {0} resources to be deleted.'.format(deleting))
+    forget_deleted_resources(sum(waves, []))
@@ -30,15 +30,20 @@ from ..decorators import (resource_task,
                           nested_resource_task,
                           with_kubernetes_client)
 from ..k8s.exceptions import KuberentesApiOperationError
+from ..k8s.planner import APPLY_ORDER, DELETE_ORDER
 from ..utils import (check_drift,
+                     set_namespace,
+                     get_drift_fingerprint,
                      retrieve_path,
-                     JsonCleanuper,
+                     sanitize_for_json,
                      mapping_by_data,
                      mapping_by_kind,
                      NODE_PROPERTY_FILES,
+                     NODE_PROPERTY_OPTIONS,
                      DEFINITION_ADDITIONS,
                      update_with_additions,
                      handle_delete_resource,
+                     flush_instance_updates,
                      validate_file_resources,
                      handle_existing_resource,
                      retrieve_stored_resource,
@@ -55,7 +60,12 @@ from .api_calls import (
     _do_resource_delete,
     _do_resource_update,
     _check_if_resource_exists,
-    _do_resource_status_check)
+    _check_if_resource_exists_before_create,
+    _check_if_resource_exists_before_update,
+    _do_resource_status_wait,
+    _do_resource_status_read)
+from .anchor import cascade_delete
+from .bulk import bulk_delete, bulk_check_drift, bulk_check_status
 from .nested_resources.tokens import (
     get_service_account_payload,
     get_cluster_role_binding_payload,
@@ -95,7 +105,7 @@ def _resource_update(client, api_mapping, resource_definition, **kwargs):
 
 
 def _file_resource_create(client, api_mapping, resource_definition, **kwargs):
-    result = _check_if_resource_exists(
+    result = _check_if_resource_exists_before_create(
         client, api_mapping, resource_definition, **kwargs)
     handle_existing_resource(result, resource_definition)
     perform_task = ctx.instance.runtime_properties.get('__perform_task',
@@ -151,11 +161,12 @@ def _healable_resource_check_status(client,
                                     api_mapping,
                                     resource_definition,
                                     **kwargs):
-    read_response = _do_resource_read(
+    read_response = _do_resource_status_read(
         client, api_mapping, resource_definition, **kwargs)
     resource_type = getattr(resource_definition, 'kind')
     if resource_type:
-        status_check = _do_resource_status_check(resource_type, read_response)
+        status_check = _do_resource_status_wait(
+            client, api_mapping, resource_definition, read_response, **kwargs)
         ctx.logger.info('Resource definition: {0}'.format(resource_type))
         ctx.logger.info('Status: {0}'.format(status_check))
         if not status_check:
@@ -173,7 +184,9 @@ def _resource_check_drift(client, api_mapping, resource_definition, **kwargs):
     current_response = _resource_read(
         client, api_mapping, resource_definition, **kwargs)
 
-    diff = check_drift(previous_response, current_response)
+    diff = check_drift(previous_response,
+                       current_response,
+                       get_drift_fingerprint(previous_response, path))
     if diff:
         raise RuntimeError('The resource has drifted: {}'.format(diff))
     else:
@@ -193,12 +206,14 @@ def _file_resource_read(client, api_mapping, resource_definition, **kwargs):
 
     resource_type = getattr(resource_definition, 'kind')
     if resource_type:
-        _do_resource_status_check(resource_type, read_response)
+        _do_resource_status_wait(
+            client, api_mapping, resource_definition, read_response, **kwargs)
         ctx.logger.info(
             'Resource definition: {0}'.format(resource_type))
 
 
-def _get_path_with_adjacent_resources(path, resource_definition, api_mapping):
+def _get_path_with_adjacent_resources(path, resource_definition, api_mapping,
+                                      client=None):
     try:
         path, resource, adjacent_resources = \
             retrieve_last_create_path(path)
@@ -221,7 +236,7 @@ def _get_path_with_adjacent_resources(path, resource_definition, api_mapping):
             apiVersion=api_version,
             metadata=metadata
         )
-        api_mapping = mapping_by_kind(resource_definition)
+        api_mapping = mapping_by_kind(resource_definition, client=client)
     return adjacent_resources, resource_definition, api_mapping
 
 
@@ -278,7 +293,7 @@ def _delete_while_adjacent_resources(client,
 
     if perform_task:
         store_result_for_retrieve_id(
-            JsonCleanuper(resource_definition).to_dict(),
+            sanitize_for_json(resource_definition),
             path
         )
         # Also the adjacent resources:
@@ -295,7 +310,7 @@ def _file_resource_delete(client, api_mapping, resource_definition, **kwargs):
     path = retrieve_path(kwargs)
     adjacent_resources, resource_definition, api_mapping = \
         _get_path_with_adjacent_resources(
-            path, resource_definition, api_mapping)
+            path, resource_definition, api_mapping, client)
     read_resource = _read_while_adjacent_resources(
         client, api_mapping, resource_definition, kwargs)
     if isinstance(read_resource, MissingResource) and adjacent_resources:
@@ -309,7 +324,8 @@ def _file_resource_delete(client, api_mapping, resource_definition, **kwargs):
                     apiVersion=inner_api,
                     metadata=inner_meta
                 )
-                inner_api_mapping = mapping_by_kind(resource_definition)
+                inner_api_mapping = mapping_by_kind(
+                    resource_definition, client=client)
                 _file_resource_delete(
                     client,
                     inner_api_mapping,
@@ -318,6 +334,7 @@ def _file_resource_delete(client, api_mapping, resource_definition, **kwargs):
 
         for k, v in adjacent_resources.items():
             store_result_for_retrieve_id(v, k)
+        flush_instance_updates()
         raise OperationRetry(
             'Continue to deletion of adjacent resources: {0}'.format(
                 text_type(read_resource)))
@@ -338,6 +355,7 @@ def _file_resource_delete(client, api_mapping, resource_definition, **kwargs):
             ctx.logger.info('Ignoring missing resource: {}'.format(
                 str(result)))
         elif isinstance(result, OperationRetry):
+            flush_instance_updates()
             raise result
 
     # If I have not thought of another scenario, we need to go back and
@@ -347,6 +365,7 @@ def _file_resource_delete(client, api_mapping, resource_definition, **kwargs):
         ctx.logger.info('Indeed, we arrived here.')
         for k, v in adjacent_resources.items():
             store_result_for_retrieve_id(v, k)
+        flush_instance_updates()
         raise OperationRetry('Retrying for adjacent resources.')
 
 
@@ -354,7 +373,7 @@ def _file_resource_delete(client, api_mapping, resource_definition, **kwargs):
 @resource_task(
     retrieve_resource_definition=resource_definition_from_blueprint,
     retrieve_mapping=mapping_by_kind,
-    resource_state_function=_check_if_resource_exists
+    resource_state_function=_check_if_resource_exists_before_create
 )
 def resource_create(client, api_mapping, resource_definition, **kwargs):
     result = _resource_create(
@@ -402,6 +421,7 @@ def custom_resource_create(client, api_mapping, resource_definition, **kwargs):
 @resource_task(
     retrieve_resources_definitions=resource_definitions_from_file,
     retrieve_mapping=mapping_by_kind,
+    dependency_order=APPLY_ORDER,
 )
 def file_resource_create(client, api_mapping, resource_definition, **kwargs):
     _file_resource_create(client, api_mapping, resource_definition, **kwargs)
@@ -411,6 +431,7 @@ def file_resource_create(client, api_mapping, resource_definition, **kwargs):
 @resource_task(
     retrieve_resources_definitions=resource_definitions_from_file,
     retrieve_mapping=mapping_by_kind,
+    dependency_order=APPLY_ORDER,
 )
 def file_resource_update(client, api_mapping, resource_definition, **kwargs):
     additions = kwargs.get(DEFINITION_ADDITIONS)
@@ -438,7 +459,8 @@ def custom_resource_read(client, api_mapping, resource_definition, **kwargs):
 
     resource_type = getattr(resource_definition, 'kind')
     if resource_type:
-        _do_resource_status_check(resource_type, read_response)
+        _do_resource_status_wait(
+            client, api_mapping, resource_definition, read_response, **kwargs)
         ctx.logger.info(
             'Resource definition: {0}'.format(resource_type))
 
@@ -485,7 +507,8 @@ def resource_read(client, api_mapping, resource_definition, **kwargs):
 
     resource_type = getattr(resource_definition, 'kind')
     if resource_type:
-        _do_resource_status_check(resource_type, read_response)
+        _do_resource_status_wait(
+            client, api_mapping, resource_definition, read_response, **kwargs)
         ctx.logger.info(
             'Resource definition: {0}'.format(resource_type))
 
@@ -540,6 +563,7 @@ def file_resource_read(client, api_mapping, resource_definition, **kwargs):
 @resource_task(
     retrieve_resources_definitions=resource_definitions_from_file,
     retrieve_mapping=mapping_by_kind,
+    bulk_task=bulk_check_status,
 )
 def file_resource_check_status(client,
                                api_mapping,
@@ -552,6 +576,7 @@ def file_resource_check_status(client,
 @resource_task(
     retrieve_resources_definitions=resource_definitions_from_file,
     retrieve_mapping=mapping_by_kind,
+    bulk_task=bulk_check_drift,
 )
 def file_resource_check_drift(client,
                               api_mapping,
@@ -564,7 +589,7 @@ def file_resource_check_drift(client,
 @resource_task(
     retrieve_resource_definition=resource_definition_from_blueprint,
     retrieve_mapping=mapping_by_kind,
-    resource_state_function=_check_if_resource_exists
+    resource_state_function=_check_if_resource_exists_before_update
 )
 def resource_update(client, api_mapping, resource_definition, **kwargs):
     result = _resource_update(
@@ -694,7 +719,10 @@ def custom_resource_delete(client, api_mapping, resource_definition, **kwargs):
     retrieve_resources_definitions=resource_definitions_from_file,
     retrieve_mapping=mapping_by_kind,
     cleanup_runtime_properties=True,  # remove on successful run
-    resource_state_function=_check_if_resource_exists
+    resource_state_function=_check_if_resource_exists,
+    dependency_order=DELETE_ORDER,
+    bulk_task=bulk_delete,
+    cascade_task=cascade_delete,
 )
 def file_resource_delete(client, api_mapping, resource_definition, **kwargs):
     _file_resource_delete(client, api_mapping, resource_definition, **kwargs)
@@ -762,7 +790,8 @@ def multiple_file_resource_delete(**kwargs):
     )
     validate_file_resources(file_resources)
 
-    for file_resource in file_resources:
+    # the files were created in order, delete them the other way around
+    for file_resource in reversed(file_resources):
         file_resource_delete(file=file_resource, **kwargs)
 
 
@@ -871,12 +900,15 @@ def prepare_pvc_delete(resource_definition, client, api_mapping, kwargs):
         apiVersion=resource_definition.api_version,
         metadata=metadata
     )
+    set_namespace(kwargs, resource_definition)
+    # Only the finalizers are removed, so the client is called directly:
+    # the update task would add an owner reference, store a fingerprint of
+    # the deleted resource, and with server-side apply, drop its spec.
     try:
-        _do_resource_update(
-            client,
+        client.update_resource(
             api_mapping,
             resource_definition,
-            **kwargs
+            ctx.node.properties.get(NODE_PROPERTY_OPTIONS, kwargs)
         )
     except KuberentesApiOperationError:
         return
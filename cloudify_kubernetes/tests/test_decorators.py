@@ -13,14 +13,23 @@
 # limitations under the License.
 
 
+import time
 import unittest
+import threading
 from mock import MagicMock, patch
 
+from cloudify import ctx as ctx_proxy
 from cloudify.state import current_ctx
 from cloudify.mocks import MockCloudifyContext
-from cloudify.exceptions import RecoverableError, NonRecoverableError
+from cloudify.manager import DirtyTrackingDict
+from cloudify.exceptions import (OperationRetry,
+                                 RecoverableError,
+                                 NonRecoverableError)
 
+from .. import utils
 from .. import decorators
+from ..k8s import cache
+from ..k8s import planner
 from ..k8s import (
     CloudifyKubernetesClient,
     KubernetesResourceDefinition,
@@ -29,6 +38,10 @@ from ..k8s import (
 
 class TestDecorators(unittest.TestCase):
 
+    def setUp(self):
+        super(TestDecorators, self).setUp()
+        cache._API_CLIENTS.clear()
+
     def _prepare_master_node(self, with_client_config=False,
                              with_relationship_to_master=True):
         node = MagicMock()
@@ -208,6 +221,227 @@ class TestDecorators(unittest.TestCase):
             error.exception.causes[0]['message'], "error_text"
         )
 
+    def test_resource_task_coalesces_updates(self):
+        _, _ctx = self._prepare_master_node()
+        _ctx.instance.update = MagicMock()
+        _ctx.logger.debug = MagicMock()
+        defintion = KubernetesResourceDefinition(
+            **_ctx.node.properties['definition'])
+
+        def task(**_):
+            for i in range(3):
+                _ctx.instance.runtime_properties['step'] = i
+                utils.update_instance()
+            self.assertFalse(_ctx.instance.update.called)
+
+        decorators.resource_task(
+            retrieve_resources_definitions=MagicMock(
+                return_value=[defintion]),
+            retrieve_mapping=MagicMock()
+        )(task)()
+        self.assertEqual(_ctx.instance.update.call_count, 1)
+        self.assertEqual(_ctx.instance.runtime_properties['step'], 2)
+        _ctx.logger.debug.assert_any_call(
+            'Saved 2 of 3 runtime properties updates.')
+
+        # Outside of a resource task the update is sent right away.
+        utils.update_instance()
+        self.assertEqual(_ctx.instance.update.call_count, 2)
+
+    def test_resource_task_flushes_updates_on_retry(self):
+        _, _ctx = self._prepare_master_node()
+        _ctx.instance.update = MagicMock()
+        defintion = KubernetesResourceDefinition(
+            **_ctx.node.properties['definition'])
+
+        def task(**_):
+            utils.update_instance()
+            utils.update_instance()
+            utils.flush_instance_updates()
+            self.assertEqual(_ctx.instance.update.call_count, 1)
+            utils.update_instance()
+            raise OperationRetry('retry')
+
+        with self.assertRaises(OperationRetry):
+            decorators.resource_task(
+                retrieve_resources_definitions=MagicMock(
+                    return_value=[defintion]),
+                retrieve_mapping=MagicMock()
+            )(task)()
+        self.assertEqual(_ctx.instance.update.call_count, 2)
+
+    def test_resource_task_definitions_generator(self):
+        _, _ctx = self._prepare_master_node()
+        _ctx.instance.update = MagicMock()
+        paths = []
+
+        def definitions(**_):
+            for name in ['a', 'b']:
+                yield KubernetesResourceDefinition(
+                    kind='Pod', apiVersion='v1', metadata={'name': name})
+
+        def task(**kwargs):
+            paths.append(kwargs['file']['resource_path'])
+
+        decorators.resource_task(
+            retrieve_resources_definitions=definitions,
+            retrieve_mapping=MagicMock()
+        )(task)(file={'resource_path': 'pods.yaml'})
+        self.assertEqual(paths, ['pods.yaml#0', 'pods.yaml#1'])
+
+    def _prepare_parallel_node(self, concurrency=4):
+        _, _ctx = self._prepare_master_node()
+        _ctx.node.properties['resources_concurrency'] = concurrency
+        _ctx.instance._runtime_properties = DirtyTrackingDict(
+            _ctx.instance.runtime_properties)
+        _ctx.instance.update = MagicMock()
+        return _ctx
+
+    @staticmethod
+    def _pods(*names):
+        def definitions(**_):
+            return [KubernetesResourceDefinition(
+                kind='Pod', apiVersion='v1', metadata={'name': name})
+                for name in names]
+        return definitions
+
+    def test_resource_task_parallel_documents(self):
+        _ctx = self._prepare_parallel_node()
+        # every document waits for all the others, so they must run at once
+        barrier = threading.Barrier(3, timeout=5)
+
+        def task(**kwargs):
+            barrier.wait()
+            path = kwargs['file']['resource_path']
+            ctx_proxy.instance.runtime_properties['kubernetes'][path] = \
+                kwargs['resource_definition'].metadata['name']
+            # a property that none of the documents started with
+            utils.store_definition_fingerprint(kwargs['resource_definition'])
+            return path
+
+        results = decorators._multidefinition_resource_task(
+            task, self._pods('a', 'b', 'c')(),
+            {'file': {'resource_path': 'pods.yaml'}}, MagicMock())
+        self.assertEqual(results,
+                         ['pods.yaml#0', 'pods.yaml#1', 'pods.yaml#2'])
+        self.assertEqual(
+            _ctx.instance.runtime_properties['kubernetes'],
+            {'metadata': {'name': 'kubernetes_id'},
+             'pods.yaml#0': 'a', 'pods.yaml#1': 'b', 'pods.yaml#2': 'c'})
+        self.assertEqual(
+            sorted(_ctx.instance.runtime_properties[
+                '__resource_fingerprints']),
+            ['v1/Pod//a', 'v1/Pod//b', 'v1/Pod//c'])
+        self.assertNotIn('__perform_task', _ctx.instance.runtime_properties)
+        _ctx.instance.update.assert_called_once()
+
+    def test_resource_task_parallel_merge_order(self):
+        _ctx = self._prepare_parallel_node()
+        _ctx.instance.runtime_properties['__queue'] = ['x']
+
+        def task(**kwargs):
+            name = kwargs['resource_definition'].metadata['name']
+            # the last document finishes first
+            time.sleep(0.05 if name == 'a' else 0)
+            ctx_proxy.instance.runtime_properties[
+                '__queue'].append(name)
+            ctx_proxy.instance.runtime_properties['last'] = name
+
+        decorators._multidefinition_resource_task(
+            task, self._pods('a', 'b')(),
+            {'file': {'resource_path': 'pods.yaml'}}, MagicMock())
+        self.assertEqual(
+            _ctx.instance.runtime_properties['__queue'],
+            ['x', 'a', 'b'])
+        self.assertEqual(_ctx.instance.runtime_properties['last'], 'b')
+
+    def test_resource_task_parallel_merge_new_keys(self):
+        _ctx = self._prepare_parallel_node()
+        # a fresh install, no document has stored anything yet
+        del _ctx.instance.runtime_properties['kubernetes']
+        self.assertNotIn('__resource_definitions',
+                         _ctx.instance.runtime_properties)
+
+        def task(**kwargs):
+            definition = kwargs['resource_definition']
+            # the first document finishes last
+            time.sleep(0.05 if definition.metadata['name'] == 'a' else 0)
+            path = kwargs['file']['resource_path']
+            ctx_proxy.instance.runtime_properties.setdefault(
+                'kubernetes', {})[path] = definition.metadata['name']
+            utils.store_resource_definition(definition, path)
+
+        decorators._multidefinition_resource_task(
+            task, self._pods('a', 'b', 'c')(),
+            {'file': {'resource_path': 'pods.yaml'}}, MagicMock())
+        runtime_properties = _ctx.instance.runtime_properties
+        self.assertEqual(
+            runtime_properties['kubernetes'],
+            {'pods.yaml#0': 'a', 'pods.yaml#1': 'b', 'pods.yaml#2': 'c'})
+        # every document started from the same order, they are numbered
+        # again in the order of the documents
+        self.assertEqual(
+            {key: (stored['order'], stored['path']) for key, stored in
+             runtime_properties['__resource_definitions'].items()},
+            {'Pod/default/a': (0, 'pods.yaml#0'),
+             'Pod/default/b': (1, 'pods.yaml#1'),
+             'Pod/default/c': (2, 'pods.yaml#2')})
+        self.assertEqual(
+            runtime_properties['__resource_definitions_order'], 3)
+        self.assertEqual(
+            runtime_properties['__resource_definitions_last'],
+            'Pod/default/c')
+
+    def test_resource_task_parallel_errors(self):
+        _ctx = self._prepare_parallel_node()
+
+        def task(**kwargs):
+            name = kwargs['resource_definition'].metadata['name']
+            if name != 'a':
+                raise NonRecoverableError('{0} failed'.format(name))
+            ctx_proxy.instance.runtime_properties['kubernetes'][
+                kwargs['file']['resource_path']] = name
+
+        with patch.object(_ctx.logger, 'error') as log_error:
+            with self.assertRaisesRegex(NonRecoverableError, 'b failed'):
+                decorators._multidefinition_resource_task(
+                    task, self._pods('a', 'b', 'c')(),
+                    {'file': {'resource_path': 'pods.yaml'}}, MagicMock())
+        self.assertEqual(log_error.call_count, 2)
+        self.assertIn('Pod c (pods.yaml#2)', log_error.call_args[0][0])
+        # the documents that were applied are still recorded
+        self.assertEqual(
+            _ctx.instance.runtime_properties['kubernetes']['pods.yaml#0'],
+            'a')
+
+    def test_resource_task_dependency_order(self):
+        _, _ctx = self._prepare_master_node()
+        _ctx.instance.update = MagicMock()
+        calls = []
+
+        def definitions(**_):
+            return [KubernetesResourceDefinition(
+                kind='Pod', apiVersion='v1',
+                metadata={'name': 'a', 'namespace': 'apps'}),
+                KubernetesResourceDefinition(
+                    kind='Namespace', apiVersion='v1',
+                    metadata={'name': 'apps'})]
+
+        def task(**kwargs):
+            calls.append((kwargs['resource_definition'].kind,
+                          kwargs['file']['resource_path']))
+
+        for order in [planner.APPLY_ORDER, planner.DELETE_ORDER]:
+            decorators.resource_task(
+                retrieve_resources_definitions=definitions,
+                retrieve_mapping=MagicMock(),
+                dependency_order=order
+            )(task)(file={'resource_path': 'pods.yaml'})
+        self.assertEqual(calls, [('Namespace', 'pods.yaml#1'),
+                                 ('Pod', 'pods.yaml#0'),
+                                 ('Pod', 'pods.yaml#0'),
+                                 ('Namespace', 'pods.yaml#1')])
+
     def test_retrieve_master(self):
         managed_master_node, _ctx = self._prepare_master_node()
         self.assertEqual(decorators._retrieve_master(_ctx.instance),
@@ -306,6 +540,33 @@ class TestDecorators(unittest.TestCase):
 
         decorators.with_kubernetes_client(function)()
 
+    @patch('cloudify_kubernetes.utils.AKSConnection')
+    @patch('cloudify_kubernetes.decorators.'
+           'setup_configuration')
+    def test_with_kubernetes_client_reuses_api_client(self, setup, aks):
+        _, _ctx = self._prepare_master_node()
+        setup.side_effect = lambda **_: MagicMock()
+        aks.has_service_account.return_value = None
+        _ctx.download_resource = MagicMock(return_value="downloaded_resource")
+        api_clients = []
+
+        def function(client, **kwargs):
+            api_clients.append(client.client)
+
+        decorators.with_kubernetes_client(function)()
+        decorators.with_kubernetes_client(function)()
+        self.assertEqual(setup.call_count, 1)
+        self.assertIs(api_clients[0], api_clients[1])
+
+        def unauthorized(client, **kwargs):
+            raise NonRecoverableError('(401) Reason: Unauthorized')
+
+        with self.assertRaises(NonRecoverableError):
+            decorators.with_kubernetes_client(unauthorized)()
+        decorators.with_kubernetes_client(function)()
+        self.assertEqual(setup.call_count, 2)
+        self.assertIsNot(api_clients[0], api_clients[2])
+
     @patch('cloudify_kubernetes.utils.AKSConnection')
     def test_with_kubernetes_client_certificate_files(self, aks):
         _, _ctx = self._prepare_master_node(with_relationship_to_master=False,
@@ -0,0 +1,106 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+from tempfile import NamedTemporaryFile
+
+from mock import MagicMock, patch
+
+from ..k8s import cache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        instance = cache.LRUCache(max_size=2, ttl=60)
+        instance.set('a', 1)
+        instance.set('b', 2)
+        self.assertEqual(instance.get('a'), 1)
+        instance.set('c', 3)
+        self.assertEqual(len(instance), 2)
+        self.assertIsNone(instance.get('b'))
+        self.assertEqual(instance.get('a'), 1)
+        self.assertEqual(instance.get('c'), 3)
+
+    def test_ttl(self):
+        now = [100]
+        instance = cache.LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+        instance.set('a', 1)
+        now[0] = 105
+        self.assertEqual(instance.get('a'), 1)
+        now[0] = 111
+        self.assertIsNone(instance.get('a'))
+        self.assertEqual(len(instance), 0)
+
+    def test_invalidate(self):
+        instance = cache.LRUCache(max_size=2, ttl=60)
+        instance.set('a', 1)
+        instance.invalidate('a')
+        instance.invalidate('missing')
+        self.assertIsNone(instance.get('a'))
+
+
+class TestApiClientCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestApiClientCache, self).setUp()
+        cache._API_CLIENTS.clear()
+
+    def _write(self, content):
+        f = NamedTemporaryFile('w', delete=False)
+        f.write(content)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_api_client_key(self):
+        # Temporary files with the same certificate share a key.
+        self.assertEqual(
+            cache.api_client_key(host='a', ca_file=self._write('cert')),
+            cache.api_client_key(host='a', ca_file=self._write('cert')))
+        self.assertNotEqual(
+            cache.api_client_key(host='a', ca_file=self._write('cert')),
+            cache.api_client_key(host='a', ca_file=self._write('other')))
+        self.assertNotEqual(
+            cache.api_client_key(host='a', token='x'),
+            cache.api_client_key(host='a', token='y'))
+        self.assertEqual(
+            cache.api_client_key(kubeconfig={'a': 1, 'b': 2}),
+            cache.api_client_key(kubeconfig={'b': 2, 'a': 1}))
+        self.assertIsNone(cache.api_client_key(kubeconfig=object()))
+
+    def test_get_api_client(self):
+        factory = MagicMock(side_effect=lambda **_: MagicMock())
+        first, key = cache.get_api_client(factory, host='a', token='x')
+        second, _ = cache.get_api_client(factory, host='a', token='x')
+        self.assertIs(first, second)
+        other, _ = cache.get_api_client(factory, host='b', token='x')
+        self.assertIsNot(first, other)
+        cache.invalidate_api_client(key)
+        third, _ = cache.get_api_client(factory, host='a', token='x')
+        self.assertIsNot(first, third)
+        self.assertEqual(factory.call_count, 3)
+
+    def test_get_api_client_not_hashable(self):
+        factory = MagicMock(side_effect=lambda **_: MagicMock())
+        with patch.object(cache, 'api_client_key', return_value=None):
+            first, key = cache.get_api_client(factory, host='a')
+            second, _ = cache.get_api_client(factory, host='a')
+        self.assertIsNone(key)
+        self.assertIsNot(first, second)
+
+
+if __name__ == '__main__':
+    unittest.main()
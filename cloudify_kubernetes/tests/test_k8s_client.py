@@ -12,13 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import json
 import unittest
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from kubernetes.client.rest import ApiException
 from kubernetes import client as kubernetes_client
 
 from .._compat import text_type
+from ..k8s import mapping
+from ..k8s import client as client_module
+from ..k8s.mapping import get_mapping, KubernetesSingleOperationApiMapping
 from ..k8s import (
     CloudifyKubernetesClient,
     KuberentesApiOperationError,
@@ -130,6 +135,49 @@ class TestClient(unittest.TestCase):
             "attribute"
         )
 
+    def test_prepare_api_method_cached(self):
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient())
+        with patch('cloudify_kubernetes.k8s.client.getfullargspec',
+                   wraps=client_module.getfullargspec) as argspec:
+            first = instance._prepare_api_method(
+                'CoreV1Api', 'read_namespaced_pod')
+            second = instance._prepare_api_method(
+                'CoreV1Api', 'read_namespaced_pod')
+        self.assertIs(first, second)
+        self.assertEqual(first[1], ['name', 'namespace'])
+        self.assertEqual(argspec.call_count, 1)
+
+    def test_prepare_api_method_repeated(self):
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient())
+        with patch.object(instance, '_create_api_method',
+                          wraps=instance._create_api_method) as create:
+            for _ in range(1000):
+                instance._prepare_api_method(
+                    'CoreV1Api', 'read_namespaced_pod')
+                instance._prepare_api_method(
+                    'CoreV1Api', 'patch_namespaced_pod',
+                    'application/apply-patch+yaml')
+        # every method is created once, one per content type
+        self.assertEqual(create.call_count, 2)
+        self.assertEqual(len(instance._api_methods), 2)
+
+    def test_prepare_delete_options_resource_cached(self):
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient())
+        definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata=METADATA)
+        options = {'grace_period_seconds': 5, 'namespace': 'default'}
+        for _ in range(2):
+            result = instance._prepare_delete_options_resource(
+                'V1DeleteOptions', definition, options)
+            self.assertEqual(result.grace_period_seconds, 5)
+        self.assertEqual(
+            instance._delete_options_attributes,
+            {'V1DeleteOptions': {'grace_period_seconds': True,
+                                 'namespace': False}})
+
     def test_execute_ApiException(self):
         logger = MagicMock()
         api_configuration = MagicMock()
@@ -312,6 +360,316 @@ class TestClient(unittest.TestCase):
             ('resource_id', 'b')
         )
 
+    def test_read_resource_reuses_reads(self):
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient())
+        calls = []
+
+        def execute_with_alternates(operation, mapping, options, key, *_):
+            calls.append(key)
+            if key == 'read' and calls.count('read') == 1:
+                raise KuberentesApiOperationError(
+                    'Exception during Kubernetes API call: (404)')
+            return key
+
+        instance.execute_with_alternates = execute_with_alternates
+        instance._prepare_payload = MagicMock()
+        definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+        for _ in range(2):
+            with self.assertRaises(KuberentesApiOperationError):
+                instance.read_resource(
+                    MagicMock(), definition, {'namespace': 'default'})
+        self.assertEqual(
+            instance.create_resource(
+                MagicMock(), definition, {'namespace': 'default'}),
+            'create')
+        for _ in range(3):
+            self.assertEqual(
+                instance.read_resource(
+                    MagicMock(), definition, {'namespace': 'default'}),
+                'read')
+        # another namespace is another resource
+        instance.read_resource(
+            MagicMock(), definition, {'namespace': 'other'})
+        instance.delete_resource(
+            get_mapping('Pod'), definition, 'foo', {'namespace': 'default'})
+        instance.read_resource(
+            MagicMock(), definition, {'namespace': 'default'})
+        self.assertEqual(calls, ['read', 'create', 'read', 'read',
+                                 'delete', 'read'])
+        self.assertEqual(instance.reads_avoided, 3)
+
+    def test_execute_with_alternates_remembers_alternate(self):
+        mismatch = KuberentesApiOperationError(
+            'The API version in the data (v1beta1) does not match the '
+            'expected API version (v1)')
+        calls = []
+
+        def prepare_operation(operation, api, method, **_):
+            return api
+
+        def execute(api, options):
+            calls.append(api)
+            if api != 'WorkingApi':
+                raise mismatch
+            return 'result'
+
+        api_mapping = MagicMock()
+        api_mapping.read = KubernetesSingleOperationApiMapping(
+            api='PrimaryApi', method='read_namespaced_thing')
+        alternates = [
+            KubernetesSingleOperationApiMapping(
+                api='BrokenApi', method='read_namespaced_thing'),
+            KubernetesSingleOperationApiMapping(
+                api='WorkingApi', method='read_namespaced_thing'),
+        ]
+        instance = CloudifyKubernetesClient(
+            MagicMock(),
+            api_client=MagicMock(configuration=MagicMock(host='cluster-a')))
+        instance._prepare_operation = prepare_operation
+        instance._execute = execute
+        with patch.dict(mapping._PREFERRED_ALTERNATES, clear=True), \
+                patch.object(KubernetesSingleOperationApiMapping,
+                             'get_apis_with_method',
+                             return_value=alternates):
+            self.assertEqual(
+                instance.execute_with_alternates(
+                    None, api_mapping, {}, 'read'), 'result')
+            self.assertEqual(calls, ['PrimaryApi', 'BrokenApi', 'WorkingApi'])
+            del calls[:]
+            self.assertEqual(
+                instance.execute_with_alternates(
+                    None, api_mapping, {}, 'read'), 'result')
+            self.assertEqual(calls, ['WorkingApi'])
+            # Another cluster does not share the preference.
+            del calls[:]
+            instance.client.configuration.host = 'cluster-b'
+            instance.execute_with_alternates(None, api_mapping, {}, 'read')
+            self.assertEqual(calls, ['PrimaryApi', 'BrokenApi', 'WorkingApi'])
+
+    def test_execute_with_alternates_api_version(self):
+        calls = []
+
+        def prepare_operation(operation, api, method, **_):
+            return api
+
+        def execute(api, options):
+            calls.append(api)
+            return 'result'
+
+        api_mapping = MagicMock()
+        api_mapping.read = KubernetesSingleOperationApiMapping(
+            api='AutoscalingV1Api',
+            method='read_namespaced_horizontal_pod_autoscaler')
+        definition = KubernetesResourceDefinition(
+            kind='HorizontalPodAutoscaler', apiVersion='autoscaling/v2',
+            metadata={'name': 'foo'})
+        instance = CloudifyKubernetesClient(
+            MagicMock(),
+            api_client=MagicMock(configuration=MagicMock(host='cluster-a')))
+        instance._prepare_operation = prepare_operation
+        instance._execute = execute
+        with patch.dict(mapping._PREFERRED_ALTERNATES, clear=True):
+            instance.execute_with_alternates(
+                None, api_mapping, {}, 'read', definition)
+            self.assertEqual(calls, ['AutoscalingV2Api'])
+            # the cluster does not serve the version of the definition
+            del calls[:]
+            instance.discovery = MagicMock()
+            instance.discovery.api_versions.return_value = ['autoscaling/v1']
+            instance.execute_with_alternates(
+                None, api_mapping, {}, 'read', definition)
+            self.assertEqual(calls, ['AutoscalingV1Api'])
+
+    def test_create_cluster_scoped_custom_object(self):
+        body = {'kind': 'Widget', 'apiVersion': 'example.com/v1',
+                'metadata': {'name': 'foo'}}
+        response = MagicMock(status=201, data=json.dumps(body))
+        discovery = MagicMock()
+        discovery.resolve.return_value = {
+            'group': 'example.com', 'version': 'v1', 'plural': 'widgets',
+            'namespaced': False}
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient(),
+            discovery=discovery)
+        # no cloudify-crd-* annotations
+        definition = KubernetesResourceDefinition(**body)
+        with patch.object(kubernetes_client.ApiClient, 'request',
+                          return_value=response) as request:
+            instance.create_resource(
+                get_mapping('CustomObjectsApi'), definition,
+                {'namespace': 'default'})
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(request.call_args[0][:2],
+                         ('POST', 'http://localhost/apis/example.com/v1/'
+                                  'widgets'))
+        discovery.resolve.assert_called_with('example.com/v1', 'Widget')
+
+    def _watch(self, raw_json):
+        events = [
+            {'type': 'ADDED', 'object': {
+                'kind': 'Pod', 'apiVersion': 'v1',
+                'metadata': {'name': 'foo', 'namespace': 'default'},
+                'status': {'phase': 'Pending'}}},
+            {'type': 'MODIFIED', 'object': {
+                'kind': 'Pod', 'apiVersion': 'v1',
+                'metadata': {'name': 'foo', 'namespace': 'default'},
+                'status': {'phase': 'Running'}}},
+        ]
+        response = MagicMock()
+        response.stream.return_value = [
+            (json.dumps(event) + '\n').encode('utf-8') for event in events]
+        instance = CloudifyKubernetesClient(
+            MagicMock(),
+            api_client=kubernetes_client.ApiClient(),
+            raw_json=raw_json)
+        definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+        with patch.object(kubernetes_client.ApiClient, 'request',
+                          return_value=response) as request:
+            result = [(event['type'], event['object'].status.phase)
+                      for event in instance.watch_resource(
+                          get_mapping('Pod'), definition,
+                          {'namespace': 'default'}, 30)]
+        self.assertEqual(result, [('ADDED', 'Pending'),
+                                  ('MODIFIED', 'Running')])
+        method, url = request.call_args[0][:2]
+        self.assertEqual(method, 'GET')
+        self.assertEqual(url.split('?')[0],
+                         'http://localhost/api/v1/namespaces/default/pods')
+        self.assertEqual(
+            dict(request.call_args[1]['query_params']),
+            {'fieldSelector': 'metadata.name=foo',
+             'timeoutSeconds': 30,
+             'watch': True})
+        self.assertEqual(request.call_args[1]['_request_timeout'], 35)
+
+    def test_watch_resource(self):
+        self._watch(raw_json=False)
+        # the watch decodes models itself
+        self._watch(raw_json=True)
+
+    def test_read_resource_status(self):
+        body = {'kind': 'Deployment', 'apiVersion': 'apps/v1',
+                'metadata': {'name': 'foo', 'namespace': 'default'},
+                'status': {'replicas': 2}}
+        response = MagicMock(status=200, data=json.dumps(body))
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient())
+        definition = KubernetesResourceDefinition(
+            kind='Deployment', apiVersion='apps/v1',
+            metadata={'name': 'foo'})
+        with patch.object(kubernetes_client.ApiClient, 'request',
+                          return_value=response) as request:
+            result = instance.read_resource_status(
+                get_mapping('Deployment'), definition,
+                {'namespace': 'default'})
+        self.assertEqual(result.status.replicas, 2)
+        self.assertEqual(
+            request.call_args[0][1],
+            'http://localhost/apis/apps/v1/namespaces/default/deployments/'
+            'foo/status')
+
+    def test_read_resource_status_forbidden(self):
+        body = {'kind': 'Deployment', 'apiVersion': 'apps/v1',
+                'metadata': {'name': 'foo', 'namespace': 'default'},
+                'status': {'replicas': 2}}
+        response = MagicMock(status=200, data=json.dumps(body))
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient())
+        definition = KubernetesResourceDefinition(
+            kind='Deployment', apiVersion='apps/v1',
+            metadata={'name': 'foo'})
+        # RBAC allows get on deployments, but not on deployments/status
+        with patch.object(kubernetes_client.ApiClient, 'request',
+                          side_effect=[ApiException(status=403), response,
+                                       response]) as request:
+            for _ in range(2):
+                instance._reads.clear()
+                result = instance.read_resource_status(
+                    get_mapping('Deployment'), definition,
+                    {'namespace': 'default'})
+                self.assertEqual(result.status.replicas, 2)
+        self.assertEqual(
+            [c[0][1] for c in request.call_args_list],
+            ['http://localhost/apis/apps/v1/namespaces/default/deployments/'
+             'foo/status'] +
+            ['http://localhost/apis/apps/v1/namespaces/default/deployments/'
+             'foo'] * 2)
+
+    def _apply(self, kind, definition, options):
+        response = MagicMock(
+            status=200, data=json.dumps(definition).encode('utf-8'))
+        response.getheader.return_value = 'application/json'
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient())
+        with patch.object(instance.client.rest_client.pool_manager,
+                          'request', return_value=response) as request:
+            instance.apply_resource(
+                get_mapping(kind),
+                KubernetesResourceDefinition(**copy.deepcopy(definition)),
+                options, field_manager='cloudify', force=True)
+        method, url = request.call_args[0]
+        self.assertEqual(method, 'PATCH')
+        self.assertEqual(request.call_args[1]['headers']['Content-Type'],
+                         'application/apply-patch+yaml')
+        self.assertEqual(json.loads(request.call_args[1]['body']),
+                         definition)
+        # other requests are not affected
+        self.assertEqual(
+            instance.client.select_header_content_type(
+                ['application/json']),
+            'application/json')
+        return url
+
+    def test_apply_resource(self):
+        url = self._apply('Deployment', {
+            'apiVersion': 'apps/v1',
+            'kind': 'Deployment',
+            'metadata': {'name': 'foo', 'namespace': 'default'},
+            'spec': {'replicas': 2,
+                     'selector': {'matchLabels': {'app': 'foo'}},
+                     'template': {'metadata': {'labels': {'app': 'foo'}}}},
+        }, {'namespace': 'default'})
+        self.assertEqual(
+            url,
+            'http://localhost/apis/apps/v1/namespaces/default/deployments/'
+            'foo?fieldManager=cloudify&force=True')
+
+    def test_apply_custom_resource(self):
+        url = self._apply('CustomObjectsApi', {
+            'apiVersion': 'example.com/v1',
+            'kind': 'Widget',
+            'metadata': {'name': 'foo'},
+            'spec': {'size': 2},
+        }, {'namespace': 'default', 'group': 'example.com',
+            'version': 'v1', 'plural': 'widgets'})
+        self.assertEqual(
+            url,
+            'http://localhost/apis/example.com/v1/namespaces/default/widgets/'
+            'foo?fieldManager=cloudify&force=True')
+
+    def test_watch_resource_ApiException(self):
+        instance = CloudifyKubernetesClient(
+            MagicMock(), api_client=kubernetes_client.ApiClient())
+        definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+        with patch.object(kubernetes_client.ApiClient, 'request',
+                          side_effect=ApiException(status=403)):
+            with self.assertRaises(KuberentesApiOperationError):
+                list(instance.watch_resource(
+                    get_mapping('Pod'), definition,
+                    {'namespace': 'default'}, 30))
+
+    def test_get_watch_method_name(self):
+        self.assertEqual(
+            mapping.get_watch_method_name('read_namespaced_pod'),
+            'list_namespaced_pod')
+        self.assertEqual(
+            mapping.get_watch_method_name('get_cluster_custom_object'),
+            'list_cluster_custom_object')
+
 
 class TestKubernetesResourceDefinition(unittest.TestCase):
     def test_KubernetesResourceDefinitionGeneral(self):
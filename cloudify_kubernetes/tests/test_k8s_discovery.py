@@ -0,0 +1,185 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock, patch
+
+from kubernetes.client.rest import ApiException
+
+from ..k8s import discovery
+from ..k8s.cache import LRUCache
+from ..k8s.discovery import ApiDiscovery, AGGREGATED_DISCOVERY_KIND
+
+
+def _aggregated(groups):
+    return {'kind': AGGREGATED_DISCOVERY_KIND, 'items': [
+        {'metadata': {'name': group}, 'versions': [
+            {'version': version, 'resources': [
+                {'resource': plural,
+                 'responseKind': {'group': group, 'version': version,
+                                  'kind': kind},
+                 'scope': scope}
+                for kind, plural, scope in resources]}]}
+        for group, version, resources in groups]}
+
+
+AGGREGATED_RESPONSES = {
+    '/api': _aggregated([('', 'v1', [('Pod', 'pods', 'Namespaced')])]),
+    '/apis': _aggregated([
+        ('apps', 'v1', [('Deployment', 'deployments', 'Namespaced')]),
+        ('example.com', 'v1', [('Widget', 'widgets', 'Cluster')])]),
+}
+
+LEGACY_RESPONSES = {
+    '/api': {'kind': 'APIVersions', 'versions': ['v1']},
+    '/apis': {'kind': 'APIGroupList', 'groups': [
+        {'name': 'apps', 'versions': [{'groupVersion': 'apps/v1',
+                                       'version': 'v1'}]}]},
+    '/api/v1': {'kind': 'APIResourceList', 'resources': [
+        {'name': 'pods', 'kind': 'Pod', 'namespaced': True},
+        {'name': 'pods/status', 'kind': 'Pod', 'namespaced': True},
+        {'name': 'nodes', 'kind': 'Node', 'namespaced': False}]},
+    '/apis/apps/v1': {'kind': 'APIResourceList', 'resources': [
+        {'name': 'deployments', 'kind': 'Deployment', 'namespaced': True}]},
+}
+
+
+class TestApiDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        super(TestApiDiscovery, self).setUp()
+        self.now = 1000
+        patcher = patch.object(
+            discovery, '_DISCOVERIES',
+            LRUCache(discovery.DISCOVERY_CACHE_SIZE,
+                     discovery.DISCOVERY_CACHE_TTL,
+                     clock=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def _api_client(self, responses):
+        api_client = MagicMock()
+        api_client.configuration.host = 'https://cluster-a'
+
+        def call_api(path, *_, **__):
+            if path not in responses:
+                raise ApiException(status=503)
+            return MagicMock(data=json.dumps(responses[path]).encode('utf-8'))
+
+        api_client.call_api.side_effect = call_api
+        return api_client
+
+    def _discovery(self, api_client):
+        return ApiDiscovery(api_client, cache_dir=self.cache_dir, ttl=600,
+                            clock=lambda: self.now)
+
+    def _paths(self, api_client):
+        return [c[0][0] for c in api_client.call_api.call_args_list]
+
+    def test_aggregated_discovery(self):
+        api_client = self._api_client(AGGREGATED_RESPONSES)
+        instance = self._discovery(api_client)
+        self.assertEqual(
+            instance.resolve('example.com/v1', 'Widget'),
+            {'group': 'example.com', 'version': 'v1', 'plural': 'widgets',
+             'namespaced': False})
+        self.assertEqual(instance.resolve('v1', 'Pod'),
+                         {'group': '', 'version': 'v1', 'plural': 'pods',
+                          'namespaced': True})
+        self.assertEqual(instance.api_versions('Deployment'), ['apps/v1'])
+        self.assertEqual(self._paths(api_client), ['/api', '/apis'])
+        self.assertIn(
+            'as=APIGroupDiscoveryList',
+            api_client.call_api.call_args[1]['header_params']['Accept'])
+
+    def test_legacy_discovery(self):
+        api_client = self._api_client(LEGACY_RESPONSES)
+        instance = self._discovery(api_client)
+        self.assertEqual(instance.resolve('v1', 'Node')['namespaced'], False)
+        self.assertEqual(instance.resolve('apps/v1', 'Deployment')['plural'],
+                         'deployments')
+        self.assertEqual(self._paths(api_client),
+                         ['/api', '/apis', '/api/v1', '/apis/apps/v1'])
+
+    def test_legacy_discovery_unavailable_group(self):
+        responses = dict(LEGACY_RESPONSES)
+        metrics = {'name': 'metrics.k8s.io', 'versions': [
+            {'groupVersion': 'metrics.k8s.io/v1beta1', 'version': 'v1beta1'}]}
+        responses['/apis'] = {
+            'kind': 'APIGroupList',
+            'groups': [metrics] + LEGACY_RESPONSES['/apis']['groups']}
+        api_client = self._api_client(responses)
+        # the metrics APIService answers with a 503
+        instance = self._discovery(api_client)
+        self.assertEqual(instance.resolve('apps/v1', 'Deployment')['plural'],
+                         'deployments')
+        self.assertIsNone(instance.resolve('metrics.k8s.io/v1beta1',
+                                           'PodMetrics'))
+
+    def test_memory_cache_ttl(self):
+        api_client = self._api_client(AGGREGATED_RESPONSES)
+        for _ in range(2):
+            self.assertTrue(ApiDiscovery(
+                api_client, ttl=60, clock=lambda: self.now).resolve(
+                'v1', 'Pod'))
+        self.assertEqual(self._paths(api_client), ['/api', '/apis'])
+        self.now += 61
+        ApiDiscovery(api_client, ttl=60, clock=lambda: self.now).resolve(
+            'v1', 'Pod')
+        self.assertEqual(self._paths(api_client),
+                         ['/api', '/apis', '/api', '/apis'])
+
+    def test_disk_cache(self):
+        self._discovery(self._api_client(AGGREGATED_RESPONSES)).resolve(
+            'v1', 'Pod')
+        # another operation, in a new process
+        discovery._DISCOVERIES.clear()
+        api_client = self._api_client(AGGREGATED_RESPONSES)
+        self.assertTrue(self._discovery(api_client).resolve('v1', 'Pod'))
+        self.assertEqual(self._paths(api_client), [])
+        # the cache expires
+        discovery._DISCOVERIES.clear()
+        self.now += 601
+        self.assertTrue(self._discovery(api_client).resolve('v1', 'Pod'))
+        self.assertEqual(self._paths(api_client), ['/api', '/apis'])
+
+    def test_refresh_once(self):
+        responses = dict(AGGREGATED_RESPONSES)
+        responses['/apis'] = _aggregated([])
+        api_client = self._api_client(responses)
+        instance = self._discovery(api_client)
+        instance.resolve('v1', 'Pod')
+        # the custom resource definition is created after the discovery
+        responses['/apis'] = AGGREGATED_RESPONSES['/apis']
+        self.assertTrue(instance.resolve('example.com/v1', 'Widget'))
+        self.assertIsNone(instance.resolve('example.com/v1', 'Gadget'))
+        self.assertEqual(self._paths(api_client),
+                         ['/api', '/apis', '/api', '/apis'])
+
+    def test_failed_discovery(self):
+        api_client = self._api_client(AGGREGATED_RESPONSES)
+        api_client.call_api.side_effect = Exception('Forbidden')
+        instance = self._discovery(api_client)
+        self.assertIsNone(instance.resolve('v1', 'Pod'))
+        self.assertEqual(instance.api_versions('Pod'), [])
+        self.assertEqual(api_client.call_api.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
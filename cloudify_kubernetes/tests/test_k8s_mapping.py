@@ -12,11 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
 import unittest
+import importlib
+from mock import patch
 
+from ..k8s import mapping
 from ..k8s.exceptions import KuberentesMappingNotFoundError
 from ..k8s.mapping import (
     get_mapping,
+    get_api_class_name,
+    get_api_and_method_for,
     KubernetesApiMapping,
     KubernetesSingleOperationApiMapping)
 
@@ -168,6 +174,16 @@ class TestMapping(unittest.TestCase):
         self.assertEqual(instance.create, 'create')
         self.assertEqual(instance.delete, 'delete')
 
+    def test_KubernetesApiMapping_list(self):
+        instance = get_mapping('Pod')
+        self.assertEqual(instance.list.method, 'list_namespaced_pod')
+        self.assertEqual(instance.delete_collection.method,
+                         'delete_collection_namespaced_pod')
+
+        instance = get_mapping('Namespace')
+        self.assertEqual(instance.list.method, 'list_namespace')
+        self.assertIsNone(instance.delete_collection)
+
     def test_KubernetesApiMapping_from_dict(self):
         instance = KubernetesApiMapping(
             read={
@@ -236,6 +252,33 @@ class TestMapping(unittest.TestCase):
         self.assertEqual(instance.delete.method, 'd_method')
         self.assertEqual(instance.delete.payload, 'd_payload')
 
+    def test_KubernetesApiMapping_read_status(self):
+        self.assertEqual(
+            get_mapping('Deployment').read_status.method,
+            'read_namespaced_deployment_status')
+        self.assertEqual(
+            get_mapping('PersistentVolume').read_status.method,
+            'read_persistent_volume_status')
+        # there is no status subresource
+        self.assertIsNone(get_mapping('ConfigMap').read_status)
+        instance = KubernetesApiMapping(
+            read={'api': 'r_api', 'method': 'r_method'},
+            create='create',
+            update='update',
+            delete='delete',
+            read_status={'api': 's_api', 'method': 's_method'}
+        )
+        self.assertEqual(instance.read_status.api, 's_api')
+        self.assertEqual(instance.read_status.method, 's_method')
+
+    def test_KubernetesApiMapping_apply(self):
+        self.assertEqual(get_mapping('Deployment').apply.method,
+                         'patch_namespaced_deployment')
+        self.assertEqual(get_mapping('CustomObjectsApi').apply.method,
+                         'patch_namespaced_custom_object')
+        self.assertEqual(get_mapping('Deployment').apply.api,
+                         get_mapping('Deployment').update.api)
+
     def test_get_mapping(self):
         mapping = get_mapping('Pod')
 
@@ -290,6 +333,82 @@ class TestMapping(unittest.TestCase):
         self.assertEqual(mapping.delete.method, 'delete_namespaced_pod')
         self.assertEqual(mapping.delete.payload, 'V1DeleteOptions')
 
+    def test_get_api_class_name(self):
+        self.assertEqual(get_api_class_name('v1'), 'CoreV1Api')
+        self.assertEqual(get_api_class_name('apps/v1'), 'AppsV1Api')
+        self.assertEqual(get_api_class_name('rbac.authorization.k8s.io/v1'),
+                         'RbacAuthorizationV1Api')
+        self.assertEqual(
+            get_api_class_name('flowcontrol.apiserver.k8s.io/v1beta3'),
+            'FlowcontrolApiserverV1beta3Api')
+
+    def test_get_api_and_method_for(self):
+        create = KubernetesSingleOperationApiMapping(
+            api='AutoscalingV1Api',
+            method='create_namespaced_horizontal_pod_autoscaler',
+            payload='V1HorizontalPodAutoscaler')
+        self.assertIs(get_api_and_method_for(create, 'autoscaling/v1'),
+                      create)
+        resolved = get_api_and_method_for(create, 'autoscaling/v2')
+        self.assertEqual((resolved.api, resolved.method, resolved.payload),
+                         ('AutoscalingV2Api',
+                          'create_namespaced_horizontal_pod_autoscaler',
+                          'V2HorizontalPodAutoscaler'))
+        # the library has no class for the API version
+        self.assertIsNone(get_api_and_method_for(create, 'example.com/v1'))
+
+    def test_get_kubernetes_apis_scanned_once(self):
+        with patch.object(mapping, '_KUBERNETES_APIS', None), \
+                patch.object(mapping, '_scan_kubernetes_apis',
+                             wraps=mapping._scan_kubernetes_apis) as scan:
+            for _ in range(10):
+                instance = KubernetesSingleOperationApiMapping(
+                    api='CoreV1Api',
+                    method='read_namespaced_pod',
+                )
+            scan.assert_not_called()
+            self.assertIn('CoreV1Api', instance.kubernetes_apis)
+            self.assertIn('AppsV1Api', instance.get_kubernetes_apis())
+            self.assertIs(instance.kubernetes_apis,
+                          mapping.get_kubernetes_apis())
+            self.assertEqual(scan.call_count, 1)
+
+    def test_alternates_index(self):
+        with patch.dict(mapping._ALTERNATES_INDEX, clear=True), \
+                patch.object(mapping, 'get_method_payload_name',
+                             wraps=mapping.get_method_payload_name) as parse:
+            instance = KubernetesSingleOperationApiMapping(
+                api='NetworkingV1Api',
+                method='create_namespaced_ingress',
+                payload='V1Ingress'
+            )
+            first = [(a.api, a.payload) for a in instance.alternates]
+            parsed = parse.call_count
+            second = [(a.api, a.payload) for a in instance.alternates]
+            self.assertEqual(first, second)
+            self.assertEqual(parse.call_count, parsed)
+            self.assertIn('create_namespaced_ingress',
+                          mapping._ALTERNATES_INDEX)
+            self.assertNotIn('NetworkingV1Api', [a for a, _ in first])
+        read = KubernetesSingleOperationApiMapping(
+            api='CoreV1Api', method='read_namespaced_pod')
+        for alternate in read.alternates:
+            self.assertIsNone(alternate.payload)
+
+    def test_import_does_not_scan_apis(self):
+        # Importing the operations must not scan the Kubernetes APIs, only
+        # the mapping module is kept, so that the scan can be watched.
+        modules = dict(
+            (name, module) for name, module in sys.modules.items()
+            if name.split('.')[0] != 'cloudify_kubernetes' or
+            name.startswith('cloudify_kubernetes.tests') or
+            name == mapping.__name__)
+        with patch.dict(sys.modules, modules, clear=True):
+            with patch.object(mapping, '_KUBERNETES_APIS', None):
+                with patch.object(mapping, '_scan_kubernetes_apis') as scan:
+                    importlib.import_module('cloudify_kubernetes.tasks')
+                    scan.assert_not_called()
+
     def test_get_mapping_no_entry(self):
         with self.assertRaises(KuberentesMappingNotFoundError):
             get_mapping('BlahBlahBlah')
@@ -0,0 +1,105 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from ..k8s import KubernetesResourceDefinition
+from ..k8s.planner import plan_waves, DELETE_ORDER
+
+
+def _definition(kind, name, namespace=None, api_version='v1', **kwargs):
+    metadata = {'name': name}
+    if namespace:
+        metadata['namespace'] = namespace
+    return KubernetesResourceDefinition(
+        kind=kind, apiVersion=api_version, metadata=metadata, **kwargs)
+
+
+def _deployment(name, namespace, pod_spec):
+    return _definition('Deployment', name, namespace,
+                       api_version='apps/v1',
+                       spec={'template': {'spec': pod_spec}})
+
+
+class TestPlanner(unittest.TestCase):
+
+    def test_independent_definitions(self):
+        definitions = [_definition('ConfigMap', 'a'),
+                       _definition('Service', 'b'),
+                       _definition('Secret', 'c')]
+        self.assertEqual(plan_waves(definitions), [[0, 1, 2]])
+
+    def test_mixed_file(self):
+        definitions = [
+            _deployment('app', 'apps', {
+                'serviceAccountName': 'runner',
+                'containers': [{
+                    'name': 'app',
+                    'envFrom': [{'configMapRef': {'name': 'settings'}}],
+                }],
+            }),
+            _definition('CustomObject', 'widget', 'apps',
+                        api_version='example.com/v1'),
+            _definition('RoleBinding', 'runner', 'apps',
+                        api_version='rbac.authorization.k8s.io/v1',
+                        roleRef={'kind': 'Role', 'name': 'reader'},
+                        subjects=[{'kind': 'ServiceAccount',
+                                   'name': 'runner'}]),
+            _definition('Role', 'reader', 'apps',
+                        api_version='rbac.authorization.k8s.io/v1'),
+            _definition('ConfigMap', 'settings', 'apps'),
+            _definition('ServiceAccount', 'runner', 'apps'),
+            _definition('CustomResourceDefinition', 'widgets.example.com',
+                        api_version='apiextensions.k8s.io/v1',
+                        spec={'group': 'example.com',
+                              'names': {'kind': 'CustomObject'}}),
+            _definition('Namespace', 'apps'),
+        ]
+        self.assertEqual(plan_waves(definitions),
+                         [[6, 7], [1, 3, 4, 5], [0, 2]])
+
+    def test_delete_order(self):
+        definitions = [_definition('Namespace', 'apps'),
+                       _definition('ServiceAccount', 'runner', 'apps'),
+                       _deployment('app', 'apps',
+                                   {'serviceAccountName': 'runner'})]
+        self.assertEqual(plan_waves(definitions), [[0], [1], [2]])
+        self.assertEqual(plan_waves(definitions, DELETE_ORDER),
+                         [[2], [1], [0]])
+
+    def test_references_in_other_namespace(self):
+        definitions = [_deployment('app', 'first',
+                                   {'serviceAccountName': 'runner'}),
+                       _definition('ServiceAccount', 'runner', 'second')]
+        self.assertEqual(plan_waves(definitions), [[0, 1]])
+
+    def test_storage_class(self):
+        definitions = [
+            _definition('PersistentVolumeClaim', 'data', 'apps',
+                        spec={'storageClassName': 'fast'}),
+            _definition('StorageClass', 'fast',
+                        api_version='storage.k8s.io/v1'),
+        ]
+        self.assertEqual(plan_waves(definitions), [[1], [0]])
+
+    def test_cycle(self):
+        definitions = [_definition('ConfigMap', 'settings'),
+                       _definition('Namespace', 'a', 'b'),
+                       _definition('Namespace', 'b', 'a')]
+        # the rest of the documents keep the order of the file
+        self.assertEqual(plan_waves(definitions), [[0], [1, 2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
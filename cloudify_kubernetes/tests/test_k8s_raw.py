@@ -0,0 +1,209 @@
+# Copyright (c) 2017-2023 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import json
+import unittest
+from mock import MagicMock, patch
+
+from kubernetes import client as kubernetes_client
+
+from ..utils import JsonCleanuper
+from ..k8s import raw
+from ..k8s import CloudifyKubernetesClient, KubernetesResourceDefinition
+from ..k8s.mapping import get_mapping
+
+TIMESTAMP = '2023-01-01T10:00:00Z'
+
+
+def _metadata(name, namespace='default'):
+    return {
+        'name': name,
+        'namespace': namespace,
+        'uid': '9b2c6bd4-4d8c-4a3e-9b1d-{0:012d}'.format(len(name)),
+        'resourceVersion': '12345',
+        'generation': 3,
+        'creationTimestamp': TIMESTAMP,
+        'labels': {'app': name, 'tier': 'backend'},
+        'annotations': {'deployment.kubernetes.io/revision': '3'},
+        'managedFields': [{
+            'manager': 'kubectl',
+            'operation': 'Update',
+            'apiVersion': 'apps/v1',
+            'time': TIMESTAMP,
+            'fieldsType': 'FieldsV1',
+            'fieldsV1': {'f:spec': {'f:replicas': {}}},
+        }],
+    }
+
+
+def _container(index):
+    return {
+        'name': 'container-{0}'.format(index),
+        'image': 'registry.local/app:{0}'.format(index),
+        'imagePullPolicy': 'IfNotPresent',
+        'ports': [{'containerPort': 8000 + index, 'protocol': 'TCP'}],
+        'env': [{'name': 'VAR_{0}'.format(i), 'value': str(i)}
+                for i in range(20)],
+        'resources': {'limits': {'cpu': '500m', 'memory': '128Mi'},
+                      'requests': {'cpu': '250m', 'memory': '64Mi'}},
+        'readinessProbe': {'httpGet': {'path': '/', 'port': 'http'},
+                           'periodSeconds': 10},
+    }
+
+
+def _deployment(name, containers=30):
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': _metadata(name),
+        'spec': {
+            'replicas': 3,
+            'selector': {'matchLabels': {'app': name}},
+            'template': {
+                'metadata': {'labels': {'app': name}},
+                'spec': {'containers': [_container(i)
+                                        for i in range(containers)]},
+            },
+        },
+        'status': {
+            'observedGeneration': 3,
+            'replicas': 3,
+            'readyReplicas': 3,
+            'conditions': [{'type': 'Available', 'status': 'True',
+                            'lastUpdateTime': TIMESTAMP,
+                            'lastTransitionTime': TIMESTAMP}],
+        },
+    }
+
+
+def _config_map(name, keys=500):
+    return {
+        'apiVersion': 'v1',
+        'kind': 'ConfigMap',
+        'metadata': _metadata(name),
+        'data': {'key-{0}'.format(i): 'value ' * 20 for i in range(keys)},
+    }
+
+
+def _service(name):
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Service',
+        'metadata': _metadata(name),
+        'spec': {
+            'type': 'ClusterIP',
+            'selector': {'app': name},
+            'ports': [{'name': 'port-{0}'.format(i), 'port': 80 + i,
+                       'targetPort': 'http', 'protocol': 'TCP'}
+                      for i in range(50)],
+        },
+    }
+
+
+CORPUS = [
+    ('Deployment', _deployment('large-deployment')),
+    ('ConfigMap', _config_map('large-config-map')),
+    ('Service', _service('large-service')),
+]
+
+
+class FakeResponse(object):
+
+    def __init__(self, body):
+        self.data = json.dumps(body).encode('utf-8')
+        self.status = 200
+
+    def getheader(self, *_):
+        return 'application/json'
+
+    def getheaders(self):
+        return {'Content-Type': 'application/json'}
+
+
+class TestRaw(unittest.TestCase):
+
+    def _read(self, kind, body, raw_json):
+        instance = CloudifyKubernetesClient(
+            MagicMock(),
+            api_client=kubernetes_client.ApiClient(),
+            raw_json=raw_json)
+        definition = KubernetesResourceDefinition(**copy.deepcopy(body))
+        with patch.object(kubernetes_client.ApiClient, 'request',
+                          side_effect=lambda *_, **__: FakeResponse(body)):
+            return JsonCleanuper(instance.read_resource(
+                get_mapping(kind), definition,
+                {'namespace': 'default'})).to_dict()
+
+    def test_get_response_type(self):
+        self.assertEqual(
+            raw.get_response_type(
+                kubernetes_client.AppsV1Api.read_namespaced_deployment),
+            'V1Deployment')
+        self.assertEqual(
+            raw.get_response_type(
+                kubernetes_client.CustomObjectsApi.
+                get_namespaced_custom_object),
+            'object')
+
+    def test_payload_from_definition(self):
+        api_client = kubernetes_client.ApiClient()
+        for kind, body in CORPUS:
+            definition = KubernetesResourceDefinition(
+                **copy.deepcopy(body))
+            class_name = get_mapping(kind).create.payload
+            self.assertEqual(
+                raw.payload_from_definition(class_name, definition),
+                api_client.sanitize_for_serialization(getattr(
+                    kubernetes_client, class_name)(**vars(definition))))
+
+    def test_read_matches_models(self):
+        for kind, body in CORPUS:
+            self.assertEqual(self._read(kind, body, True),
+                             self._read(kind, body, False))
+
+    def test_raw_api_method(self):
+        calls = []
+
+        def read_namespaced_config_map(**kwargs):
+            """read the specified ConfigMap
+
+            :param str name: name of the ConfigMap (required)
+            :return: V1ConfigMap
+            """
+            calls.append(kwargs)
+            return FakeResponse(_config_map('small', keys=1))
+
+        result = raw.RawApiMethod(read_namespaced_config_map)(name='small')
+        self.assertEqual(calls, [{'_preload_content': False,
+                                  'name': 'small'}])
+        self.assertEqual(result['api_version'], 'v1')
+        self.assertEqual(result['data'], {'key-0': 'value ' * 20})
+        self.assertEqual(result['metadata']['resource_version'], '12345')
+
+    def test_read_skips_models(self):
+        deserialize = kubernetes_client.ApiClient.deserialize
+        for kind, body in CORPUS:
+            with patch.object(kubernetes_client.ApiClient, 'deserialize',
+                              autospec=True,
+                              side_effect=deserialize) as models:
+                self._read(kind, body, False)
+                self.assertEqual(models.call_count, 1)
+                # the response is only parsed as JSON
+                self._read(kind, body, True)
+                self.assertEqual(models.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,9 +13,10 @@
 # limitations under the License.
 
 import json
+import yaml
 import unittest
 from datetime import datetime
-from mock import MagicMock, Mock, patch, mock_open
+from mock import ANY, MagicMock, Mock, patch, mock_open
 
 from cloudify.state import current_ctx
 from cloudify.mocks import MockCloudifyContext
@@ -29,7 +30,11 @@ from .. import tasks
 from ..utils import (
     retrieve_id,
     JsonCleanuper,
+    get_instance_labels,
+    definition_fingerprint,
     retrieve_last_create_path,
+    store_definition_fingerprint,
+    remove_definition_fingerprint,
     INSTANCE_RUNTIME_PROPERTY_KUBERNETES)
 
 from ..k8s.mapping import (
@@ -76,6 +81,21 @@ spec:
       privileged: true
 """
 
+
+def _file_fingerprints(data):
+    fingerprints = {}
+    for document in yaml.safe_load_all(data):
+        key = '{apiVersion}/{kind}//{name}'.format(
+            name=document['metadata']['name'], **document)
+        document['metadata']['labels'] = get_instance_labels()
+        fingerprints[key] = {
+            'fingerprint': definition_fingerprint(
+                KubernetesResourceDefinition(**document)),
+            'skipped_updates': 0,
+        }
+    return fingerprints
+
+
 RESPONSE = json.loads(json.dumps({
     'kind': 'Pod',
     'apiVersion': 'v1',
@@ -447,6 +467,71 @@ class TestTasks(unittest.TestCase):
             "Status is {'phase': 'Unknown'}"
         )
 
+    def test_do_resource_status_wait(self):
+        _, _ctx = self._prepare_master_node()
+        _ctx.node.properties['status_watch_timeout'] = 30
+        resource_definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+        client = MagicMock()
+        client.watch_resource.return_value = iter([
+            {'type': 'MODIFIED', 'object': {'status': {'phase': 'Pending'}}},
+            {'type': 'MODIFIED', 'object': {'status': {'phase': 'Running'}}},
+        ])
+        self.assertTrue(tasks._do_resource_status_wait(
+            client, MagicMock(), resource_definition,
+            {'status': {'phase': 'Pending'}}))
+        self.assertEqual(client.watch_resource.call_count, 1)
+        self.assertEqual(client.watch_resource.call_args[0][3], 30)
+
+    def test_do_resource_status_wait_timeout(self):
+        _, _ctx = self._prepare_master_node()
+        resource_definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+        client = MagicMock()
+        # no time budget, retry the operation
+        with self.assertRaises(OperationRetry):
+            tasks._do_resource_status_wait(
+                client, MagicMock(), resource_definition,
+                {'status': {'phase': 'Pending'}})
+        client.watch_resource.assert_not_called()
+
+        _ctx.node.properties['status_watch_timeout'] = 1
+        client.watch_resource.return_value = iter([
+            {'type': 'MODIFIED', 'object': {'status': {'phase': 'Unknown'}}},
+        ])
+        with patch('cloudify_kubernetes.tasks.api_calls.time') as time:
+            time.time.side_effect = [100, 102]
+            with self.assertRaises(OperationRetry) as error:
+                tasks._do_resource_status_wait(
+                    client, MagicMock(), resource_definition,
+                    {'status': {'phase': 'Pending'}})
+        self.assertEqual(text_type(error.exception),
+                         "Status is {'phase': 'Unknown'}")
+
+    def test_healable_resource_check_status_reads_status(self):
+        self._prepare_master_node()
+        client = MagicMock()
+        client.read_resource_status.return_value = {
+            'metadata': {'name': 'foo', 'managed_fields': [{}],
+                         'annotations': {'a': 'b'}},
+            'spec': {'replicas': 1, 'template': {'spec': {}}},
+            'status': {'unavailable_replicas': None},
+        }
+        with patch('cloudify_kubernetes.tasks.api_calls.'
+                   '_do_resource_status_check',
+                   return_value=True) as status_check:
+            tasks.operations._healable_resource_check_status(
+                client, MagicMock(),
+                KubernetesResourceDefinition(
+                    kind='Deployment', apiVersion='apps/v1',
+                    metadata={'name': 'foo'}))
+        client.read_resource.assert_not_called()
+        status_check.assert_called_once_with('Deployment', {
+            'metadata': {'name': 'foo'},
+            'spec': {'replicas': 1},
+            'status': {'unavailable_replicas': None},
+        })
+
     @patch('cloudify_kubernetes.tasks.operations.'
            '_healable_resource_check_status')
     def test_resource_check_status_fail_heal(self, fn):
@@ -480,6 +565,35 @@ class TestTasks(unittest.TestCase):
             "Status is {'phase': 'Failed'}"
         )
 
+    def test_do_resource_status_check_pod_terminal_state(self):
+        self._prepare_master_node()
+        for phase, key, reason in [
+                ('Pending', 'container_statuses', 'ImagePullBackOff'),
+                ('Running', 'container_statuses', 'CrashLoopBackOff'),
+                ('Pending', 'init_container_statuses',
+                 'CreateContainerConfigError')]:
+            with self.assertRaises(NonRecoverableError) as error:
+                tasks._do_resource_status_check("Pod", {
+                    'status': {
+                        'phase': phase,
+                        key: [{'name': 'app', 'state': {'waiting': {
+                            'reason': reason,
+                            'message': 'Details'}}}]}
+                })
+            self.assertEqual(
+                text_type(error.exception),
+                'Container app is waiting with reason {0}: '
+                'Details'.format(reason))
+
+        # waiting to be created is not terminal
+        with self.assertRaises(OperationRetry):
+            tasks._do_resource_status_check("Pod", {
+                'status': {
+                    'phase': 'Pending',
+                    'container_statuses': [{'name': 'app', 'state': {
+                        'waiting': {'reason': 'ContainerCreating'}}}]}
+            })
+
     def test_do_resource_status_check_service_fail(self):
         # raise exception on empty balancer
         _, _ctx = self._prepare_master_node()
@@ -501,6 +615,136 @@ class TestTasks(unittest.TestCase):
                        'unavailable_replicas': None}
         })
 
+    def test_do_resource_status_check_deployment_failed(self):
+        self._prepare_master_node()
+        with self.assertRaises(NonRecoverableError) as error:
+            tasks._do_resource_status_check("Deployment", {
+                'status': {'conditions': [
+                    {'type': 'Available', 'status': 'False'},
+                    {'type': 'Progressing', 'status': 'False',
+                     'reason': 'ProgressDeadlineExceeded',
+                     'message': 'ReplicaSet "app" has timed out progressing.'}
+                ], 'unavailable_replicas': 1}
+            })
+        self.assertEqual(
+            text_type(error.exception),
+            'The rollout has failed with reason ProgressDeadlineExceeded: '
+            'ReplicaSet "app" has timed out progressing.')
+
+    def test_do_resource_status_check_deployment_stale_condition(self):
+        self._prepare_master_node()
+        failed = {'type': 'Progressing', 'status': 'False',
+                  'reason': 'ProgressDeadlineExceeded', 'message': 'old'}
+        resource = {
+            'metadata': {'name': 'app', 'generation': 5},
+            'spec': {'replicas': 1},
+            'status': {'observed_generation': 4, 'conditions': [failed]}}
+        # the condition is from the rollout of generation 4
+        with self.assertRaises(OperationRetry) as error:
+            tasks._do_resource_status_check("Deployment", resource)
+        self.assertEqual(
+            text_type(error.exception),
+            'Waiting for generation 5 to be observed, the observed '
+            'generation is 4.')
+        resource['status']['observed_generation'] = 5
+        with self.assertRaises(NonRecoverableError):
+            tasks._do_resource_status_check("Deployment", resource)
+
+    def test_do_resource_status_check_deployment_rollout(self):
+        self._prepare_master_node()
+        metadata = {'name': 'app', 'generation': 4}
+        spec = {'replicas': 10}
+        with self.assertRaises(OperationRetry) as error:
+            tasks._do_resource_status_check("Deployment", {
+                'metadata': metadata, 'spec': spec,
+                'status': {'observed_generation': 3, 'replicas': 10,
+                           'updated_replicas': 10, 'ready_replicas': 10,
+                           'available_replicas': 10}
+            })
+        self.assertEqual(
+            text_type(error.exception),
+            'Waiting for generation 4 to be observed, the observed '
+            'generation is 3.')
+        with self.assertRaises(OperationRetry) as error:
+            tasks._do_resource_status_check("Deployment", {
+                'metadata': metadata, 'spec': spec,
+                'status': {'observed_generation': 4, 'replicas': 12,
+                           'updated_replicas': 7, 'ready_replicas': 9,
+                           'available_replicas': 9}
+            })
+        self.assertEqual(
+            text_type(error.exception),
+            'Rollout in progress: 7/10 updated, 9/10 ready, '
+            '9/10 available.')
+        with self.assertRaises(OperationRetry) as error:
+            tasks._do_resource_status_check("Deployment", {
+                'metadata': metadata, 'spec': spec,
+                'status': {'observed_generation': 4, 'replicas': 11,
+                           'updated_replicas': 10, 'ready_replicas': 10,
+                           'available_replicas': 10}
+            })
+        self.assertEqual(
+            text_type(error.exception),
+            'Rollout in progress: 1 old replicas are pending termination.')
+        self.assertTrue(tasks._do_resource_status_check("Deployment", {
+            'metadata': metadata, 'spec': spec,
+            'status': {'observed_generation': 4, 'replicas': 10,
+                       'updated_replicas': 10, 'ready_replicas': 10,
+                       'available_replicas': 10}
+        }))
+
+    def test_do_resource_status_check_stateful_set_rollout(self):
+        self._prepare_master_node()
+        resource = {
+            'metadata': {'name': 'db', 'generation': 2},
+            'spec': {'replicas': 3, 'update_strategy': {
+                'type': 'RollingUpdate',
+                'rolling_update': {'partition': 0}}},
+            'status': {'observed_generation': 2, 'replicas': 3,
+                       'updated_replicas': 3, 'ready_replicas': 3,
+                       'current_revision': 'db-1', 'update_revision': 'db-2'}
+        }
+        # ready replicas of the previous revision are not enough
+        with self.assertRaises(OperationRetry) as error:
+            tasks._do_resource_status_check("StatefulSet", resource)
+        self.assertEqual(
+            text_type(error.exception),
+            'Rollout in progress: waiting for revision db-2, the current '
+            'revision is db-1.')
+        resource['status']['current_revision'] = 'db-2'
+        self.assertTrue(
+            tasks._do_resource_status_check("StatefulSet", resource))
+        # only the pods from the partition are updated
+        resource['spec']['update_strategy']['rolling_update'][
+            'partition'] = 2
+        resource['status'].update(updated_replicas=0,
+                                  current_revision='db-1')
+        with self.assertRaises(OperationRetry) as error:
+            tasks._do_resource_status_check("StatefulSet", resource)
+        self.assertEqual(text_type(error.exception),
+                         'Rollout in progress: 0/1 updated, 3/3 ready.')
+        resource['status']['updated_replicas'] = 1
+        self.assertTrue(
+            tasks._do_resource_status_check("StatefulSet", resource))
+
+    def test_do_resource_status_check_daemon_set_rollout(self):
+        self._prepare_master_node()
+        resource = {
+            'metadata': {'name': 'agent', 'generation': 5},
+            'status': {'observed_generation': 5,
+                       'desired_number_scheduled': 4,
+                       'updated_number_scheduled': 2,
+                       'number_available': 4,
+                       'number_unavailable': None}
+        }
+        with self.assertRaises(OperationRetry) as error:
+            tasks._do_resource_status_check("DaemonSet", resource)
+        self.assertEqual(text_type(error.exception),
+                         'Rollout in progress: 2/4 updated, 4/4 available.')
+        resource['status']['updated_number_scheduled'] = 4
+        self.assertTrue(
+            tasks._do_resource_status_check("DaemonSet", resource))
+
     def test_do_resource_status_check_persistent_volume_claim(self):
         self._prepare_master_node()
         tasks._do_resource_status_check("PersistentVolumeClaim", {
@@ -701,10 +945,13 @@ class TestTasks(unittest.TestCase):
             def to_dict(self):
                 return expected_value
 
+        fake_resource_definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+
         class _UpdateResource(object):
             def __call__(self, api_mapping, resource_definition, options):
                 if api_mapping == 'fake_api_mapping':
-                    if resource_definition == 'fake_resource_definition':
+                    if resource_definition is fake_resource_definition:
                         if options['first'] == 'second':
                             return _Result()
 
@@ -714,7 +961,7 @@ class TestTasks(unittest.TestCase):
         result = tasks._do_resource_update(
             client=client,
             api_mapping='fake_api_mapping',
-            resource_definition='fake_resource_definition'
+            resource_definition=fake_resource_definition
         )
 
         self.assertEqual(result, expected_value)
@@ -820,6 +1067,404 @@ class TestTasks(unittest.TestCase):
                 resource_definition=MagicMock()
             )
 
+    def test_do_resource_create_optimistic(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        _ctx.node.properties['optimistic_create'] = True
+        resource_definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+        client = MagicMock()
+        client.create_resource.return_value = {'metadata': {'name': 'foo'}}
+
+        # no read before the create
+        self.assertIsNone(tasks.api_calls.
+                          _check_if_resource_exists_before_create(
+                              client, MagicMock(), resource_definition))
+        _ctx.instance.runtime_properties['__perform_task'] = True
+        self.assertEqual(
+            tasks._do_resource_create(
+                client, MagicMock(), resource_definition),
+            {'metadata': {'name': 'foo'}})
+        client.read_resource.assert_not_called()
+
+        # the resource exists, read it and use it
+        client.create_resource.side_effect = KuberentesApiOperationError(
+            'Exception during Kubernetes API call: (409)\n'
+            'Reason: Conflict')
+        client.read_resource.return_value = {'metadata': {'name': 'foo',
+                                                          'uid': '1'}}
+        self.assertEqual(
+            tasks._do_resource_create(
+                client, MagicMock(), resource_definition),
+            {'metadata': {'name': 'foo', 'uid': '1'}})
+        self.assertFalse(_ctx.instance.runtime_properties['__perform_task'])
+
+        # without optimistic create, a conflict is an error
+        _ctx.node.properties['optimistic_create'] = False
+        _ctx.instance.runtime_properties['__perform_task'] = True
+        with self.assertRaises(KuberentesApiOperationError):
+            tasks._do_resource_create(
+                client, MagicMock(), resource_definition)
+        tasks.api_calls._check_if_resource_exists_before_create(
+            client, MagicMock(), resource_definition)
+        self.assertEqual(client.read_resource.call_count, 2)
+
+    def test_do_resource_update_unchanged(self):
+        _, _ctx = self._prepare_master_node()
+        _ctx.node.properties['skip_unchanged_updates'] = True
+        _ctx.instance._runtime_properties = DirtyTrackingDict({})
+        resource_definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'},
+            spec={'containers': [{'name': 'a', 'image': 'a:1'}]})
+        client = MagicMock()
+        client.update_resource.return_value = {'metadata': {'name': 'foo'}}
+
+        tasks._do_resource_update(client, MagicMock(), resource_definition)
+        self.assertEqual(client.update_resource.call_count, 1)
+        fingerprints = _ctx.instance.runtime_properties[
+            '__resource_fingerprints']
+        self.assertEqual(list(fingerprints), ['v1/Pod//foo'])
+        # stored by the operation
+        _ctx.instance.runtime_properties['kubernetes'] = {
+            'metadata': {'name': 'foo'}}
+
+        # the same definition, with its keys in another order
+        client.reset_mock()
+        unchanged = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'},
+            spec={'containers': [{'image': 'a:1', 'name': 'a'}]})
+        self.assertEqual(
+            tasks.api_calls._check_if_resource_exists_before_update(
+                client, MagicMock(), unchanged),
+            {'metadata': {'name': 'foo'}})
+        self.assertEqual(
+            tasks._do_resource_update(client, MagicMock(), unchanged),
+            {'metadata': {'name': 'foo'}})
+        client.read_resource.assert_not_called()
+        client.update_resource.assert_not_called()
+        self.assertEqual(
+            _ctx.instance.runtime_properties['__resource_fingerprints'][
+                'v1/Pod//foo']['skipped_updates'], 1)
+
+        # a changed definition is updated
+        changed = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'},
+            spec={'containers': [{'name': 'a', 'image': 'a:2'}]})
+        tasks._do_resource_update(client, MagicMock(), changed)
+        self.assertEqual(client.update_resource.call_count, 1)
+
+        # and so is every definition, when the check is turned off
+        _ctx.node.properties['skip_unchanged_updates'] = False
+        tasks._do_resource_update(client, MagicMock(), changed)
+        self.assertEqual(client.update_resource.call_count, 2)
+
+    def _bulk_documents(self, client, *names):
+        documents = []
+        for index, (kind, name) in enumerate(names):
+            definition = KubernetesResourceDefinition(
+                kind=kind, apiVersion='v1', metadata={'name': name})
+            documents.append((definition, {
+                'client': client,
+                'api_mapping': SUPPORTED_API_MAPPINGS[kind],
+                'resource_definition': definition,
+                'file': {'resource_path': 'bulk.yaml#{0}'.format(index)},
+            }))
+        return documents
+
+    @staticmethod
+    def _listed(*names, **kwargs):
+        return {'items': [
+            dict({'metadata': {'name': name,
+                               'labels': get_instance_labels()}}, **kwargs)
+            for name in names]}
+
+    def test_bulk_check_status(self):
+        self._prepare_master_node(create=True)
+        client = MagicMock()
+        client.list_resources.return_value = self._listed(
+            'a', 'b', status={'phase': 'Running'})
+        documents = self._bulk_documents(
+            client, ('Pod', 'a'), ('Pod', 'b'), ('Pod', 'c'))
+        apply_document = MagicMock()
+
+        tasks.bulk.bulk_check_status([documents], apply_document)
+        # one request for the kind
+        client.list_resources.assert_called_once_with(
+            SUPPORTED_API_MAPPINGS['Pod'], documents[0][0], ANY,
+            'cloudify.co/deployment-id=test_name,'
+            'cloudify.co/node-instance-id=test_id')
+        client.read_resource.assert_not_called()
+        # the missing resource is checked on its own
+        apply_document.assert_called_once_with(*documents[2])
+
+    def test_bulk_check_status_not_ready(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        client = MagicMock()
+        listed = self._listed('a', 'b', spec={'replicas': 2})
+        for item, updated in zip(listed['items'], [2, 1]):
+            item['metadata']['generation'] = 1
+            item['status'] = {
+                'observed_generation': 1, 'replicas': 2,
+                'updated_replicas': updated, 'ready_replicas': updated,
+                'available_replicas': updated}
+        client.list_resources.return_value = listed
+        documents = self._bulk_documents(
+            client, ('Deployment', 'a'), ('Deployment', 'b'))
+        apply_document = MagicMock()
+
+        tasks.bulk.bulk_check_status([documents], apply_document)
+        # the rollout in progress is checked, and watched, on its own
+        apply_document.assert_called_once_with(*documents[1])
+
+        # the listed resources are enough when the status is not validated
+        _ctx.node.properties['validate_resource_status'] = False
+        apply_document.reset_mock()
+        tasks.bulk.bulk_check_status([documents], apply_document)
+        apply_document.assert_not_called()
+
+    def test_bulk_delete(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        client = MagicMock()
+        documents = self._bulk_documents(
+            client, ('Pod', 'a'), ('Pod', 'b'), ('ConfigMap', 'c'))
+        for index, (definition, _) in enumerate(documents):
+            metadata = dict(definition.metadata,
+                            labels=get_instance_labels())
+            _ctx.instance.runtime_properties.setdefault('kubernetes', {})[
+                'bulk.yaml#{0}'.format(index)] = {
+                'kind': definition.kind, 'metadata': metadata}
+        apply_document = MagicMock()
+
+        # the config map is already gone
+        client.list_resources.side_effect = [
+            self._listed('a', 'b'), self._listed()]
+        with self.assertRaises(OperationRetry):
+            tasks.bulk.bulk_delete([documents], apply_document)
+        client.delete_resources.assert_called_once_with(
+            SUPPORTED_API_MAPPINGS['Pod'], documents[0][0], ANY, ANY)
+        client.delete_resource.assert_not_called()
+        apply_document.assert_not_called()
+
+        # the pods are gone too
+        client.list_resources.side_effect = None
+        client.list_resources.return_value = self._listed()
+        tasks.bulk.bulk_delete([documents], apply_document)
+        self.assertEqual(client.delete_resources.call_count, 1)
+        self.assertNotIn('kubernetes', _ctx.instance.runtime_properties)
+
+    def test_bulk_delete_one_by_one(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        client = MagicMock()
+        documents = self._bulk_documents(client, ('Pod', 'a'), ('Pod', 'b'))
+        apply_document = MagicMock()
+        # another resource of the node instance has the labels, and b
+        # was created before the labels
+        client.list_resources.return_value = self._listed('a', 'other')
+        tasks.bulk.bulk_delete([documents], apply_document)
+        client.delete_resources.assert_not_called()
+        self.assertEqual(apply_document.call_count, 2)
+
+    @patch('cloudify_kubernetes.tasks.anchor.get_mapping',
+           SUPPORTED_API_MAPPINGS.get)
+    def test_add_owner_reference(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        _ctx.node.properties['owner_anchor'] = {'enabled': True}
+        client = MagicMock()
+        client.create_resource.return_value = {'metadata': {'uid': 'u1'}}
+        documents = self._bulk_documents(
+            client, ('Pod', 'a'), ('ConfigMap', 'b'), ('Namespace', 'c'))
+        for definition, kwargs in documents:
+            tasks.anchor.add_owner_reference(
+                client, kwargs['api_mapping'], definition,
+                file=kwargs['file'])
+
+        # one anchor for the namespace
+        client.create_resource.assert_called_once_with(
+            SUPPORTED_API_MAPPINGS['ConfigMap'], ANY,
+            {'namespace': 'default'})
+        anchor = client.create_resource.call_args[0][1]
+        self.assertEqual(anchor.metadata['name'],
+                         'cloudify-owner-test-name-test-id')
+        self.assertEqual(
+            _ctx.instance.runtime_properties['__owner_anchors'],
+            {'default': {'name': 'cloudify-owner-test-name-test-id',
+                         'uid': 'u1'}})
+        for definition, _ in documents[:2]:
+            self.assertEqual(definition.metadata['ownerReferences'], [{
+                'apiVersion': 'v1',
+                'kind': 'ConfigMap',
+                'name': 'cloudify-owner-test-name-test-id',
+                'uid': 'u1',
+                'blockOwnerDeletion': True,
+            }])
+        # cluster scoped resources can not have a namespaced owner
+        self.assertNotIn('ownerReferences', documents[2][0].metadata)
+
+    @patch('cloudify_kubernetes.tasks.anchor.get_mapping',
+           SUPPORTED_API_MAPPINGS.get)
+    def test_cascade_delete(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        _ctx.instance.runtime_properties['__owner_anchors'] = {
+            'default': {'name': 'cloudify-owner-test-name-test-id',
+                        'uid': 'u1'}}
+        client = MagicMock()
+        client.read_resource.return_value = {
+            'metadata': {'resource_version': '7'}}
+        client.watch_resource.return_value = [
+            {'type': 'MODIFIED', 'object': {}},
+            {'type': 'DELETED', 'object': {}}]
+        documents = self._bulk_documents(
+            client, ('Pod', 'a'), ('Pod', 'b'), ('Namespace', 'default'))
+        for index, (definition, _) in enumerate(documents):
+            metadata = dict(definition.metadata)
+            if index < 2:
+                metadata['owner_references'] = [{'uid': 'u1'}]
+            _ctx.instance.runtime_properties.setdefault('kubernetes', {})[
+                'bulk.yaml#{0}'.format(index)] = {
+                'kind': definition.kind, 'metadata': metadata}
+
+        waves = tasks.anchor.cascade_delete(
+            [documents[:2], documents[2:]])
+        # one delete of the anchor, and one watch
+        client.delete_resource.assert_called_once_with(
+            SUPPORTED_API_MAPPINGS['ConfigMap'], ANY,
+            'cloudify-owner-test-name-test-id',
+            {'namespace': 'default', 'propagation_policy': 'Foreground'})
+        client.watch_resource.assert_called_once_with(
+            SUPPORTED_API_MAPPINGS['ConfigMap'], ANY,
+            {'namespace': 'default', 'resource_version': '7'}, ANY)
+        # the namespace is not owned, it is deleted on its own
+        self.assertEqual(waves, [documents[2:]])
+        self.assertEqual(
+            list(_ctx.instance.runtime_properties['kubernetes']),
+            ['bulk.yaml#2'])
+        self.assertTrue(_ctx.instance.runtime_properties[
+            '__owner_anchors']['default']['deleted'])
+
+        # the other files of the node do not delete the anchor again
+        tasks.anchor.cascade_delete([documents[2:]])
+        self.assertEqual(client.delete_resource.call_count, 1)
+
+    @patch('cloudify_kubernetes.tasks.anchor.get_mapping',
+           SUPPORTED_API_MAPPINGS.get)
+    def test_cascade_delete_retry(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        _ctx.node.properties['owner_anchor'] = {
+            'enabled': True, 'delete_timeout': 0}
+        _ctx.instance.runtime_properties['__owner_anchors'] = {
+            'default': {'name': 'cloudify-owner-test-name-test-id',
+                        'uid': 'u1'}}
+        client = MagicMock()
+        client.read_resource.return_value = {'metadata': {}}
+        documents = self._bulk_documents(client, ('Pod', 'a'))
+        with self.assertRaises(OperationRetry):
+            tasks.anchor.cascade_delete([documents])
+        self.assertNotIn('deleted', _ctx.instance.runtime_properties[
+            '__owner_anchors']['default'])
+
+    @patch('cloudify_kubernetes.tasks.anchor.get_mapping',
+           SUPPORTED_API_MAPPINGS.get)
+    def test_prepare_pvc_delete(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        _ctx.node.properties['owner_anchor'] = {'enabled': True}
+        # the anchors were deleted before the resources they do not own
+        _ctx.instance.runtime_properties['__owner_anchors'] = {
+            'default': {'name': 'cloudify-owner-test-name-test-id',
+                        'uid': 'u1', 'deleted': True}}
+        client = MagicMock()
+        definition = KubernetesResourceDefinition(
+            kind='PersistentVolumeClaim', apiVersion='v1',
+            metadata={'name': 'data',
+                      'finalizers': ['kubernetes.io/pvc-protection']},
+            spec={'accessModes': ['ReadWriteOnce']})
+        mapping = SUPPORTED_API_MAPPINGS['PersistentVolumeClaim']
+
+        tasks.operations.prepare_pvc_delete(
+            definition, client, mapping,
+            {'file': {'resource_path': 'pvc.yaml#0'}})
+        client.update_resource.assert_called_once_with(mapping, ANY, ANY)
+        update = client.update_resource.call_args[0][1]
+        self.assertEqual(update.metadata,
+                         {'name': 'data', 'finalizers': None})
+        # no anchor is created during the uninstall
+        client.create_resource.assert_not_called()
+
+    def test_prepare_pvc_delete_server_side_apply(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        _ctx.node.properties['server_side_apply'] = {'enabled': True}
+        client = MagicMock()
+        definition = KubernetesResourceDefinition(
+            kind='PersistentVolumeClaim', apiVersion='v1',
+            metadata={'name': 'data',
+                      'finalizers': ['kubernetes.io/pvc-protection']})
+
+        tasks.operations.prepare_pvc_delete(
+            definition, client,
+            SUPPORTED_API_MAPPINGS['PersistentVolumeClaim'],
+            {'file': {'resource_path': 'pvc.yaml#0'}})
+        # an apply of the metadata alone would drop the spec, and could not
+        # remove a finalizer that another field manager owns
+        client.apply_resource.assert_not_called()
+        client.update_resource.assert_called_once()
+
+    def test_prepare_pvc_delete_fingerprint(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        _ctx.instance._runtime_properties = DirtyTrackingDict({})
+        definition = KubernetesResourceDefinition(
+            kind='PersistentVolumeClaim', apiVersion='v1',
+            metadata={'name': 'data',
+                      'finalizers': ['kubernetes.io/pvc-protection']})
+        store_definition_fingerprint(definition)
+        # the delete forgets the definition before the finalizers are
+        # removed
+        remove_definition_fingerprint(definition)
+
+        tasks.operations.prepare_pvc_delete(
+            definition, MagicMock(),
+            SUPPORTED_API_MAPPINGS['PersistentVolumeClaim'],
+            {'file': {'resource_path': 'pvc.yaml#0'}})
+        self.assertEqual(_ctx.instance.runtime_properties.get(
+            '__resource_fingerprints'), {})
+
+    def test_do_resource_apply(self):
+        _, _ctx = self._prepare_master_node(create=True)
+        _ctx.node.properties['server_side_apply'] = {
+            'enabled': True, 'force_conflicts': True}
+        _ctx.instance.runtime_properties['__perform_task'] = True
+        resource_definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+        client = MagicMock()
+        client.apply_resource.return_value = {'metadata': {'name': 'foo'}}
+        mapping = MagicMock()
+
+        # create and update are the same apply call
+        for task in (tasks._do_resource_create, tasks._do_resource_update):
+            self.assertEqual(task(client, mapping, resource_definition),
+                             {'metadata': {'name': 'foo'}})
+        self.assertEqual(client.apply_resource.call_count, 2)
+        client.apply_resource.assert_called_with(
+            mapping, resource_definition, ANY,
+            field_manager='cloudify', force=True)
+        client.create_resource.assert_not_called()
+        client.update_resource.assert_not_called()
+
+        # without the read before the create, an existing resource must
+        # not be applied to
+        _ctx.node.properties['optimistic_create'] = True
+        client.create_resource.side_effect = KuberentesApiOperationError(
+            'Exception during Kubernetes API call: (409)\n'
+            'Reason: Conflict')
+        client.read_resource.return_value = {'metadata': {'name': 'foo',
+                                                          'uid': '1'}}
+        self.assertIsNone(tasks.api_calls.
+                          _check_if_resource_exists_before_create(
+                              client, mapping, resource_definition))
+        self.assertEqual(
+            tasks._do_resource_create(client, mapping, resource_definition),
+            {'metadata': {'name': 'foo', 'uid': '1'}})
+        self.assertFalse(_ctx.instance.runtime_properties['__perform_task'])
+        self.assertEqual(client.apply_resource.call_count, 2)
+        self.assertEqual(client.read_resource.call_count, 1)
+
     @patch('cloudify_kubernetes.utils.AKSConnection')
     @patch('cloudify_kubernetes.decorators.'
            'setup_configuration')
@@ -853,13 +1498,18 @@ class TestTasks(unittest.TestCase):
         self.assertDictEqual(
             _ctx.instance.runtime_properties,
             json.loads(json.dumps({
-                '__resource_definitions': [
-                    {
-                        'kind': 'Pod',
-                        'apiVersion': 'v1',
-                        'metadata': {'name': 'a'}
+                '__resource_definitions': {
+                    'Pod/default/a': {
+                        'definition': {
+                            'kind': 'Pod',
+                            'apiVersion': 'v1',
+                            'metadata': {'name': 'a'}
+                        },
+                        'order': 0
                     }
-                ],
+                },
+                '__resource_definitions_order': 1,
+                '__resource_definitions_last': 'Pod/default/a',
                 'kubernetes': RESPONSE
             }))
         )
@@ -960,7 +1610,14 @@ class TestTasks(unittest.TestCase):
                         )
                     file_mock.assert_called_with('new_path', 'rb')
         expected_props = json.loads(json.dumps({
-            '__resource_definitions': [expected_value],
+            '__resource_definitions': {
+                'Pod/default/check_id': {'definition': expected_value,
+                                         'order': 0,
+                                         'path': 'abc.yaml#1'}},
+            '__resource_definitions_order': 1,
+            '__resource_definitions_last': 'Pod/default/check_id',
+            '__resource_files': {'abc.yaml': 2},
+            '__resource_fingerprints': _file_fingerprints(FILE_YAML),
             'kubernetes': {
                 'abc.yaml#0': expected_value,
                 'abc.yaml#1': expected_value}}))
@@ -1082,7 +1739,14 @@ class TestTasks(unittest.TestCase):
         self.assertEqual(
             _ctx.instance.runtime_properties,
             json.loads(json.dumps({
-                '__resource_definitions': [expected_value],
+                '__resource_definitions': {
+                    'Pod/default/check_id': {'definition': expected_value,
+                                             'order': 0,
+                                             'path': 'abc.yaml#1'}},
+                '__resource_definitions_order': 1,
+                '__resource_definitions_last': 'Pod/default/check_id',
+                '__resource_files': {'abc.yaml': 2},
+                '__resource_fingerprints': _file_fingerprints(FILE_YAML),
                 'kubernetes': {
                     'abc.yaml#0': expected_value,
                     'abc.yaml#1': expected_value
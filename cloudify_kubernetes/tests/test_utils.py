@@ -13,17 +13,26 @@
 # limitations under the License.
 
 import os
+import copy
 import json
+import yaml
 import unittest
-from mock import (MagicMock, mock_open, patch)
+from datetime import datetime
+from shutil import rmtree
+from tempfile import NamedTemporaryFile, mkdtemp
+from mock import (MagicMock, PropertyMock, mock_open, patch)
 
 from cloudify.state import current_ctx
 from cloudify.mocks import MockCloudifyContext
 from cloudify.exceptions import NonRecoverableError
 
+from deepdiff import DeepDiff
+from cloudify_kubernetes_sdk.state import Resource
+
 from cloudify_kubernetes import utils
 from cloudify.manager import DirtyTrackingDict
 from cloudify_kubernetes.k8s.mapping import (
+    get_mapping,
     KubernetesSingleOperationApiMapping,
     KubernetesApiMapping
 )
@@ -32,6 +41,9 @@ from cloudify_kubernetes.k8s.exceptions import (
     KuberentesMappingNotFoundError
 )
 from cloudify_kubernetes.k8s.client import KubernetesResourceDefinition
+from cloudify_kubernetes.tests.test_k8s_raw import CORPUS
+from cloudify_kubernetes._compat import text_type
+from kubernetes import client as kubernetes_client
 
 
 file_resources = """
@@ -52,6 +64,124 @@ spec: d
 """
 
 
+def _legacy_cleanup(ob):
+    """ The to_dict() and in place walk that sanitize_for_json replaced. """
+    def cleanup(resource):
+        keys = range(len(resource)) if isinstance(resource, list) \
+            else list(resource)
+        for k in keys:
+            v = resource[k]
+            if not v:
+                continue
+            if isinstance(v, (list, dict)):
+                cleanup(v)
+            elif not isinstance(v, int) and not isinstance(v, text_type):
+                resource[k] = text_type(v)
+    resource = ob if isinstance(ob, dict) else ob.to_dict()
+    cleanup(resource)
+    return resource
+
+
+def _large_crd():
+    properties = {
+        'field{0}'.format(i): {
+            'type': 'object',
+            'description': 'Field number {0}.'.format(i),
+            'properties': {
+                'name': {'type': 'string', 'maxLength': 63},
+                'replicas': {'type': 'integer', 'minimum': 0},
+                'ratio': {'type': 'number', 'maximum': 0.5},
+            },
+            'required': ['name'],
+        } for i in range(250)}
+    body = {
+        'apiVersion': 'apiextensions.k8s.io/v1',
+        'kind': 'CustomResourceDefinition',
+        'metadata': {
+            'name': 'widgets.example.com',
+            'resourceVersion': '1',
+            'creationTimestamp': '2023-01-01T10:00:00Z',
+            'managedFields': [{'manager': 'kubectl', 'operation': 'Update',
+                               'time': '2023-01-01T10:00:00Z',
+                               'fieldsType': 'FieldsV1',
+                               'fieldsV1': {'f:spec': {}}}],
+        },
+        'spec': {
+            'group': 'example.com',
+            'names': {'kind': 'Widget', 'plural': 'widgets'},
+            'scope': 'Namespaced',
+            'versions': [{
+                'name': 'v1', 'served': True, 'storage': True,
+                'schema': {'openAPIV3Schema': {
+                    'type': 'object',
+                    'properties': {'spec': {'type': 'object',
+                                            'properties': properties}}}},
+            }],
+        },
+    }
+    response = MagicMock(data=json.dumps(body))
+    return kubernetes_client.ApiClient().deserialize(
+        response, 'V1CustomResourceDefinition'), body
+
+
+class TestSanitizeForJson(unittest.TestCase):
+
+    def test_sanitize_for_json(self):
+        value = {
+            'a': 'b',
+            'c': [{'date': datetime(2017, 1, 1, 1, 1), 'g': None,
+                   'h': 0.5, 'i': 0.0, 'j': True, 'k': 3}, None],
+        }
+        self.assertEqual(utils.sanitize_for_json(value), {
+            'a': 'b',
+            'c': [{'date': '2017-01-01 01:01:00', 'g': None,
+                   'h': '0.5', 'i': 0.0, 'j': True, 'k': 3}, None],
+        })
+        # The input is left as it was.
+        self.assertEqual(value['c'][0]['date'], datetime(2017, 1, 1, 1, 1))
+        self.assertEqual(utils.JsonCleanuper(value).to_dict(),
+                         utils.sanitize_for_json(value))
+
+    def test_sanitize_for_json_models(self):
+        crd, _ = _large_crd()
+        self.assertEqual(utils.sanitize_for_json(crd), _legacy_cleanup(crd))
+        definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'foo'})
+        self.assertEqual(utils.sanitize_for_json(definition), {
+            'kind': 'Pod', 'apiVersion': 'v1', 'metadata': {'name': 'foo'}})
+
+    def test_sanitize_for_json_exclude(self):
+        crd, body = _large_crd()
+        exclude = ['metadata.managed_fields', 'spec.versions.schema',
+                   'managedFields']
+        result = utils.sanitize_for_json(crd, exclude=exclude)
+        self.assertNotIn('managed_fields', result['metadata'])
+        self.assertEqual(result['metadata']['name'], 'widgets.example.com')
+        self.assertNotIn('schema', result['spec']['versions'][0])
+        self.assertEqual(result['spec']['versions'][0]['name'], 'v1')
+        result = utils.sanitize_for_json(body, exclude=exclude)
+        self.assertNotIn('managedFields', result)
+        self.assertIn('managedFields', result['metadata'])
+        self.assertEqual(
+            utils.compile_projection(['a.b', 'a', 'c.d.e']),
+            {'a': utils.EXCLUDED_FIELD,
+             'c': {'d': {'e': utils.EXCLUDED_FIELD}}})
+
+    def test_sanitize_for_json_large_model(self):
+        crd, body = _large_crd()
+        self.assertGreater(len(json.dumps(body, indent=2).splitlines()),
+                           5000)
+        # the models are walked once, without an intermediate to_dict copy
+        with patch.object(kubernetes_client.V1CustomResourceDefinition,
+                          'to_dict') as crd_to_dict, \
+                patch.object(kubernetes_client.V1JSONSchemaProps,
+                             'to_dict') as schema_to_dict:
+            result = utils.sanitize_for_json(crd)
+        crd_to_dict.assert_not_called()
+        schema_to_dict.assert_not_called()
+        self.assertEqual(result, _legacy_cleanup(crd))
+
+
 class TestUtils(unittest.TestCase):
 
     def _assert_mapping(self, mapping):
@@ -212,6 +342,113 @@ class TestUtils(unittest.TestCase):
                               [{'test': {'a': 1, 'b': 2, }}, None])
             file_mock.assert_called_once_with('local_path', 'rb')
 
+    def _yaml_file(self, content):
+        with NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+        _ctx = MockCloudifyContext()
+        _ctx.download_resource_and_render = lambda *_: f.name
+        current_ctx.set(_ctx)
+        return f.name
+
+    def test_yaml_from_files_single_pass(self):
+        self._yaml_file(file_resources)
+        with patch('yaml.load_all', wraps=yaml.load_all) as load_all:
+            result = utils._yaml_from_files('path')
+        self.assertEqual([d['kind'] for d in result if d],
+                         ['Service', 'Pod'])
+        self.assertEqual(load_all.call_count, 1)
+        self.assertIs(load_all.call_args[1]['Loader'], utils.YAML_LOADER)
+
+    def test_yaml_from_files_syntax_error(self):
+        self._yaml_file(file_resources + 'kind: [unclosed\n')
+        # no document is returned, so none of them is applied
+        with self.assertRaises(yaml.YAMLError):
+            utils._yaml_from_files('path')
+
+    def test_yaml_from_files_empty(self):
+        self._yaml_file('# only a comment\n')
+        with self.assertRaises(KuberentesInvalidDefinitionError):
+            utils._yaml_from_files('path')
+
+    def _cached_yaml_context(self, workdir, instance_id='instance_1'):
+        rendered = self._yaml_file(file_resources)
+        _ctx = MockCloudifyContext(node_id=instance_id,
+                                   blueprint_id='blueprint',
+                                   deployment_id='deployment',
+                                   properties={})
+        _ctx.download_resource_and_render = MagicMock(return_value=rendered)
+        current_ctx.set(_ctx)
+        plugin = patch.object(type(_ctx), 'plugin',
+                              new_callable=PropertyMock,
+                              return_value=MagicMock(workdir=workdir))
+        plugin.start()
+        self.addCleanup(plugin.stop)
+        return _ctx
+
+    def test_yaml_from_files_cache(self):
+        workdir = mkdtemp()
+        self.addCleanup(rmtree, workdir)
+        _ctx = self._cached_yaml_context(workdir)
+        first = list(utils._yaml_from_files('path', template_variables={}))
+        self.assertEqual([d['kind'] for d in first if d],
+                         ['Service', 'Pod'])
+        with patch('yaml.load_all') as load_all:
+            self.assertEqual(list(utils._yaml_from_files('path')), first)
+            self.assertEqual(
+                list(utils._yaml_from_files('path',
+                                            target_path='/tmp/target')),
+                first)
+            self.assertFalse(load_all.called)
+        # the templates can read the context, so the files are rendered
+        self.assertEqual(_ctx.download_resource_and_render.call_count, 3)
+
+        # Another rendered content is parsed.
+        rendered = _ctx.download_resource_and_render.return_value
+        with open(rendered, 'w') as outfile:
+            outfile.write(file_resources.replace('name: foo', 'name: baz'))
+        self.assertNotEqual(list(utils._yaml_from_files('path')), first)
+
+        # Another instance with the same content shares the documents.
+        cache_dir = os.path.join(workdir, utils.RESOURCE_FILES_CACHE_DIR)
+        _ctx = self._cached_yaml_context(workdir, instance_id='instance_2')
+        list(utils._yaml_from_files('path'))
+        self.assertEqual(
+            len([n for n in os.listdir(cache_dir) if n.endswith('.json')]),
+            2)
+
+        # Disabled by the node property.
+        _ctx.node.properties[utils.NODE_PROPERTY_CACHE_FILES] = False
+        with patch('yaml.load_all', return_value=iter([{}])) as load_all:
+            list(utils._yaml_from_files('path'))
+            self.assertTrue(load_all.called)
+
+    def test_yaml_from_files_cache_keys(self):
+        workdir = mkdtemp()
+        self.addCleanup(rmtree, workdir)
+        _ctx = self._cached_yaml_context(workdir)
+        rendered = _ctx.download_resource_and_render.return_value
+        with open(rendered, 'w') as outfile:
+            outfile.write('kind: ConfigMap\ndata:\n  1: one\n')
+        # JSON would turn the integer key into a string
+        for _ in range(2):
+            self.assertEqual(list(utils._yaml_from_files('path')),
+                             [{'kind': 'ConfigMap', 'data': {1: 'one'}}])
+        self.assertFalse(os.path.isdir(
+            os.path.join(workdir, utils.RESOURCE_FILES_CACHE_DIR)))
+
+    def test_evict_cached_documents(self):
+        cache_dir = mkdtemp()
+        self.addCleanup(rmtree, cache_dir)
+        for i, name in enumerate(['old', 'mid', 'new']):
+            path = os.path.join(cache_dir, name + '.json')
+            with open(path, 'w') as outfile:
+                outfile.write('x' * 100)
+            os.utime(path, (i, i))
+        utils._evict_cached_documents(cache_dir, max_size=250)
+        self.assertEqual(sorted(os.listdir(cache_dir)),
+                         ['mid.json', 'new.json'])
+
     def test_mapping_by_data_kwargs(self):
         self._prepare_context(with_api_mapping=False)
         mapping = self._prepare_mapping()
@@ -250,6 +487,22 @@ class TestUtils(unittest.TestCase):
         with self.assertRaises(KuberentesMappingNotFoundError):
             utils.mapping_by_kind(resource_definition)
 
+    def test_mapping_by_kind_discovery(self):
+        self._prepare_context(with_api_mapping=False)
+
+        resource_definition = KubernetesResourceDefinition(
+            kind='Widget', apiVersion='example.com/v1',
+            metadata={'name': 'foo'})
+        client = MagicMock()
+        self.assertEqual(
+            utils.mapping_by_kind(resource_definition, client=client),
+            get_mapping('CustomObjectsApi'))
+        client.discovery.resolve.assert_called_with('example.com/v1',
+                                                    'Widget')
+        client.discovery.resolve.return_value = None
+        with self.assertRaises(KuberentesMappingNotFoundError):
+            utils.mapping_by_kind(resource_definition, client=client)
+
     def test_resource_definition_from_blueprint_kwargs(self):
         self._prepare_context(with_definition=False)
 
@@ -340,7 +593,8 @@ class TestUtils(unittest.TestCase):
             with patch('cloudify.ctx.download_resource_and_render'):
                 with patch('os.path.isfile'):
                     with patch('os.path.getsize'):
-                        result = utils.resource_definitions_from_file(**kwargs)
+                        result = list(
+                            utils.resource_definitions_from_file(**kwargs))
 
             self.assertTrue(isinstance(result[0],
                                        KubernetesResourceDefinition))
@@ -405,7 +659,7 @@ class TestUtils(unittest.TestCase):
                 'cloudify_kubernetes.utils._yaml_from_files',
                 _mocked_yaml_from_files
         ):
-            result = utils.resource_definitions_from_file()
+            result = list(utils.resource_definitions_from_file())
 
             self.assertTrue(isinstance(result[0],
                                        KubernetesResourceDefinition))
@@ -471,7 +725,8 @@ class TestUtils(unittest.TestCase):
                       _ctx.instance.runtime_properties)
         self.assertDictEqual(
             definition,
-            _ctx.instance.runtime_properties['__resource_definitions'][0]
+            _ctx.instance.runtime_properties['__resource_definitions'][
+                'Deployment/default/None']['definition']
         )
         mock_mapping = KubernetesApiMapping(**self._prepare_mapping())
         result_from_storage, mapping_from_storage = \
@@ -523,23 +778,24 @@ class TestUtils(unittest.TestCase):
                 'cloudify_kubernetes.utils._yaml_from_files',
                 _mocked_yaml_from_files
         ):
-            results_from_file = utils.resource_definitions_from_file(**kwargs)
+            results_from_file = list(
+                utils.resource_definitions_from_file(**kwargs))
             for rs in results_from_file:
                 utils.store_resource_definition(rs)
             self.assertIn('__resource_definitions',
                           _ctx.instance.runtime_properties)
-            self.assertDictEqual(
-                definition1,
-                _ctx.instance.runtime_properties['__resource_definitions'][0]
-            )
-            self.assertDictEqual(
-                definition2,
-                _ctx.instance.runtime_properties['__resource_definitions'][1]
-            )
-            self.assertDictEqual(
-                definition3,
-                _ctx.instance.runtime_properties['__resource_definitions'][2]
-            )
+            self.assertEqual(
+                _ctx.instance.runtime_properties['__resource_definitions'][
+                    'Deployment/default/MyDeployment'],
+                {'definition': definition1, 'order': 0})
+            self.assertEqual(
+                _ctx.instance.runtime_properties['__resource_definitions'][
+                    'Service/default/MyService'],
+                {'definition': definition2, 'order': 1})
+            self.assertEqual(
+                _ctx.instance.runtime_properties['__resource_definitions'][
+                    'Ingress/default/MyIngress'],
+                {'definition': definition3, 'order': 2})
             results_from_file.reverse()
             mock_mapping = KubernetesApiMapping(**self._prepare_mapping())
             for result_from_file in results_from_file:
@@ -548,6 +804,61 @@ class TestUtils(unittest.TestCase):
                                                    mock_mapping)
                 self.assertEqual(result_from_file, result_from_storage)
 
+    def test_resource_definitions_migration(self):
+        _ctx = self._prepare_context(with_definition=False)
+        pods = [{'kind': 'Pod', 'apiVersion': 'v1',
+                 'metadata': {'name': name, 'namespace': 'apps'}}
+                for name in ['a', 'b', 'c', 'd']]
+        # the layout of older versions of the plugin
+        _ctx.instance.runtime_properties['__resource_definitions'] = pods
+        _ctx.instance.runtime_properties['kubernetes'] = {
+            'f.yaml#0': pods[0], 'f.yaml#1': pods[1],
+            'ff.yaml#0': pods[2], 'g.yaml': pods[3]}
+
+        definitions = utils.get_resource_definitions()
+        self.assertEqual(definitions['Pod/apps/b'], {
+            'definition': pods[1], 'order': 1, 'path': 'f.yaml#1'})
+        self.assertEqual(
+            _ctx.instance.runtime_properties['__resource_files'],
+            {'f.yaml': 2, 'ff.yaml': 1, 'g.yaml': 1})
+        self.assertEqual(
+            _ctx.instance.runtime_properties[
+                '__resource_definitions_order'], 4)
+        self.assertEqual(
+            _ctx.instance.runtime_properties[
+                '__resource_definitions_last'], 'Pod/apps/d')
+
+        # only the documents of the same file are adjacent
+        path, resource, adjacent_resources = \
+            utils.retrieve_last_create_path('f.yaml#0')
+        self.assertEqual(resource, pods[0])
+        self.assertEqual(adjacent_resources, {'f.yaml#1': pods[1]})
+        self.assertEqual(
+            sorted(_ctx.instance.runtime_properties['kubernetes']),
+            ['ff.yaml#0', 'g.yaml'])
+
+        # a renamed file resolves to the path of the last definition
+        path, resource, _ = utils.retrieve_last_create_path('h.yaml')
+        self.assertEqual((path, resource), ('g.yaml', pods[3]))
+        self.assertNotIn(
+            'Pod/apps/d',
+            _ctx.instance.runtime_properties['__resource_definitions'])
+
+    def test_remove_resource_definition(self):
+        _ctx = self._prepare_context(with_definition=False)
+        for name, namespace in [('a', 'apps'), ('a', 'other')]:
+            utils.store_resource_definition(KubernetesResourceDefinition(
+                kind='Pod', apiVersion='v1',
+                metadata={'name': name, 'namespace': namespace}))
+        utils.remove_resource_definition('Pod', 'a', 'other')
+        self.assertEqual(
+            list(_ctx.instance.runtime_properties['__resource_definitions']),
+            ['Pod/apps/a'])
+        # without the namespace, the resources of the kind and name
+        utils.remove_resource_definition('Pod', 'a')
+        self.assertEqual(
+            _ctx.instance.runtime_properties['__resource_definitions'], {})
+
     def test_set_namespace(self):
         self._prepare_context(with_definition=False)
         self.assertIsNone(utils.set_namespace({'namespace': 'default'}))
@@ -578,6 +889,159 @@ class TestUtils(unittest.TestCase):
         for key in utils.CERT_KEYS:
             assert os.path.exists(config['api_options'][key]) is False
 
+    def test_store_result_for_retrieve_id_projection(self):
+        _ctx = self._prepare_context()
+        _ctx.instance.update = MagicMock()
+        annotation = 'kubectl.kubernetes.io/last-applied-configuration'
+        response = {
+            'kind': 'Pod',
+            'api_version': 'v1',
+            'metadata': {
+                'name': 'foo',
+                'namespace': 'bar',
+                'managed_fields': [{'manager': 'kubectl'}],
+                'annotations': {annotation: '{"big": "json"}',
+                                'owner': 'me'},
+            },
+            'spec': {'containers': [{'name': 'c'}]},
+        }
+        utils.store_result_for_retrieve_id(response, 'file.yaml#0')
+        stored = _ctx.instance.runtime_properties['kubernetes'][
+            'file.yaml#0']
+        self.assertEqual(stored['metadata'], {
+            'name': 'foo', 'namespace': 'bar',
+            'annotations': {'owner': 'me'}})
+        self.assertEqual(stored['spec'], response['spec'])
+        self.assertNotIn(
+            'managed_fields',
+            _ctx.instance.runtime_properties[utils.DEFS]['Pod/bar/foo'][
+                'definition']['metadata'])
+        # The lookups still work on the projected data.
+        path, resource, _ = utils.retrieve_last_create_path(
+            'file.yaml#0', delete=False)
+        self.assertEqual(resource['metadata']['name'], 'foo')
+        # Drift ignores the fields that were not stored.
+        self.assertFalse(utils.check_drift(stored, response))
+        changed = dict(response, spec={'containers': [{'name': 'd'}]})
+        self.assertTrue(utils.check_drift(stored, changed))
+
+        _ctx.node.properties[utils.NODE_PROPERTY_EXCLUDE] = ['spec']
+        utils.store_result_for_retrieve_id(response)
+        self.assertNotIn(
+            'spec', _ctx.instance.runtime_properties['kubernetes'])
+        self.assertIn(
+            'managed_fields',
+            _ctx.instance.runtime_properties['kubernetes']['metadata'])
+        self.assertEqual(utils.retrieve_id(), 'foo')
+
+    def test_check_drift_fast_paths(self):
+        _ctx = self._prepare_context()
+        stored = {'kind': 'Deployment',
+                  'metadata': {'name': 'foo', 'resource_version': '1',
+                               'generation': 1},
+                  'spec': {'replicas': 1},
+                  'status': {'ready_replicas': 0}}
+        with patch('cloudify_kubernetes.utils.DeepDiff') as deep_diff:
+            # the same version, nothing to compare
+            self.assertFalse(utils.check_drift(stored, dict(stored)))
+            # only the status changed, and it is ignored
+            _ctx.node.properties['drift_ignored_fields'] = ['status']
+            status_changed = dict(
+                stored,
+                metadata=dict(stored['metadata'], resource_version='2'),
+                status={'ready_replicas': 1})
+            self.assertFalse(utils.check_drift(stored, status_changed))
+            deep_diff.assert_not_called()
+        # a new generation is diffed without hashing
+        spec_changed = dict(
+            status_changed,
+            metadata=dict(status_changed['metadata'], generation=2),
+            spec={'replicas': 2})
+        with patch('cloudify_kubernetes.utils.drift_fingerprint') as hashes:
+            diff = utils.check_drift(stored, spec_changed)
+            hashes.assert_not_called()
+        self.assertEqual(list(diff), ['values_changed'])
+        self.assertEqual(sorted(diff['values_changed']),
+                         ["root['metadata']['generation']",
+                          "root['spec']['replicas']"])
+
+        # the fingerprint of the stored result is kept
+        fingerprint = utils.get_drift_fingerprint(stored, 'file.yaml#0')
+        with patch('cloudify_kubernetes.utils.drift_fingerprint') as hashes:
+            self.assertEqual(
+                utils.get_drift_fingerprint(stored, 'file.yaml#0'),
+                fingerprint)
+            hashes.assert_not_called()
+            # until the ignored fields change
+            _ctx.node.properties['drift_ignored_fields'] = []
+            utils.get_drift_fingerprint(stored, 'file.yaml#0')
+            hashes.assert_called_once()
+
+    def test_check_drift_fast_path(self):
+        _ctx = self._prepare_context()
+        _ctx.node.properties['drift_ignored_fields'] = ['status']
+        exclude = utils.get_drift_excluded_fields()
+
+        def legacy_check_drift(previous, current):
+            return DeepDiff(
+                Resource(utils.project_result(previous, exclude)).state,
+                Resource(utils.project_result(current, exclude)).state)
+
+        def changed(body, **changes):
+            body = copy.deepcopy(dict(body, **changes))
+            body['metadata']['resourceVersion'] = '12346'
+            return body
+
+        pairs = []
+        for kind, body in CORPUS:
+            pairs.append(('{0} unchanged'.format(kind), body,
+                          copy.deepcopy(body), False))
+            pairs.append(('{0} status'.format(kind), body,
+                          changed(body, status={'observed': True}), False))
+            pairs.append(('{0} labels'.format(kind), body,
+                          changed(body, metadata=dict(
+                              body['metadata'], labels={'app': 'other'})),
+                          True))
+        for name, previous, current, drifted in pairs:
+            fingerprint = utils.get_drift_fingerprint(previous, name)
+            self.assertEqual(bool(legacy_check_drift(previous, current)),
+                             drifted)
+            with patch('cloudify_kubernetes.utils.DeepDiff',
+                       wraps=DeepDiff) as deep_diff:
+                self.assertEqual(
+                    bool(utils.check_drift(previous, current, fingerprint)),
+                    drifted)
+            # only a resource that drifted is diffed field by field
+            self.assertEqual(deep_diff.call_count, int(drifted), name)
+
+    def test_add_instance_labels(self):
+        _ctx = self._prepare_context()
+        metadata = {'name': 'a', 'labels': {'app': 'a'}}
+        definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata=metadata)
+        utils.add_instance_labels(definition)
+        self.assertEqual(definition.metadata['labels'], {
+            'app': 'a',
+            'cloudify.co/deployment-id': 'test_name',
+            'cloudify.co/node-id': 'test_name',
+            'cloudify.co/node-instance-id': 'test_id',
+        })
+        # the original metadata is not changed
+        self.assertEqual(metadata, {'name': 'a', 'labels': {'app': 'a'}})
+
+        _ctx.node.properties['use_external_resource'] = True
+        definition = KubernetesResourceDefinition(
+            kind='Pod', apiVersion='v1', metadata={'name': 'a'})
+        utils.add_instance_labels(definition)
+        self.assertNotIn('labels', definition.metadata)
+
+    def test_label_value(self):
+        self.assertEqual(utils._label_value('_my app.'), 'my-app')
+        value = utils._label_value('a' * 100)
+        self.assertEqual(len(value), 63)
+        self.assertEqual(value, utils._label_value('a' * 100))
+        self.assertNotEqual(value, utils._label_value('a' * 101))
+
     def test_handle_existing_resource(self):
         _ctx = self._prepare_context()
         definition = MagicMock()
@@ -13,8 +13,12 @@
 # limitations under the License.
 #
 import os
+import re
 import sys
 import json
+import hashlib
+import threading
+from contextlib import contextmanager
 from deepdiff import DeepDiff
 from tempfile import NamedTemporaryFile
 
@@ -42,14 +46,10 @@ from .k8s import (get_mapping,
                   KuberentesInvalidDefinitionError)
 
 try:
-    from collections import (
-        Mapping,
-        OrderedDict
-    )
+    from collections import Mapping
 except ImportError:
     if PY311:
         from collections.abc import Mapping
-        from collections import OrderedDict
     else:
         raise
 
@@ -61,6 +61,9 @@ NODE_PROPERTY_FILE = 'file'
 NODE_PROPERTY_FILES = 'files'
 NODE_PROPERTY_OPTIONS = 'options'
 DEFS = '__resource_definitions'
+DEFS_ORDER = '__resource_definitions_order'
+DEFS_LAST = '__resource_definitions_last'
+RESOURCE_FILES = '__resource_files'
 PERMIT_REDEFINE = 'allow_node_redefinition'
 INSTANCE_RUNTIME_PROPERTY_KUBERNETES = 'kubernetes'
 FILENAMES = r'[A-Za-z0-9\.\_\-\/]*yaml\#[0-9]*'
@@ -77,6 +80,46 @@ CLUSTER_TYPES = ['cloudify.nodes.aws.eks.Cluster',
                  'cloudify.nodes.azure.compute.ManagedCluster']
 CLUSTER_REL = 'cloudify.relationships.kubernetes.connected_to_shared_cluster'
 DEFINITION_ADDITIONS = 'definitions_additions'
+# libyaml is much faster than the pure python loader, when it is available.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+NODE_PROPERTY_CACHE_FILES = 'cache_resource_files'
+NODE_PROPERTY_RESOURCES_CONCURRENCY = 'resources_concurrency'
+NODE_PROPERTY_STATUS_WATCH_TIMEOUT = 'status_watch_timeout'
+NODE_PROPERTY_OPTIMISTIC_CREATE = 'optimistic_create'
+NODE_PROPERTY_SERVER_SIDE_APPLY = 'server_side_apply'
+DEFAULT_FIELD_MANAGER = 'cloudify'
+NODE_PROPERTY_SKIP_UNCHANGED_UPDATES = 'skip_unchanged_updates'
+FINGERPRINTS = '__resource_fingerprints'
+NODE_PROPERTY_DRIFT_IGNORED_FIELDS = 'drift_ignored_fields'
+DRIFT_FINGERPRINTS = '__drift_fingerprints'
+NODE_PROPERTY_BULK_OPERATIONS = 'bulk_operations'
+NODE_PROPERTY_OWNER_ANCHOR = 'owner_anchor'
+OWNER_ANCHORS = '__owner_anchors'
+DEFAULT_OWNER_ANCHOR_DELETE_TIMEOUT = 300
+LABEL_DEPLOYMENT = 'cloudify.co/deployment-id'
+LABEL_NODE = 'cloudify.co/node-id'
+LABEL_NODE_INSTANCE = 'cloudify.co/node-instance-id'
+LABEL_VALUE_INVALID_CHARACTERS = re.compile(r'[^A-Za-z0-9_.-]')
+LABEL_VALUE_MAX_LENGTH = 63
+DRIFT_EXCLUDED_FIELDS = [
+    'metadata.resource_version',
+    'metadata.resourceVersion',
+]
+RESOURCE_FILES_CACHE_DIR = 'resource_files_cache'
+RESOURCE_FILES_CACHE_SIZE = 32 * 1024 * 1024
+NODE_PROPERTY_EXCLUDE = 'exclude_from_runtime_properties'
+DEFAULT_EXCLUDED_FIELDS = [
+    'metadata.managed_fields',
+    'metadata.managedFields',
+    'metadata.annotations.kubectl.kubernetes.io/last-applied-configuration',
+]
+# The fields of a resource that status checks do not use.
+STATUS_EXCLUDED_FIELDS = DEFAULT_EXCLUDED_FIELDS + [
+    'metadata.annotations',
+    'spec.template',
+    'spec.job_template',
+    'spec.volume_claim_templates',
+]
 
 
 def merge_definitions(old, new):
@@ -129,6 +172,42 @@ def match_resource(left, right):
     return False
 
 
+def _source_file(path):
+    """ Split a resource path into its file and the number of the document
+    in the file.
+    """
+    source, _, number = path.partition('#')
+    return source, int(number) if number.isdigit() else 0
+
+
+def _add_file_document(path):
+    """ Count the documents of a file, so that the other documents of the
+    file can be found by path, without looking at every stored resource.
+    """
+    source, number = _source_file(path)
+    files = ctx.instance.runtime_properties.get(RESOURCE_FILES, {})
+    if files.get(source, 0) <= number:
+        files = dict(files)
+        files[source] = number + 1
+        ctx.instance.runtime_properties[RESOURCE_FILES] = files
+
+
+def _adjacent_paths(file_name, file_resources):
+    """ Get the paths of the other stored documents of the file of a path.
+    """
+    source, _ = _source_file(file_name)
+    count = ctx.instance.runtime_properties.get(RESOURCE_FILES, {}).get(source)
+    if count is None:
+        # stored before the files were counted
+        adjacent_file_name = file_name.split('.yaml')[0]
+        return [path for path in file_resources
+                if adjacent_file_name in path and path != file_name]
+    paths = [source] + ['{0}#{1}'.format(source, number)
+                        for number in range(count)]
+    return [path for path in paths
+            if path in file_resources and path != file_name]
+
+
 def retrieve_last_create_path(file_name=None, delete=True):
     """We want to find out the last path that was used to create resources."""
 
@@ -137,40 +216,47 @@ def retrieve_last_create_path(file_name=None, delete=True):
 
     # There are two places where data is stored about resources.
     # The first is by filename, plus the data from the file in the blueprint.
-    file_resources = OrderedDict(ctx.instance.runtime_properties.get(
-        INSTANCE_RUNTIME_PROPERTY_KUBERNETES, {}))
+    file_resources = ctx.instance.runtime_properties.get(
+        INSTANCE_RUNTIME_PROPERTY_KUBERNETES)
+    if not isinstance(file_resources, dict):
+        file_resources = {}
     # The second stores the defintion object.
-    resource_definitions = ctx.instance.runtime_properties.get(DEFS, [])
+    resource_definitions = get_resource_definitions()
 
     # This is the resource from a file.
     file_resource = None
     # These are other resources from the same file.
     adjacent_resources = {}
 
-    try:
+    if file_name in file_resources:
         # We try to get the resource definition as it appeared in the file.
-        if delete:
-            file_resource = file_resources.pop(file_name)
-        else:
-            return file_name, file_resources[file_name], adjacent_resources
-    except KeyError:
+        file_resource = file_resources[file_name]
+        if not delete:
+            return file_name, file_resource, adjacent_resources
+    else:
         # If this is a deployment update, the name of the file might have
         # changed. So the name of the file that we got originally
         # might be the name of the new file.
         # If that's the case, then we get the most recently added resource
         # definition as the resource that we want to delete.
-        try:
-            if delete:
-                resource_definition = resource_definitions.pop()
-            else:
-                resource_definition = resource_definitions[-1]
-        except IndexError:
+        last_key = _last_resource_definition(resource_definitions)
+        if not last_key:
             raise NonRecoverableError('No resource could be resolved.')
+        stored = resource_definitions[last_key]
+        if delete:
+            del resource_definitions[last_key]
+        resource_definition = stored['definition']
 
         # We now want to get the file that was in that resource.
-        for file_name, file_resource in file_resources.items():
-            if match_resource(resource_definition, file_resource):
-                break
+        path = stored.get('path')
+        if path in file_resources and \
+                match_resource(resource_definition, file_resources[path]):
+            file_name, file_resource = path, file_resources[path]
+        else:
+            # stored before the paths were kept
+            for file_name, file_resource in file_resources.items():
+                if match_resource(resource_definition, file_resource):
+                    break
 
     if delete and file_name in file_resources:
         del file_resources[file_name]
@@ -178,10 +264,9 @@ def retrieve_last_create_path(file_name=None, delete=True):
     if not file_resource:
         return file_name, file_resource, adjacent_resources
 
-    adjacent_file_name, _ = file_name.split('.yaml')
-
-    for _f, _r in list(file_resources.items()):
-        if adjacent_file_name in _f and not match_resource(_r, file_resource):
+    for _f in _adjacent_paths(file_name, file_resources):
+        _r = file_resources[_f]
+        if not match_resource(_r, file_resource):
             adjacent_resources.update({_f: _r})
             if delete:
                 del file_resources[_f]
@@ -192,7 +277,7 @@ def retrieve_last_create_path(file_name=None, delete=True):
 
     # force save
     ctx.instance.runtime_properties.dirty = True
-    ctx.instance.update()
+    update_instance()
 
     return file_name, file_resource, adjacent_resources
 
@@ -203,6 +288,111 @@ def generate_traceback_exception():
     return response
 
 
+def _load_yaml_documents(file_path):
+    # Parse the whole file once, before any of its documents is applied, so
+    # that a file with a syntax error does not touch the cluster.
+    with open(file_path, 'rb') as outfile:
+        documents = list(yaml.load_all(outfile, Loader=YAML_LOADER))
+    # Validate file content if it contains at least one document
+    if not documents:
+        raise KuberentesInvalidDefinitionError(
+            'Invalid resource file definition.'
+        )
+    return documents
+
+
+def _resource_files_cache_dir():
+    """ Get the directory of the parsed resource files.
+
+    The files are still downloaded and rendered by every operation, since
+    their templates can read the context. Only the parsing is saved: the
+    parsed documents are stored by the hash of the rendered content.
+
+    :return: The directory, or None if the cache can not be used in this
+        context.
+    """
+    try:
+        if not get_node(ctx).properties.get(
+                NODE_PROPERTY_CACHE_FILES, True):
+            return
+        workdir = ctx.plugin.workdir
+        if not workdir:
+            return
+    except Exception:
+        return
+    return os.path.join(workdir, RESOURCE_FILES_CACHE_DIR)
+
+
+def _content_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_cached_documents(cache_dir, content_hash):
+    try:
+        documents_path = os.path.join(cache_dir, content_hash + '.json')
+        with open(documents_path, 'rb') as infile:
+            documents = json.loads(infile.read().decode('utf-8'))
+        # Keep recently used entries from the eviction.
+        os.utime(documents_path, None)
+    except (IOError, OSError, ValueError):
+        return
+    return documents
+
+
+def _write_atomically(path, data):
+    with NamedTemporaryFile(
+            'wb', dir=os.path.dirname(path), delete=False) as outfile:
+        outfile.write(data)
+    os.rename(outfile.name, path)
+
+
+def _write_cached_documents(cache_dir, content_hash, documents):
+    try:
+        data = json.dumps(documents, separators=(',', ':'))
+    except (TypeError, ValueError):
+        # For example YAML timestamps, keep parsing these files.
+        return
+    if json.loads(data) != documents:
+        # For example keys that are not strings, JSON would change them.
+        return
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _write_atomically(os.path.join(cache_dir, content_hash + '.json'),
+                          data.encode('utf-8'))
+        _evict_cached_documents(cache_dir)
+    except (IOError, OSError) as e:
+        ctx.logger.debug(
+            'Failed to cache resource file: {0}'.format(text_type(e)))
+
+
+def _evict_cached_documents(cache_dir, max_size=RESOURCE_FILES_CACHE_SIZE):
+    entries = []
+    total_size = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.json'):
+            continue
+        stat = os.stat(os.path.join(cache_dir, name))
+        entries.append((stat.st_mtime, stat.st_size, name))
+        total_size += stat.st_size
+    # Remove the least recently used documents.
+    for _, size, name in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total_size -= size
+
+
+def _load_and_cache_yaml_documents(file_path, cache_dir, content_hash):
+    documents = _load_yaml_documents(file_path)
+    _write_cached_documents(cache_dir, content_hash, documents)
+    return documents
+
+
 def _yaml_from_files(
         resource_path,
         target_path=None,
@@ -223,17 +413,15 @@ def _yaml_from_files(
             'Invalid resource file definition.'
         )
 
-    with open(downloaded_file_path, 'rb') as outfile:
-        file_content = outfile.read()
-
-    # Validate file content if it contains at least one dict
-    file_content = file_content.strip()
-    if len(list(yaml.load_all(file_content, Loader=yaml.SafeLoader))) == 0:
-        raise KuberentesInvalidDefinitionError(
-            'Invalid resource file definition.'
-        )
-
-    return yaml.load_all(file_content, Loader=yaml.SafeLoader)
+    cache_dir = _resource_files_cache_dir()
+    if cache_dir:
+        content_hash = _content_hash(downloaded_file_path)
+        documents = _read_cached_documents(cache_dir, content_hash)
+        if documents is not None:
+            return documents
+        return _load_and_cache_yaml_documents(
+            downloaded_file_path, cache_dir, content_hash)
+    return _load_yaml_documents(downloaded_file_path)
 
 
 def mapping_by_data(**kwargs):
@@ -251,7 +439,12 @@ def mapping_by_data(**kwargs):
     )
 
 
-def mapping_by_kind(resource_definition, node_options=None, **_):
+def mapping_by_kind(resource_definition, node_options=None, client=None,
+                    **_):
+    """ Get the API mapping of a resource definition. Custom resources are
+    found by their cloudify-crd-* annotations or node options, or by the
+    API discovery of the client.
+    """
     node_options = node_options or []
     try:
         annotations = resource_definition.metadata.get(
@@ -266,6 +459,10 @@ def mapping_by_kind(resource_definition, node_options=None, **_):
     except KuberentesMappingNotFoundError:
         if set(CUSTOM_OBJECT_NODE_OPTIONS).issubset(set(node_options)):
             return get_mapping(kind='CustomObjectsApi')
+        discovery = getattr(client, 'discovery', None)
+        if discovery and discovery.resolve(
+                resource_definition.api_version, resource_definition.kind):
+            return get_mapping(kind='CustomObjectsApi')
         raise
 
 
@@ -311,13 +508,15 @@ def resource_definitions_from_file(**kwargs):
 
 def resource_definitions_from_file_result(result):
     validate_file_resource(result)
-    resource_defs = []
-    for definition in _yaml_from_files(**result):
+    return _resource_definitions_from_documents(_yaml_from_files(**result))
+
+
+def _resource_definitions_from_documents(documents):
+    for definition in documents:
         if not isinstance(definition, dict):
             ctx.logger.warn('Unexpected {d} definition.'.format(d=definition))
             continue
-        resource_defs.append(KubernetesResourceDefinition(**definition))
-    return resource_defs
+        yield KubernetesResourceDefinition(**definition)
 
 
 def resource_definition_from_payload(**kwargs):
@@ -362,92 +561,314 @@ def get_node(_ctx):
         return _ctx.node
 
 
-class JsonCleanuper(object):
+_COALESCED_UPDATES = threading.local()
 
-    def __init__(self, ob):
-        if isinstance(ob, dict):
-            resource = ob
+
+@contextmanager
+def coalesced_updates():
+    """ Buffer the runtime properties updates that are made through
+    update_instance, and send them in one ctx.instance.update() when the
+    block exits, also when it exits with an exception.
+
+    Nested blocks join the outer one.
+    """
+    if getattr(_COALESCED_UPDATES, 'state', None) is not None:
+        yield
+        return
+    state = _COALESCED_UPDATES.state = {'requested': 0, 'sent': 0}
+    try:
+        yield
+    finally:
+        try:
+            flush_instance_updates()
+        finally:
+            _COALESCED_UPDATES.state = None
+        if state['requested'] > state['sent']:
+            ctx.logger.debug(
+                'Saved {0} of {1} runtime properties updates.'.format(
+                    state['requested'] - state['sent'], state['requested']))
+
+
+def update_instance():
+    """ Save the runtime properties, now or when the enclosing
+    coalesced_updates block exits.
+    """
+    state = getattr(_COALESCED_UPDATES, 'state', None)
+    if state is None:
+        ctx.instance.update()
+        return
+    state['requested'] += 1
+    state['pending'] = True
+
+
+def flush_instance_updates():
+    """ Send the buffered runtime properties update, for example before
+    raising OperationRetry.
+    """
+    state = getattr(_COALESCED_UPDATES, 'state', None)
+    if state and state.pop('pending', False):
+        state['sent'] += 1
+        ctx.instance.update()
+
+
+EXCLUDED_FIELD = True
+
+
+def compile_projection(exclude):
+    """ Turn dotted field paths, like "metadata.managed_fields", into the
+    nested dict that sanitize_for_json walks along with the value.
+
+    :param exclude: A list of dotted field paths.
+    :return: dict
+    """
+    projection = {}
+    for path in exclude or []:
+        node = projection
+        keys = path.split('.')
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+            if node is EXCLUDED_FIELD:
+                break
         else:
-            resource = ob.to_dict()
+            node[keys[-1]] = EXCLUDED_FIELD
+    return projection
 
-        if isinstance(resource, list):
-            self._cleanuped_list(resource)
-        elif isinstance(resource, dict):
-            self._cleanuped_dict(resource)
 
-        self.value = resource
+def _is_model(value):
+    return isinstance(getattr(type(value), 'openapi_types', None), dict)
 
-    def _cleanuped_list(self, resource):
-        for k, v in enumerate(resource):
-            if not v:
-                continue
-            if isinstance(v, list):
-                self._cleanuped_list(v)
-            elif isinstance(v, dict):
-                self._cleanuped_dict(v)
-            elif not isinstance(v, int) and not \
-                    isinstance(v, text_type):
-                resource[k] = text_type(v)
-
-    def _cleanuped_dict(self, resource):
-        for k in resource:
-            if not resource[k]:
-                continue
-            if isinstance(resource[k], list):
-                self._cleanuped_list(resource[k])
-            elif isinstance(resource[k], dict):
-                self._cleanuped_dict(resource[k])
-            elif not isinstance(resource[k], int) and not \
-                    isinstance(resource[k], text_type):
-                resource[k] = text_type(resource[k])
+
+def _lookup_dotted_key(projection, key):
+    # Keys like "kubectl.kubernetes.io/last-applied-configuration" were split
+    # by compile_projection, so follow their parts down the projection.
+    for part in key.split('.'):
+        if not isinstance(projection, dict):
+            break
+        projection = projection.get(part)
+    return projection
+
+
+def _sanitize_dict(value, projection):
+    result = {}
+    for k, v in value.items():
+        sub_projection = projection.get(k) if projection else None
+        if sub_projection is None and projection and '.' in k:
+            sub_projection = _lookup_dotted_key(projection, k)
+        if sub_projection is EXCLUDED_FIELD:
+            continue
+        result[k] = v if type(v) in _PLAIN_TYPES \
+            else _sanitize_value(v, sub_projection)
+    return result
+
+
+def _sanitize_list(value, projection):
+    return [v if type(v) in _PLAIN_TYPES else _sanitize_value(v, projection)
+            for v in value]
+
+
+def _sanitize_model(value, projection):
+    # Walk kubernetes.client models directly, with the keys to_dict() would
+    # produce, instead of building the dict first and walking it again.
+    result = {}
+    for attr in value.openapi_types:
+        sub_projection = projection.get(attr) if projection else None
+        if sub_projection is EXCLUDED_FIELD:
+            continue
+        v = getattr(value, attr)
+        result[attr] = v if type(v) in _PLAIN_TYPES \
+            else _sanitize_value(v, sub_projection)
+    return result
+
+
+_PLAIN_TYPES = frozenset([text_type, int, bool, type(None)])
+_SANITIZERS = {
+    dict: _sanitize_dict,
+    list: _sanitize_list,
+}
+
+
+def _sanitize_value(value, projection):
+    sanitizer = _SANITIZERS.get(type(value))
+    if sanitizer:
+        return sanitizer(value, projection)
+    if isinstance(value, dict):
+        return _sanitize_dict(value, projection)
+    if isinstance(value, list):
+        return _sanitize_list(value, projection)
+    if _is_model(value):
+        return _sanitize_model(value, projection)
+    if not value or isinstance(value, (int, text_type)):
+        return value
+    return text_type(value)
+
+
+def sanitize_for_json(ob, exclude=None):
+    """ Convert a Kubernetes API result, or a resource definition, into
+    something that can be stored in runtime properties: dicts, lists,
+    strings and integers. Any other value is converted to text.
+
+    :param ob: A dict, a kubernetes.client model, or an object that has
+        a to_dict method.
+    :param exclude: An optional list of dotted field paths to drop from
+        the result, for example ["metadata.managed_fields"].
+    :return: A new dict or list, the input is not modified.
+    """
+    projection = compile_projection(exclude)
+    if not isinstance(ob, (dict, list)) and not _is_model(ob):
+        ob = ob.to_dict()
+        if not isinstance(ob, (dict, list)):
+            return ob
+    return _sanitize_value(ob, projection)
+
+
+class JsonCleanuper(object):
+
+    def __init__(self, ob):
+        self.value = sanitize_for_json(ob)
 
     def to_dict(self):
         return self.value
 
 
-def store_resource_definition(resource_definition):
-    if DEFS not in ctx.instance.runtime_properties:
-        ctx.instance.runtime_properties[DEFS] = []
-    ctx.logger.info('Trying: {0}'.format(resource_definition.to_dict()))
-    for index, li in enumerate(ctx.instance.runtime_properties.get(DEFS, [])):
-        if match_resource(li, resource_definition):
-            # We found a match but still updating the resource definition
-            # because fields like metadata.labels can change.
+def resource_key(resource):
+    """ Get the key of a resource in the stored resource definitions.
 
-            ctx.instance.runtime_properties.get(DEFS)[
-                index] = JsonCleanuper(resource_definition).to_dict()
-            return
-    ctx.logger.info('Adding: {0}'.format(resource_definition))
-    ctx.instance.runtime_properties[DEFS].append(
-        JsonCleanuper(resource_definition).to_dict())
+    :param resource: a dict or a KubernetesResourceDefinition
+    :return: A string with the kind, namespace and name of the resource.
+    """
+    if isinstance(resource, KubernetesResourceDefinition):
+        kind, metadata = resource.kind, resource.metadata
+    else:
+        kind, metadata = resource.get('kind'), resource.get('metadata')
+    if not isinstance(metadata, dict):
+        metadata = {}
+    return _resource_key(kind, metadata.get('namespace'), metadata.get('name'))
+
+
+def _resource_key(kind, namespace, name):
+    return '{0}/{1}/{2}'.format(kind, namespace or DEFAULT_NAMESPACE, name)
+
+
+def get_resource_definitions():
+    """ Get the stored resource definitions by resource key. Definitions that
+    older versions of the plugin stored as a list are moved to the keyed
+    layout, in the same order.
+
+    :return: A dict of the definition, order and path of every resource.
+    """
+    runtime_properties = ctx.instance.runtime_properties
+    resource_definitions = runtime_properties.get(DEFS)
+    if isinstance(resource_definitions, dict):
+        return resource_definitions
+    if not resource_definitions:
+        return {}
+    ctx.logger.debug('Indexing {0} stored resource definitions.'.format(
+        len(resource_definitions)))
+    indexed = {}
+    for order, definition in enumerate(resource_definitions):
+        indexed[resource_key(definition)] = {
+            'definition': definition, 'order': order}
+    results = runtime_properties.get(INSTANCE_RUNTIME_PROPERTY_KUBERNETES)
+    if isinstance(results, dict):
+        for path, result in results.items():
+            if not isinstance(result, dict) or 'kind' not in result or \
+                    not isinstance(result.get('metadata'), dict):
+                continue
+            stored = indexed.get(resource_key(result))
+            if stored:
+                stored['path'] = path
+            _add_file_document(path)
+    runtime_properties[DEFS] = indexed
+    runtime_properties[DEFS_ORDER] = len(resource_definitions)
+    runtime_properties[DEFS_LAST] = resource_key(resource_definitions[-1])
+    return indexed
+
+
+def _last_resource_definition(resource_definitions):
+    """ Get the key of the definition that was stored last. Only needed when
+    a resource can not be found by its key or path.
+    """
+    last_key = ctx.instance.runtime_properties.get(DEFS_LAST)
+    if last_key in resource_definitions:
+        return last_key
+    # the last definition was removed, the one before it has the next order
+    if resource_definitions:
+        return max(resource_definitions,
+                   key=lambda key: resource_definitions[key]['order'])
+
+
+def order_added_resource_definitions(runtime_properties, order, added):
+    """ Number the definitions that documents applied in parallel added.
+    Every document started from the same __resource_definitions_order, so
+    they are numbered again, in the order of the documents.
+
+    :param runtime_properties: The merged runtime properties.
+    :param order: The order of the first added definition.
+    :param added: The keys of the added definitions, in document order.
+    """
+    resource_definitions = runtime_properties.get(DEFS) or {}
+    for key in added:
+        if key not in resource_definitions:
+            continue
+        resource_definitions[key]['order'] = order
+        runtime_properties[DEFS_LAST] = key
+        order += 1
+    runtime_properties[DEFS_ORDER] = order
 
 
-def remove_resource_definition(resource_kind, resource_name):
-    resource_definitions = ctx.instance.runtime_properties.get(DEFS, [])
+def store_resource_definition(resource_definition, path=None):
+    resource_definitions = get_resource_definitions()
+    ctx.logger.info('Trying: {0}'.format(resource_definition.to_dict()))
+    key = resource_key(resource_definition)
+    stored = resource_definitions.get(key)
+    if stored:
+        # We found a match but still updating the resource definition
+        # because fields like metadata.labels can change.
+        stored = dict(stored,
+                      definition=sanitize_for_json(resource_definition))
+    else:
+        ctx.logger.info('Adding: {0}'.format(resource_definition))
+        order = ctx.instance.runtime_properties.get(DEFS_ORDER, 0)
+        ctx.instance.runtime_properties[DEFS_ORDER] = order + 1
+        ctx.instance.runtime_properties[DEFS_LAST] = key
+        stored = {'definition': sanitize_for_json(resource_definition),
+                  'order': order}
+    if path:
+        stored['path'] = path
+    resource_definitions[key] = stored
+    ctx.instance.runtime_properties[DEFS] = resource_definitions
+
+
+def remove_resource_definition(resource_kind, resource_name, namespace=None):
+    resource_definitions = get_resource_definitions()
     ctx.logger.info('REMOVE {0} {1}'.format(resource_kind, resource_name))
-    c = 0
-    for list_item in resource_definitions:
-        ctx.logger.info('Checking list item {0}'.format(list_item))
-        if list_item['kind'] == resource_kind and \
-                list_item['metadata']['name'] == \
-                resource_name:
-            ctx.logger.info(
-                'Deleting item {0}'.format(resource_definitions[c]))
-            del resource_definitions[c]
-        c += 1
+    key = _resource_key(resource_kind, namespace, resource_name)
+    if key in resource_definitions:
+        keys = [key]
+    else:
+        # the namespace of the stored resource is not known
+        keys = [k for k, stored in resource_definitions.items()
+                if stored['definition']['kind'] == resource_kind and
+                stored['definition']['metadata']['name'] == resource_name]
+    for key in keys:
+        ctx.logger.info(
+            'Deleting item {0}'.format(resource_definitions.pop(key)))
     ctx.instance.runtime_properties[DEFS] = resource_definitions
     # force save
     ctx.instance.runtime_properties.dirty = True
-    ctx.instance.update()
+    update_instance()
 
 
 def retrieve_stored_resource(resource_definition, api_mapping, delete=False):
 
-    node_resource_definitions = ctx.instance.runtime_properties.get(DEFS, [])
-    json_resource_definition = JsonCleanuper(resource_definition).to_dict()
-    try:
-        stored_resource_definition = node_resource_definitions.pop()
-    except IndexError:
+    node_resource_definitions = get_resource_definitions()
+    json_resource_definition = sanitize_for_json(resource_definition)
+    last_key = _last_resource_definition(node_resource_definitions)
+    if last_key:
+        stored_resource_definition = node_resource_definitions.pop(
+            last_key)['definition']
+        ctx.instance.runtime_properties[DEFS] = node_resource_definitions
+    else:
         ctx.logger.error('No stored resource definitions found.')
         stored_resource_definition = json_resource_definition
     allow_node_definition = ctx.node.properties[PERMIT_REDEFINE]
@@ -474,9 +895,10 @@ def retrieve_stored_resource(resource_definition, api_mapping, delete=False):
     if delete:
         remove_resource_definition(
             resource_definition.kind,
-            resource_definition.metadata['name'])
+            resource_definition.metadata['name'],
+            resource_definition.metadata.get('namespace'))
     ctx.instance.runtime_properties.dirty = True
-    ctx.instance.update()
+    update_instance()
 
     return resource_definition, api_mapping
 
@@ -498,18 +920,38 @@ def retrieve_id(delete=False):
         INSTANCE_RUNTIME_PROPERTY_KUBERNETES] = data
     # force save
     ctx.instance.runtime_properties.dirty = True
-    ctx.instance.update()
+    update_instance()
     return resource_id
 
 
+def get_excluded_fields():
+    """ Get the fields that are dropped from API responses before they are
+    stored in runtime properties.
+
+    :return: A list of dotted field paths.
+    """
+    return get_node(ctx).properties.get(
+        NODE_PROPERTY_EXCLUDE, DEFAULT_EXCLUDED_FIELDS)
+
+
+def project_result(result, exclude=None):
+    if not isinstance(result, dict):
+        return result
+    if exclude is None:
+        exclude = get_excluded_fields()
+    return sanitize_for_json(result, exclude=exclude)
+
+
 def store_result_for_retrieve_id(result, path=None):
 
+    result = project_result(result)
     store_resource_definition(
         KubernetesResourceDefinition(
             result['kind'],
             result.get('api_version', result.get('apiVersion')),
             result['metadata']
-        )
+        ),
+        path
     )
 
     if not isinstance(
@@ -522,12 +964,13 @@ def store_result_for_retrieve_id(result, path=None):
     if path:
         ctx.instance.runtime_properties[
             INSTANCE_RUNTIME_PROPERTY_KUBERNETES][path] = result
+        _add_file_document(path)
     else:
         ctx.instance.runtime_properties[
             INSTANCE_RUNTIME_PROPERTY_KUBERNETES] = result
     # force save
     ctx.instance.runtime_properties.dirty = True
-    ctx.instance.update()
+    update_instance()
 
 
 def get_result_for_retrieve_id(path=None):
@@ -647,6 +1090,212 @@ def handle_existing_resource(resource_exists, definition):
         ctx.instance.runtime_properties['__perform_task'] = False
 
 
+def get_server_side_apply():
+    """ Get the server_side_apply node property.
+
+    :return: A dict with the field_manager and force keys, or None if the
+        resources are created and updated with POST and PUT requests.
+    """
+    apply = ctx.node.properties.get(NODE_PROPERTY_SERVER_SIDE_APPLY) or {}
+    if not apply.get('enabled'):
+        return
+    return {
+        'field_manager': apply.get('field_manager') or DEFAULT_FIELD_MANAGER,
+        'force': apply.get('force_conflicts', False),
+    }
+
+
+def optimistic_create_enabled():
+    """ Create resources without reading them first, and read them only if
+    the create fails because they exist. Resources that are expected to
+    exist are always read first.
+    """
+    return ctx.node.properties.get(NODE_PROPERTY_OPTIMISTIC_CREATE, False) \
+        and not ctx.node.properties.get('use_external_resource', False)
+
+
+def _label_value(value):
+    """ Turn an ID into a valid label value, the same way every time. """
+    value = LABEL_VALUE_INVALID_CHARACTERS.sub('-', text_type(value))
+    value = value.strip('-_.')
+    if len(value) > LABEL_VALUE_MAX_LENGTH:
+        digest = hashlib.sha256(value.encode('utf-8')).hexdigest()[:8]
+        value = '{0}-{1}'.format(
+            value[:LABEL_VALUE_MAX_LENGTH - 9].rstrip('-_.'), digest)
+    return value
+
+
+def get_instance_labels():
+    """ Get the labels that mark the resources of the node instance.
+
+    :return: A dict of labels.
+    """
+    return {
+        LABEL_DEPLOYMENT: _label_value(ctx.deployment.id),
+        LABEL_NODE: _label_value(get_node(ctx).id),
+        LABEL_NODE_INSTANCE: _label_value(get_instance(ctx).id),
+    }
+
+
+def get_instance_label_selector():
+    labels = get_instance_labels()
+    return ','.join('{0}={1}'.format(key, labels[key])
+                    for key in [LABEL_DEPLOYMENT, LABEL_NODE_INSTANCE])
+
+
+def add_instance_labels(resource_definition):
+    """ Label a resource that the node instance creates or updates with its
+    deployment, node and node instance, so that the resources of the node
+    instance can be listed and deleted by label. External resources are not
+    labeled.
+    """
+    if get_node(ctx).properties.get('use_external_resource', False):
+        return
+    metadata = resource_definition.metadata
+    labels = metadata.get('labels') or {}
+    instance_labels = get_instance_labels()
+    if all(labels.get(k) == v for k, v in instance_labels.items()):
+        return
+    # the metadata can be a node property, do not change it in place
+    labels = dict(labels)
+    labels.update(instance_labels)
+    resource_definition.metadata = dict(metadata, labels=labels)
+
+
+def bulk_operations_enabled():
+    """ Check, read and delete the resources of file resources with a
+    request per kind, that selects them by the labels of the node instance.
+    """
+    return get_node(ctx).properties.get(NODE_PROPERTY_BULK_OPERATIONS, False) \
+        and not get_node(ctx).properties.get('use_external_resource', False)
+
+
+def get_owner_anchor():
+    """ Get the owner_anchor node property.
+
+    :return: A dict with the delete_timeout key, or None if the resources
+        have no owner anchor.
+    """
+    anchor = get_node(ctx).properties.get(NODE_PROPERTY_OWNER_ANCHOR) or {}
+    if not anchor.get('enabled') or \
+            get_node(ctx).properties.get('use_external_resource', False):
+        return
+    return {
+        'delete_timeout': anchor.get(
+            'delete_timeout', DEFAULT_OWNER_ANCHOR_DELETE_TIMEOUT),
+    }
+
+
+def forget_deleted_resources(documents):
+    """ Remove the runtime properties of resources that were deleted without
+    their tasks.
+
+    :param documents: A list of (definition, kwargs) tuples.
+    """
+    results = ctx.instance.runtime_properties.get(
+        INSTANCE_RUNTIME_PROPERTY_KUBERNETES)
+    drift_fingerprints = dict(
+        ctx.instance.runtime_properties.get(DRIFT_FINGERPRINTS, {}))
+    for definition, kwargs in documents:
+        path = retrieve_path(kwargs)
+        result = results.pop(path, None) if isinstance(results, dict) \
+            else None
+        drift_fingerprints.pop(path or '', None)
+        remove_definition_fingerprint(definition)
+        # the namespace of the definition can come from the options
+        namespace = ((result or {}).get('metadata') or {}).get(
+            'namespace') or definition.metadata.get('namespace')
+        remove_resource_definition(
+            definition.kind, definition.metadata['name'], namespace)
+    if drift_fingerprints:
+        ctx.instance.runtime_properties[DRIFT_FINGERPRINTS] = \
+            drift_fingerprints
+    else:
+        ctx.instance.runtime_properties.pop(DRIFT_FINGERPRINTS, None)
+    if isinstance(results, dict) and not results:
+        ctx.instance.runtime_properties.pop(
+            INSTANCE_RUNTIME_PROPERTY_KUBERNETES, None)
+    # force save
+    ctx.instance.runtime_properties.dirty = True
+    update_instance()
+
+
+def definition_fingerprint(resource_definition):
+    """ Hash a resource definition, so that the same definition always has
+    the same hash, whatever the order of its keys.
+
+    :param resource_definition: A KubernetesResourceDefinition or a dict.
+    :return: A hex digest.
+    """
+    return _canonical_hash(sanitize_for_json(resource_definition))
+
+
+def _canonical_hash(value):
+    canonical = json.dumps(value,
+                           sort_keys=True,
+                           separators=(',', ':'),
+                           default=text_type)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _fingerprint_key(resource_definition):
+    return '{0}/{1}/{2}/{3}'.format(
+        resource_definition.api_version,
+        resource_definition.kind,
+        resource_definition.metadata.get('namespace') or '',
+        resource_definition.metadata.get('name'))
+
+
+def store_definition_fingerprint(resource_definition):
+    """ Remember the definition that was last applied to a resource, next
+    to the stored resource definitions.
+    """
+    fingerprints = dict(ctx.instance.runtime_properties.get(FINGERPRINTS, {}))
+    key = _fingerprint_key(resource_definition)
+    fingerprints[key] = {
+        'fingerprint': definition_fingerprint(resource_definition),
+        # the updates that were skipped over the life of the resource
+        'skipped_updates': fingerprints.get(key, {}).get(
+            'skipped_updates', 0),
+    }
+    ctx.instance.runtime_properties[FINGERPRINTS] = fingerprints
+
+
+def remove_definition_fingerprint(resource_definition):
+    fingerprints = dict(ctx.instance.runtime_properties.get(FINGERPRINTS, {}))
+    if fingerprints.pop(
+            _fingerprint_key(resource_definition), None):
+        ctx.instance.runtime_properties[FINGERPRINTS] = fingerprints
+
+
+def definition_unchanged(resource_definition):
+    """ Check if a definition is the same as the one that was last applied
+    to the resource.
+
+    :return: bool
+    """
+    if not ctx.node.properties.get(
+            NODE_PROPERTY_SKIP_UNCHANGED_UPDATES, False):
+        return False
+    stored = ctx.instance.runtime_properties.get(FINGERPRINTS, {}).get(
+        _fingerprint_key(resource_definition))
+    return bool(stored) and stored['fingerprint'] == definition_fingerprint(
+        resource_definition)
+
+
+def count_skipped_update(resource_definition):
+    key = _fingerprint_key(resource_definition)
+    fingerprints = dict(ctx.instance.runtime_properties[FINGERPRINTS])
+    fingerprints[key] = dict(
+        fingerprints[key],
+        skipped_updates=fingerprints[key].get('skipped_updates', 0) + 1)
+    ctx.instance.runtime_properties[FINGERPRINTS] = fingerprints
+    ctx.logger.info(
+        'The definition of {0} {1} did not change since it was applied. '
+        'Skipping the update.'.format(resource_definition.kind,
+                                      resource_definition.metadata['name']))
+
+
 def handle_delete_resource(resource_exists):
     expected = ctx.node.properties.get('use_external_resource', False)
 
@@ -798,5 +1447,98 @@ def update_with_additions(resource_definition, additions):
     return definition
 
 
-def check_drift(previous, current):
-    return DeepDiff(Resource(previous).state, Resource(current).state)
+def get_drift_excluded_fields():
+    """ Get the fields that drift detection ignores: the fields that are not
+    stored in runtime properties, the resourceVersion, which changes with
+    every write, and the drift_ignored_fields node property, for example
+    fields that controllers manage, like status.
+
+    :return: A list of dotted field paths.
+    """
+    return get_excluded_fields() + DRIFT_EXCLUDED_FIELDS + list(
+        get_node(ctx).properties.get(NODE_PROPERTY_DRIFT_IGNORED_FIELDS) or [])
+
+
+def _metadata_field(resource, *keys):
+    metadata = resource.get('metadata') if isinstance(resource, dict) else None
+    for key in keys:
+        if isinstance(metadata, dict) and metadata.get(key) is not None:
+            return metadata[key]
+
+
+def _resource_version(resource):
+    return _metadata_field(resource, 'resource_version', 'resourceVersion')
+
+
+def drift_fingerprint(resource, exclude=None):
+    """ Hash the fields of a resource that drift detection compares.
+
+    :param resource: A read response, or the result stored from one.
+    :param exclude: The ignored fields, by default
+        get_drift_excluded_fields().
+    :return: A hex digest.
+    """
+    if exclude is None:
+        exclude = get_drift_excluded_fields()
+    return _canonical_hash(project_result(resource, exclude))
+
+
+def get_drift_fingerprint(previous, path=None):
+    """ Get the drift fingerprint of a stored result. It is stored in
+    runtime properties, and computed again only when the stored result or
+    the ignored fields change.
+
+    :param previous: The stored result.
+    :param path: The resource path of a file resource.
+    :return: A hex digest.
+    """
+    exclude = get_drift_excluded_fields()
+    version = _resource_version(previous)
+    key = path or ''
+    stored = ctx.instance.runtime_properties.get(
+        DRIFT_FINGERPRINTS, {}).get(key)
+    if stored and version and stored['resource_version'] == version \
+            and stored['ignored_fields'] == exclude:
+        return stored['fingerprint']
+    fingerprint = drift_fingerprint(previous, exclude)
+    if version:
+        fingerprints = dict(
+            ctx.instance.runtime_properties.get(DRIFT_FINGERPRINTS, {}))
+        fingerprints[key] = {
+            'resource_version': version,
+            'ignored_fields': exclude,
+            'fingerprint': fingerprint,
+        }
+        ctx.instance.runtime_properties[DRIFT_FINGERPRINTS] = fingerprints
+    return fingerprint
+
+
+def check_drift(previous, current, previous_fingerprint=None):
+    """ Compare the stored result of a resource with a new read of it.
+    The cheap checks come first: the same resourceVersion means that the
+    resource did not change, and the same hash of the compared fields means
+    that only ignored fields changed. Only a resource that did change is
+    diffed field by field.
+
+    :param previous: The stored result.
+    :param current: The read response.
+    :param previous_fingerprint: The drift fingerprint of previous, if it
+        is already known.
+    :return: The differences, empty if the resource did not drift.
+    """
+    version = _resource_version(previous)
+    if version and version == _resource_version(current):
+        return {}
+    exclude = get_drift_excluded_fields()
+    generation = _metadata_field(previous, 'generation')
+    current_generation = _metadata_field(current, 'generation')
+    # a new generation is a change of the spec, there is no point in
+    # hashing it first
+    if generation is None or generation == current_generation:
+        if previous_fingerprint is None:
+            previous_fingerprint = drift_fingerprint(previous, exclude)
+        if previous_fingerprint == drift_fingerprint(current, exclude):
+            return {}
+    # The stored response is projected, so project the current one too.
+    return DeepDiff(Resource(project_result(previous, exclude)).state,
+                    Resource(project_result(current, exclude)).state)
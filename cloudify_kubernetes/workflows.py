@@ -101,9 +101,9 @@ def update_resource_definition(node_instance_id,
             resource_definition_changes = \
                 ast.literal_eval(resource_definition_changes)
         elif 'Unexpected' in str(e):
-            resource_definition_changes = \
+            resource_definition_changes = list(
                 utils.resource_definitions_from_file_result(
-                    resource_definition_changes)
+                    resource_definition_changes))
 
     node_instance = ctx.get_node_instance(node_instance_id)
 